@@ -0,0 +1,246 @@
+# vim: set ts=8 sts=4 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import concurrent.futures
+import inspect
+import time
+import traceback
+from ambuild2.task import LOAD_CHECK_INTERVAL, TaskMaster, TaskWorker
+
+# Runs commands from the main process with asyncio (--asyncio), instead of
+# handing them to a pool of worker processes. Each job slot is just a
+# coroutine, so there are no extra interpreters to start or pickle state into,
+# and very high -j values are cheap.
+#
+# This module needs Python 3.5 or higher, so it's only imported when asked for.
+
+# Threads for work that would block the event loop: parsing dependencies,
+# hashing outputs, and copying files.
+NUM_HELPER_THREADS = 4
+
+# Stands in for a worker process. |pid| is the slot number, which is what
+# gets printed and logged for the commands it runs.
+class AsyncSlot(object):
+    def __init__(self, pid):
+        self.pid = pid
+
+# Runs tasks with TaskWorker's code, driving their steps (see
+# TaskWorker.runSteps()) from the event loop. Nothing here may change the
+# current folder, since every task shares this process.
+class AsyncTaskRunner(TaskWorker):
+    def __init__(self, loop, pool, vars, jobserver_config):
+        self.loop = loop
+        self.pool = pool
+        self.initRunner(vars, jobserver_config)
+
+    def inPool(self, fn, *args):
+        return self.loop.run_in_executor(self.pool, fn, *args)
+
+    async def run(self, message):
+        try:
+            return await self.runTask(message)
+        except Exception as e:
+            response = {
+                'ok': False,
+                'cmdline': self.task_argv_debug(message),
+                'stdout': '',
+                'stderr': traceback.format_exc(),
+            }
+            return self.issueResponse(message, response)
+
+    async def runTask(self, message):
+        response = self.prepareTask(message)
+        if response is not None:
+            return self.issueResponse(message, response)
+
+        response = {'start': time.time()}
+        fn = self.taskMap[message['task_type']]
+        if inspect.isgeneratorfunction(fn):
+            reply = await self.runSteps(fn(message))
+        else:
+            reply = await self.inPool(fn, message)
+        response.update(reply)
+        response['end'] = time.time()
+        return await self.inPool(self.issueResponse, message, response)
+
+    async def runSteps(self, steps):
+        send, value = steps.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                if step[0] == 'execute':
+                    value = await self.execute(*step[1:])
+                else:
+                    value = await self.inPool(step[1], *step[2:])
+                send = steps.send
+            except Exception as exn:
+                send, value = steps.throw, exn
+
+    # Like TaskWorker.execute(), but asyncio reaps the process, so its peak
+    # memory usage isn't known.
+    async def execute(self, argv, folder, env, pass_fds = ()):
+        kwargs = {}
+        if len(pass_fds):
+            kwargs['pass_fds'] = pass_fds
+        out, err = self.createOutputs()
+        try:
+            p = await asyncio.create_subprocess_exec(*argv,
+                                                     cwd = folder,
+                                                     env = env,
+                                                     stdout = out.fp,
+                                                     stderr = err.fp,
+                                                     **kwargs)
+            await p.wait()
+        finally:
+            out.finish()
+            err.finish()
+        return p.returncode, out, err, None
+
+class AsyncTaskMaster(TaskMaster):
+    def __init__(self, cx, builder, task_graph, max_parallel):
+        self.loop_ = asyncio.new_event_loop()
+        self.pool_ = concurrent.futures.ThreadPoolExecutor(NUM_HELPER_THREADS)
+        self.running_ = set()
+        super(AsyncTaskMaster, self).__init__(cx, builder, task_graph, max_parallel)
+
+        if self.jobserver_ is not None:
+            jobserver_config = self.jobserver_.worker_config
+        else:
+            jobserver_config = {}
+        try:
+            self.runner_ = AsyncTaskRunner(self.loop_, self.pool_, cx.vars, jobserver_config)
+        except:
+            # run() won't get a chance to close it.
+            if self.jobserver_ is not None:
+                self.jobserver_.close()
+            raise
+
+    def startWorker(self):
+        slot = AsyncSlot(len(self.workers_) + 1)
+        self.workers_.append(slot)
+        self.cx.tracer.nameThread(slot.pid, 'slot {}'.format(slot.pid))
+
+    # Slots cost nothing, so they're all created up front (in pumpAsync()).
+    def start_workers(self):
+        pass
+
+    # There are no round-trips to save, so tasks are never queued behind
+    # each other.
+    def find_worker(self, task, batches):
+        if len(self.idle_):
+            return next(iter(self.idle_))
+        return None
+
+    def issue_batch(self, worker, tasks):
+        for task in tasks:
+            task.dispatched = time.time()
+            future = asyncio.ensure_future(self.runTask(worker, task), loop = self.loop_)
+            self.running_.add(future)
+
+    async def runTask(self, worker, task):
+        if task.tools_env is not None:
+            self.runner_.addToolsEnvs({task.tools_env.env_id: task.tools_env})
+        result = await self.runner_.run(self.task_message(task))
+        return worker, result
+
+    def pump(self):
+        # Subprocesses need the loop to be the current one, so the child
+        # watcher can find it (before Python 3.8).
+        asyncio.set_event_loop(self.loop_)
+        try:
+            self.loop_.run_until_complete(self.pumpAsync())
+        finally:
+            # Tasks that are still running are allowed to finish; their
+            # results are dropped.
+            if len(self.running_):
+                self.loop_.run_until_complete(asyncio.wait(self.running_))
+            asyncio.set_event_loop(None)
+            self.loop_.close()
+            self.pool_.shutdown()
+
+    async def pumpAsync(self):
+        interrupted = self.watchInterrupt()
+        self.runInlineTasks()
+        self.checkFinished()
+        for _ in range(self.max_workers_):
+            self.startWorker()
+        for worker in self.workers_:
+            self.recvSpawned(worker, {'id': 'spawned'})
+
+        while self.status_ == TaskMaster.BUILD_IN_PROGRESS:
+            waiting = set(self.running_)
+            if interrupted is not None:
+                waiting.add(interrupted)
+            if not len(waiting):
+                # Everything is being held back (see poll_timeout()).
+                await asyncio.sleep(self.poll_timeout() or LOAD_CHECK_INTERVAL)
+                self.issue_tasks()
+                continue
+
+            done, _ = await asyncio.wait(waiting,
+                                         timeout = self.poll_timeout(),
+                                         return_when = asyncio.FIRST_COMPLETED)
+            if not len(done):
+                self.issue_tasks()
+                continue
+
+            if interrupted in done:
+                if self.cx.interrupt.poll():
+                    self.terminateBuild(TaskMaster.BUILD_INTERRUPTED)
+                    break
+                interrupted = self.watchInterrupt()
+
+            for future in done:
+                if future not in self.running_:
+                    continue
+                self.running_.remove(future)
+                worker, result = future.result()
+                self.recvResults(worker, {'id': 'results', 'results': [result]})
+
+        self.stopWatchingInterrupt()
+
+    # Returns a future that completes when the interrupt (see WatchInterrupt)
+    # has something to read, or None if there's no interrupt.
+    def watchInterrupt(self):
+        if self.cx.interrupt is None:
+            return None
+
+        future = self.loop_.create_future()
+
+        def on_readable():
+            self.loop_.remove_reader(self.cx.interrupt.fileno())
+            if not future.done():
+                future.set_result(None)
+
+        try:
+            self.loop_.add_reader(self.cx.interrupt.fileno(), on_readable)
+        except NotImplementedError:
+            # Windows' event loop can't do this, but --watch isn't supported
+            # there either.
+            return None
+        return future
+
+    def stopWatchingInterrupt(self):
+        if self.cx.interrupt is None:
+            return
+        try:
+            self.loop_.remove_reader(self.cx.interrupt.fileno())
+        except NotImplementedError:
+            pass
@@ -4,31 +4,45 @@ import os, errno
 import traceback
 from ambuild2 import util
 from ambuild2 import nodetypes
+from array import array
 from collections import deque
 from ambuild2.task import Task, TaskMaster
+from ambuild2.task import ComputePriorities, DEFAULT_TASK_DURATION
 
 # Given the partial command DAG, compute a task tree we can send to the task
 # thread.
 class TaskTreeBuilder(object):
     def __init__(self, cx):
         self.cx = cx
-        self.worklist = []
-        self.cache = {}
+        self.worklist = array('i')
+        self.tasks = None
         self.cmd_list = []
+        self.task_list = []
         self.tree_leafs = []
         self.max_parallel = 0
 
     def buildFromGraph(self, graph):
+        self.graph = graph
+        self.tasks = [None] * len(graph.entries)
+
         for node in graph.leafs:
             leaf = self.enqueueCommand(node)
             self.tree_leafs.append(leaf)
 
+        out_start = graph.out_start
+        out_edges = graph.out_edges
+        tasks = self.tasks
+
         self.max_parallel = len(self.worklist)
         while len(self.worklist):
-            task, node = self.worklist.pop()
-
-            for outgoing in node.outgoing:
-                outgoing_task = self.findTask(outgoing)
+            node = self.worklist.pop()
+            task = tasks[node]
+
+            for i in range(out_start[node], out_start[node + 1]):
+                outgoing = out_edges[i]
+                outgoing_task = tasks[outgoing]
+                if outgoing_task is None:
+                    outgoing_task = self.enqueueCommand(outgoing)
                 task.addOutgoing(outgoing_task)
 
             if len(self.worklist) > self.max_parallel:
@@ -36,22 +50,19 @@ class TaskTreeBuilder(object):
 
         return self.cmd_list, self.tree_leafs
 
-    def findTask(self, node):
-        if node in self.cache:
-            return self.cache[node]
-        return self.enqueueCommand(node)
-
     def enqueueCommand(self, node):
-        assert node not in self.cache
-        assert node.isCommand()
+        assert self.tasks[node] is None
+        assert self.graph.is_command[node]
+        entry = self.graph.entries[node]
         output_list = []
-        for output in self.cx.db.query_outgoing(node.entry):
+        for output in self.cx.db.query_outgoing(entry):
             assert output.type == nodetypes.Output
             output_list.append(output.path)
-        task = Task(len(self.cmd_list), node.entry, output_list)
-        self.cache[node] = task
-        self.cmd_list.append(node)
-        self.worklist.append((task, node))
+        task = Task(len(self.cmd_list), entry, output_list)
+        self.tasks[node] = task
+        self.cmd_list.append(entry)
+        self.task_list.append(task)
+        self.worklist.append(node)
         return task
 
 class Builder(object):
@@ -59,10 +70,44 @@ class Builder(object):
         self.cx = cx
         self.graph = graph
 
-        tb = TaskTreeBuilder(cx)
-        self.commands, self.leafs = tb.buildFromGraph(graph)
+        with cx.tracer.span('TaskTreeBuilder'):
+            tb = TaskTreeBuilder(cx)
+            self.commands, self.leafs = tb.buildFromGraph(graph)
+        self.tasks = tb.task_list
         self.max_parallel = tb.max_parallel
         self.num_completed_tasks = 0
+        self.num_pruned_tasks = 0
+
+        # Use how long each command took last time to decide what to run first.
+        self.durations = cx.db.query_durations()
+        if len(self.durations):
+            default = sum(self.durations.values()) / len(self.durations)
+        else:
+            default = DEFAULT_TASK_DURATION
+        for task, entry in zip(self.tasks, self.commands):
+            task.duration = self.durations.get(entry.id, default)
+        ComputePriorities(self.tasks)
+
+        # How long commands took this time, written out in commit().
+        self.new_durations = {}
+
+        # Estimate how much memory each command needs, so TaskMaster can keep
+        # big commands (like links with lots of debug info) from running all
+        # at once. Build scripts can override the estimate.
+        memory = cx.db.query_command_memory()
+        peaks = [peak for peak, _ in memory.values() if peak is not None]
+        if len(peaks):
+            default = sum(peaks) // len(peaks)
+        else:
+            default = 0
+        for task, entry in zip(self.tasks, self.commands):
+            peak, reserve = memory.get(entry.id, (None, None))
+            if reserve is not None:
+                task.memory = reserve
+            elif peak is not None:
+                task.memory = peak
+            else:
+                task.memory = default
 
         # Set of nodes we'll mark as clean in the database.
         self.update_set = set()
@@ -83,8 +128,8 @@ class Builder(object):
                 print('  -> ' + output)
 
             for child in leaf.outgoing:
-                child.incoming.remove(leaf)
-                if not len(child.incoming):
+                child.num_incoming -= 1
+                if not child.num_incoming:
                     leafs.append(child)
 
             counter += 1
@@ -103,19 +148,32 @@ class Builder(object):
         if not len(self.leafs):
             return TaskMaster.BUILD_NO_CHANGES, None
 
-        tm = TaskMaster(self.cx, self, self.leafs, self.max_parallel)
-        tm.run()
-        self.commit()
+        if self.cx.options.asyncio:
+            from ambuild2.async_task import AsyncTaskMaster as master_class
+        else:
+            master_class = TaskMaster
+
+        with self.cx.tracer.span('TaskMaster'):
+            tm = master_class(self.cx, self, self.leafs, self.max_parallel)
+            tm.run()
+        with self.cx.tracer.span('Builder.commit'):
+            self.commit()
+
+        if self.num_pruned_tasks:
+            util.con_out(
+                util.ConsoleHeader,
+                'Skipped {0} commands whose inputs were unchanged.'.format(self.num_pruned_tasks),
+                util.ConsoleNormal)
 
         if tm.succeeded() and len(self.commands) != self.num_completed_tasks:
             util.con_err(util.ConsoleRed,
                          'Build marked as completed, but some commands were not executed?!\n',
                          'Commands:', util.ConsoleNormal)
-            for task in self.commands:
-                if not task:
+            for entry in self.commands:
+                if not entry:
                     continue
                 util.con_err(util.ConsoleBlue, ' -> ', util.ConsoleRed,
-                             '{0}'.format(task.entry.format()), util.ConsoleNormal)
+                             '{0}'.format(entry.format()), util.ConsoleNormal)
 
         return tm.status(), tm.failed_task_message
 
@@ -129,9 +187,21 @@ class Builder(object):
         # Update any dirty source file timestamps. It's important that files are
         # not modified in between being used as dependencies and the build
         # finishing; otherwise, the DAG state will be incoherent.
-        for entry in self.update_set:
-            if entry.dirty != nodetypes.ALWAYS_DIRTY:
-                self.cx.db.unmark_dirty(entry)
+        entries = [entry for entry in self.update_set if entry.dirty != nodetypes.ALWAYS_DIRTY]
+
+        # Remember what each source looked like, so a later build can tell
+        # whether a touched file really changed. Without --content-hash, clear
+        # the digest instead, since it would no longer match the stamp.
+        if self.cx.options.content_hash:
+            results = util.DigestFiles([entry.path for entry in entries])
+        else:
+            results = [(None, None)] * len(entries)
+
+        for entry, (stamp, digest) in zip(entries, results):
+            self.markExcludedConsumersDirty(entry)
+            self.cx.db.unmark_dirty(entry, stamp)
+            self.cx.db.set_digest(entry, digest)
+        self.cx.db.set_durations(self.new_durations)
         self.cx.db.commit()
 
     def addDiscoveredSource(self, path):
@@ -240,14 +310,14 @@ class Builder(object):
                      util.ConsoleNormal)
         return False
 
-    def mergeDependencies(self, cmd_node, discovered_paths):
+    def mergeDependencies(self, cmd_entry, discovered_paths):
         # Grab nodes for each dependency.
         discovered_set = self.discoverEntries(discovered_paths)
         if discovered_set is None:
             return False
 
-        strong_inputs = self.cx.db.query_strong_inputs(cmd_node.entry)
-        dynamic_inputs = self.cx.db.query_dynamic_inputs(cmd_node.entry)
+        strong_inputs = self.cx.db.query_strong_inputs(cmd_entry)
+        dynamic_inputs = self.cx.db.query_dynamic_inputs(cmd_entry)
 
         # Any inputs that were not inputs before, should be linked via the
         # dynamic edge table now. If the new input is an output (i.e. a
@@ -262,15 +332,15 @@ class Builder(object):
 
             if added.type != nodetypes.Source:
                 assert added.type == nodetypes.Output
-                if not self.ensureValidDependency(added, cmd_node.entry):
+                if not self.ensureValidDependency(added, cmd_entry):
                     return False
 
             # Add the edge.
-            self.cx.db.add_dynamic_edge(added, cmd_node.entry)
+            self.cx.db.add_dynamic_edge(added, cmd_entry)
 
         # Remove any dynamic links that are no longer needed.
         for removed in (dynamic_inputs - discovered_set):
-            self.cx.db.drop_dynamic_edge(removed, cmd_node.entry)
+            self.cx.db.drop_dynamic_edge(removed, cmd_entry)
 
         # Update the timestamps of the files we used.
         for entry in discovered_set:
@@ -286,23 +356,94 @@ class Builder(object):
                 util.ConsoleBlue, 'Message details:\n', util.ConsoleNormal, '{0}'.format(message))
             return False
 
-        node = self.commands[task_id]
+        cmd_entry = self.commands[task_id]
         self.commands[task_id] = None
 
         if 'deps' in message:
-            if not self.mergeDependencies(node, message['deps']):
+            if not self.mergeDependencies(cmd_entry, message['deps']):
                 return False
 
-        if node.entry.dirty != nodetypes.ALWAYS_DIRTY:
-            for incoming in self.cx.db.query_strong_inputs(node.entry):
+        if cmd_entry.dirty != nodetypes.ALWAYS_DIRTY:
+            for incoming in self.cx.db.query_strong_inputs(cmd_entry):
                 self.lazyUpdateEntry(incoming)
-            for incoming in self.cx.db.query_dynamic_inputs(node.entry):
+            for incoming in self.cx.db.query_dynamic_inputs(cmd_entry):
                 self.lazyUpdateEntry(incoming)
 
-            for path, stamp in updates:
-                entry = self.cx.db.query_path(path)
+        # If the command regenerated its outputs byte-for-byte, there is no need
+        # to run anything downstream of it.
+        changed = not len(updates)
+        for path, stamp, digest in updates:
+            entry = self.cx.db.query_path(path)
+            if entry.digest is None or entry.digest != digest:
+                changed = True
+                self.markExcludedConsumersDirty(entry)
+            if cmd_entry.dirty != nodetypes.ALWAYS_DIRTY:
                 self.cx.db.unmark_dirty(entry, stamp)
-            self.cx.db.unmark_dirty(node.entry)
+            self.cx.db.set_digest(entry, digest)
+
+        if cmd_entry.dirty != nodetypes.ALWAYS_DIRTY:
+            self.cx.db.unmark_dirty(cmd_entry)
+
+        if changed:
+            self.markOutgoingDirty(self.tasks[task_id])
+
+        if 'start' in message:
+            self.recordDuration(cmd_entry, message['end'] - message['start'])
+        if message.get('peak_memory', None) is not None:
+            self.cx.db.set_peak_memory(cmd_entry, message['peak_memory'])
+
+        self.num_completed_tasks += 1
+        return True
+
+    # Blend with earlier runs, so one slow build (say, with a cold disk cache)
+    # doesn't skew the schedule for long.
+    def recordDuration(self, entry, seconds):
+        previous = self.durations.get(entry.id, None)
+        if previous is not None:
+            seconds = (previous + seconds) / 2
+        self.new_durations[entry.id] = seconds
+
+    # Dependents of a command whose outputs changed must run. They're marked
+    # dirty in the database as well, so they're not forgotten if the build
+    # stops before reaching them.
+    def markOutgoingDirty(self, task):
+        for outgoing in task.outgoing:
+            if outgoing.needs_run:
+                continue
+            outgoing.needs_run = True
+
+            entry = self.commands[outgoing.id]
+            if entry.dirty == nodetypes.NOT_DIRTY:
+                self.cx.db.mark_dirty(entry)
+
+    # When the build is restricted to some targets, commands outside of their
+    # closure aren't in the graph, so nothing here would run them after |entry|
+    # changes. Once its new stamp is saved, the next full build wouldn't either,
+    # so they're marked dirty in the database.
+    def markExcludedConsumersDirty(self, entry):
+        restrict = self.graph.restrict
+        if restrict is None:
+            return
+
+        worklist = [entry]
+        seen = set(worklist)
+        while len(worklist):
+            for outgoing in self.cx.db.query_outgoing(worklist.pop()):
+                if outgoing in seen:
+                    continue
+                seen.add(outgoing)
+                if not outgoing.isCommand():
+                    worklist.append(outgoing)
+                elif outgoing not in restrict and outgoing.dirty == nodetypes.NOT_DIRTY:
+                    self.cx.db.mark_dirty(outgoing)
+
+    # Called when a task's last dependency completes. Returns True if the task
+    # can be skipped, because none of its dependencies changed any outputs.
+    def pruneTask(self, task):
+        if task.needs_run:
+            return False
 
+        self.commands[task.id] = None
         self.num_completed_tasks += 1
+        self.num_pruned_tasks += 1
         return True
@@ -0,0 +1,84 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from ambuild2 import database
+from ambuild2 import nodetypes
+from ambuild2 import run
+from ambuild2 import util
+
+# src.txt -> cp -> out/prog -> cp -> package/prog
+#         -> cp -> docs/src.txt
+class RestrictedBuildTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'src.txt')
+        self.write_source(b'old')
+
+        os.mkdir(os.path.join(self.root, '.ambuild2'))
+        db = database.CreateDatabase(os.path.join(self.root, '.ambuild2', 'graph'))
+        source = db.add_source(self.source)
+        out_folder = db.add_folder(None, 'out')
+        package_folder = db.add_folder(None, 'package')
+        docs_folder = db.add_folder(None, 'docs')
+        prog = self.add_copy(db, source, self.source, out_folder, os.path.join('out', 'prog'))
+        self.add_copy(db, prog, prog.path, package_folder, os.path.join('package', 'prog'))
+        self.add_copy(db, source, self.source, docs_folder, os.path.join('docs', 'src.txt'))
+        db.commit()
+        db.close()
+
+        with open(os.path.join(self.root, '.ambuild2', 'vars'), 'wb') as fp:
+            util.DiskPickle({'buildPath': self.root}, fp)
+
+        argv = sys.argv
+        sys.argv = argv[:1]
+        try:
+            self.options, _ = run.BuildOptions()
+        finally:
+            sys.argv = argv
+        self.options.no_daemon = True
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def add_copy(self, db, input, source_path, folder, output_path):
+        cmd = db.add_command(nodetypes.Copy, None, (source_path, output_path), nodetypes.DIRTY,
+                             None)
+        output = db.add_output(folder, output_path)
+        db.add_strong_edge(input, cmd)
+        db.add_strong_edge(cmd, output)
+        return output
+
+    def write_source(self, contents):
+        with open(self.source, 'wb') as fp:
+            fp.write(contents)
+
+    def build(self, targets):
+        with open(os.devnull, 'w') as null:
+            stdout = sys.stdout
+            sys.stdout = null
+            try:
+                self.assertTrue(run.Build(self.root, self.options, [self.root] + targets))
+            finally:
+                sys.stdout = stdout
+
+    def read(self, path):
+        with open(os.path.join(self.root, path), 'rb') as fp:
+            return fp.read()
+
+    def runTest(self):
+        self.build([])
+        self.assertEqual(self.read(os.path.join('package', 'prog')), b'old')
+
+        # Change the source, and only build what out/prog needs.
+        self.write_source(b'new!')
+        self.build([os.path.join('out', 'prog')])
+        self.assertEqual(self.read(os.path.join('out', 'prog')), b'new!')
+        self.assertEqual(self.read(os.path.join('package', 'prog')), b'old')
+
+        # The next full build must still copy the new out/prog, and src.txt.
+        self.build([])
+        self.assertEqual(self.read(os.path.join('package', 'prog')), b'new!')
+        self.assertEqual(self.read(os.path.join('docs', 'src.txt')), b'new!')
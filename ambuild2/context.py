@@ -14,16 +14,36 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+import select
 import time
 import traceback
 import os, sys
-from ambuild2 import util, database, damage
+from ambuild2 import util, database, damage, fswatch, nodetypes, stats, trace
 from ambuild2.builder import Builder
 from ambuild2.frontend.version import Version
 from ambuild2.process_manager import ProcessManager
 from ambuild2.task import Task, TaskMaster
 from optparse import OptionParser
 
+# How long the file system must be quiet before --watch starts a build.
+WATCH_SETTLE_TIME = 0.2
+
+# Cancels a build when a source file or build script changes underneath it.
+class WatchInterrupt(object):
+    def __init__(self, cx, watcher):
+        self.cx = cx
+        self.watcher = watcher
+
+    def fileno(self):
+        return self.watcher.fileno()
+
+    def poll(self):
+        changed = self.watcher.drain()
+        if not changed or not self.watcher.hasSourceChanges(self.cx.db, changed):
+            return False
+        util.con_err(util.ConsoleHeader, 'Inputs changed; restarting build.', util.ConsoleNormal)
+        return True
+
 class Context(object):
     def __init__(self, buildPath, options, args):
         self.buildPath = buildPath
@@ -59,6 +79,13 @@ class Context(object):
         self.procman = ProcessManager()
         self.db.connect()
 
+        # If set, an object whose fileno() becomes readable when the build
+        # might need to be cancelled. Its poll() returns True to cancel.
+        self.interrupt = None
+
+        # Records where time goes during a build (see startTrace).
+        self.tracer = trace.NullTracer()
+
     def __enter__(self):
         return self
 
@@ -91,6 +118,10 @@ class Context(object):
 
         util.con_out(util.ConsoleHeader, 'Reparsing build scripts.', util.ConsoleNormal)
 
+        # The generator expects to import every node itself, so drop anything
+        # a previous build left in the cache (see daemon.py).
+        self.db.flush_caches()
+
         # The database should be upgraded here, so we should always have an
         # API version set.
         api_version = Version(self.db.query_var('api_version'))
@@ -120,7 +151,8 @@ class Context(object):
         cm.db = self.db
         cm.refactoring = self.options.refactor
         try:
-            cm.generate('ambuild2')
+            with self.tracer.span('reconfigure'):
+                cm.generate('ambuild2')
         except:
             traceback.print_exc()
             util.con_err(util.ConsoleRed, 'Failed to reparse build scripts.', util.ConsoleNormal)
@@ -134,25 +166,171 @@ class Context(object):
         return True
 
     def Build(self):
-        if not self.reconfigure():
+        self.startTrace()
+        try:
+            if not self.reconfigure():
+                return False
+
+            return self.build_internal()
+        finally:
+            self.finishTrace()
+
+    # If --trace was given, record the next build in a trace file.
+    def startTrace(self):
+        self.tracer = trace.CreateTracer(self.options.trace)
+
+    def finishTrace(self):
+        self.tracer.save()
+        self.tracer = trace.NullTracer()
+
+    # Build, then rebuild whenever a source file or build script changes, until
+    # interrupted.
+    def Watch(self):
+        watcher = fswatch.BuildWatcher(self.buildPath)
+        if not watcher.active:
+            util.con_err(util.ConsoleRed, 'Watching for changes is not supported on this platform.',
+                         util.ConsoleNormal)
             return False
 
-        return self.build_internal()
+        # Watch before the first build, so it can be cancelled too.
+        self.db.bulk_load()
+        watcher.sync(self.db, full_scan = True)
+
+        self.interrupt = WatchInterrupt(self, watcher)
+        try:
+            while True:
+                self.startTrace()
+                if self.reconfigure():
+                    candidates = watcher.takeCandidates(self.db)
+                    try:
+                        self.build_internal(candidates = candidates)
+                    finally:
+                        # Wait for any tasks still running, so the next build
+                        # starts with fresh workers.
+                        self.procman.close_all_children()
+                        watcher.finishBuild(self.db, candidates)
+                        self.finishTrace()
+                else:
+                    # Keep watching the build scripts, so we can try again.
+                    self.db.flush_caches()
+                    self.db.bulk_load()
+                    watcher.invalidate()
+                    watcher.sync(self.db, full_scan = True)
 
-    def build_internal(self):
+                self.waitForChanges(watcher)
+        except KeyboardInterrupt:
+            return True
+        finally:
+            self.interrupt = None
+            watcher.close()
+
+    def waitForChanges(self, watcher):
+        # Sources that changed during the last build don't need to be waited for.
+        if not watcher.hasSourceChanges(self.db, watcher.pending):
+            util.con_out(util.ConsoleHeader, 'Waiting for changes...', util.ConsoleNormal)
+            while True:
+                select.select([watcher], [], [])
+                changed = watcher.drain()
+                if changed is None or watcher.hasSourceChanges(self.db, changed):
+                    break
+
+        # Editors and checkouts tend to write several files at once; wait for
+        # them to finish.
+        while True:
+            ready, _, _ = select.select([watcher], [], [], WATCH_SETTLE_TIME)
+            if not ready:
+                break
+            watcher.drain()
+
+    # Targets named on the command line, after the build folder.
+    @property
+    def targets(self):
+        return self.args[1:]
+
+    # Find the outputs named by a target: an alias, an output path, or a
+    # folder containing outputs. Paths are relative to the build folder.
+    def resolve_target(self, target):
+        entries = self.db.query_alias(target)
+        if len(entries):
+            return entries
+
+        path = target
+        if os.path.isabs(path):
+            path = util.RelPathIfCommon(path, self.buildPath)
+            if path is None:
+                return entries
+        path = os.path.normpath(path)
+
+        entry = self.db.query_path(path)
+        if entry is not None and entry.type in [nodetypes.Output, nodetypes.SharedOutput]:
+            entries.add(entry)
+            return entries
+
+        if path == '.':
+            prefix = ''
+        else:
+            prefix = path + os.sep
+        for entry in self.db.all_nodes():
+            if entry.type == nodetypes.Output and entry.path.startswith(prefix):
+                entries.add(entry)
+        return entries
+
+    # Returns the set of entries the targets need, or None to build
+    # everything. Returns False if a target could not be found.
+    def compute_restriction(self):
+        if not len(self.targets):
+            return None
+
+        roots = set()
+        for target in self.targets:
+            entries = self.resolve_target(target)
+            if not len(entries):
+                util.con_err(util.ConsoleRed, 'No outputs found for target: ', util.ConsoleBlue,
+                             target, util.ConsoleNormal)
+                return False
+            roots |= entries
+        return damage.ComputeClosure(self.db, roots)
+
+    # If |candidates| is not None, only those entries are checked for changes
+    # on disk (see damage.ComputeDamageGraph).
+    def build_internal(self, candidates = None):
         if self.options.show_graph:
             self.db.printGraph()
             return True
+        if self.options.stats:
+            return stats.PrintStats(self.db)
+
+        # Pull the whole graph into memory with a few sequential scans. The
+        # damage pass and dependency merging then never hit the database for
+        # individual nodes.
+        if not self.db.bulk_loaded:
+            with self.tracer.span('bulk_load'):
+                self.db.bulk_load()
+
+        restrict = self.compute_restriction()
+        if restrict is False:
+            return False
 
         if self.options.show_changed:
-            dmg_list = damage.ComputeDamageGraph(self.db, only_changed = True)
+            dmg_list = damage.ComputeDamageGraph(self.db,
+                                                 only_changed = True,
+                                                 content_hash = self.options.content_hash,
+                                                 candidates = candidates,
+                                                 restrict = restrict)
             for entry in dmg_list:
                 if not entry.isFile():
                     continue
                 print(entry.format())
             return True
 
-        dmg_graph = damage.ComputeDamageGraph(self.db)
+        # The full file graph is only needed to show damage; otherwise, files are
+        # collapsed out while the graph is built.
+        with self.tracer.span('ComputeDamageGraph'):
+            dmg_graph = damage.ComputeDamageGraph(self.db,
+                                                  commands_only = not self.options.show_damage,
+                                                  content_hash = self.options.content_hash,
+                                                  candidates = candidates,
+                                                  restrict = restrict)
         if not dmg_graph:
             return False
 
@@ -161,8 +339,6 @@ class Context(object):
             dmg_graph.printGraph()
             return True
 
-        dmg_graph.filter_commands()
-
         if self.options.show_commands:
             dmg_graph.printGraph()
             return True
@@ -0,0 +1,373 @@
+# vim: set ts=8 sts=4 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+import errno
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+from ambuild2 import fswatch
+from ambuild2 import util
+from optparse import Values
+
+# An optional, long-lived build server for a single build folder. It keeps the
+# database caches in memory and watches every folder containing a file in the
+# graph, so a build only has to check the files that were reported as changed.
+# "ambuild" connects to it over a Unix socket, sends its options and
+# environment, and prints whatever the server sends back. If the client goes
+# away (for example, on Ctrl-C), the build is cancelled.
+
+def SocketPath(buildPath):
+    return os.path.join(buildPath, '.ambuild2', 'daemon.sock')
+
+def IsSupported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork')
+
+# Forwards writes to sys.stdout or sys.stderr to a connected client.
+class ClientStream(object):
+    def __init__(self, conn, id, isatty):
+        self.conn_ = conn
+        self.id_ = id
+        self.isatty_ = isatty
+        self.encoding = 'utf-8'
+
+    def write(self, text):
+        try:
+            self.conn_.send({'id': self.id_, 'text': text})
+        except (OSError, EOFError):
+            # The client went away; ClientInterrupt cancels the build.
+            pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self.isatty_
+
+# Cancels the build when the client's connection becomes readable. The client
+# doesn't send anything during a build, so that means it closed the connection.
+class ClientInterrupt(object):
+    def __init__(self, conn):
+        self.conn_ = conn
+
+    def fileno(self):
+        return self.conn_.fileno()
+
+    def poll(self):
+        return True
+
+# Runs a build with the client's environment, so commands see its PATH,
+# compiler variables, and MAKEFLAGS (see jobserver.Open), and then restores
+# ours.
+class ClientEnvironment(object):
+    def __init__(self, env):
+        self.env_ = env
+        self.saved_ = None
+
+    def __enter__(self):
+        self.saved_ = dict(os.environ)
+        os.environ.clear()
+        os.environ.update(self.env_)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        os.environ.clear()
+        os.environ.update(self.saved_)
+
+class Daemon(object):
+    def __init__(self, buildPath):
+        self.buildPath = buildPath
+        self.socketPath = SocketPath(buildPath)
+        self.varsPath = os.path.join(buildPath, '.ambuild2', 'vars')
+        self.cx = None
+        self.watcher = fswatch.BuildWatcher(buildPath)
+        self.data_version_ = None
+        self.vars_stamp_ = None
+
+    def run(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.unlink(self.socketPath)
+        except OSError:
+            pass
+        server.bind(self.socketPath)
+        os.chmod(self.socketPath, 0o600)
+        server.listen(4)
+
+        try:
+            self.pump(server)
+        finally:
+            server.close()
+            try:
+                os.unlink(self.socketPath)
+            except OSError:
+                pass
+            self.closeContext()
+            self.watcher.close()
+
+    def pump(self, server):
+        watch_fd = self.watcher.fileno()
+        rdlist = [server]
+        if watch_fd is not None:
+            rdlist.append(watch_fd)
+
+        while True:
+            try:
+                ready, _, _ = select.select(rdlist, [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            # Keep the kernel's event queue short while we're idle.
+            if watch_fd in ready:
+                self.watcher.drain()
+
+            if server in ready:
+                sock, _ = server.accept()
+                conn = mp.connection.Connection(sock.detach())
+                try:
+                    if not self.serve(conn):
+                        return
+                finally:
+                    conn.close()
+
+    # Returns False if the server should shut down.
+    def serve(self, conn):
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return True
+
+        if message['id'] == 'stop':
+            conn.send({'id': 'done', 'ok': True})
+            return False
+        if message['id'] != 'build':
+            conn.send({'id': 'stderr', 'text': 'Unknown request: {}\n'.format(message['id'])})
+            conn.send({'id': 'done', 'ok': False})
+            return True
+
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = ClientStream(conn, 'stdout', message['isatty'][0])
+        sys.stderr = ClientStream(conn, 'stderr', message['isatty'][1])
+        try:
+            with util.FolderChanger(self.buildPath), ClientEnvironment(message['env']):
+                ok = self.build(Values(message['options']), message['args'], ClientInterrupt(conn))
+        except Exception:
+            traceback.print_exc()
+            ok = False
+
+            # Don't trust anything we have cached.
+            self.closeContext()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+        try:
+            conn.send({'id': 'done', 'ok': ok})
+        except (OSError, EOFError):
+            pass
+        return True
+
+    def build(self, options, args, interrupt):
+        if self.cx is not None and self.isStale():
+            self.closeContext()
+        if self.cx is None:
+            self.openContext(options)
+        self.cx.options = options
+        self.cx.args = args
+
+        # The client's environment replaced the one the build was configured
+        # with; put that back on top, as a local build would.
+        self.cx.restore_environment()
+
+        # reconfigureAndBuild() might close the context.
+        cx = self.cx
+        cx.interrupt = interrupt
+        cx.startTrace()
+        try:
+            return self.reconfigureAndBuild()
+        finally:
+            cx.finishTrace()
+            cx.interrupt = None
+
+    def reconfigureAndBuild(self):
+        if not self.cx.reconfigure():
+            # A failed reparse leaves its changes in the open transaction and
+            # in the caches. Closing the connection rolls them back, so the
+            # next build reparses too.
+            self.closeContext()
+            return False
+
+        candidates = self.watcher.takeCandidates(self.cx.db)
+        try:
+            return self.cx.build_internal(candidates = candidates)
+        finally:
+            # Don't leave workers running between builds.
+            self.cx.procman.close_all_children()
+            self.watcher.finishBuild(self.cx.db, candidates)
+            if len(self.cx.targets):
+                # Changes outside the targets were ignored, so check everything
+                # next time.
+                self.watcher.invalidate()
+            self.data_version_ = self.cx.db.data_version()
+            self.vars_stamp_ = util.FileStamp(self.varsPath)
+
+    def openContext(self, options):
+        from ambuild2.context import Context
+        self.cx = Context(self.buildPath, options, [])
+        self.cx.db.bulk_load()
+        self.data_version_ = self.cx.db.data_version()
+        self.vars_stamp_ = util.FileStamp(self.varsPath)
+        self.watcher.invalidate()
+
+    def closeContext(self):
+        if self.cx is None:
+            return
+        self.cx.__exit__(None, None, None)
+        self.cx = None
+
+    # Something other than us (like configure.py) changed the build.
+    def isStale(self):
+        if util.FileStamp(self.varsPath) != self.vars_stamp_:
+            return True
+        return self.cx.db.data_version() != self.data_version_
+
+def StartDaemon(buildPath):
+    if not IsSupported():
+        util.con_err(util.ConsoleRed, 'The build daemon is not supported on this platform.',
+                     util.ConsoleNormal)
+        return False
+
+    conn = Connect(buildPath)
+    if conn is not None:
+        conn.close()
+        util.con_err(util.ConsoleRed, 'A build daemon is already running for this folder.',
+                     util.ConsoleNormal)
+        return False
+
+    pid = os.fork()
+    if pid == 0:
+        DaemonMain(buildPath)
+        os._exit(0)
+
+    # Wait for the server to start listening.
+    for _ in range(100):
+        conn = Connect(buildPath)
+        if conn is not None:
+            conn.close()
+            util.con_out(util.ConsoleHeader, 'Build daemon started (pid: {0}).'.format(pid),
+                         util.ConsoleNormal)
+            return True
+        time.sleep(0.1)
+
+    util.con_err(util.ConsoleRed, 'Build daemon failed to start; see ',
+                 os.path.join(buildPath, '.ambuild2', 'daemon.log'), util.ConsoleNormal)
+    return False
+
+def DaemonMain(buildPath):
+    os.setsid()
+
+    log_path = os.path.join(buildPath, '.ambuild2', 'daemon.log')
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(null_fd)
+    os.close(log_fd)
+
+    def on_terminate(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, on_terminate)
+
+    try:
+        Daemon(buildPath).run()
+    except SystemExit:
+        pass
+    except:
+        traceback.print_exc()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+def Connect(buildPath):
+    if not IsSupported():
+        return None
+
+    socketPath = SocketPath(buildPath)
+    if not os.path.exists(socketPath):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except OSError:
+        # Stale socket from a server that died.
+        sock.close()
+        return None
+    return mp.connection.Connection(sock.detach())
+
+# Send a request to the daemon and print its output. Returns None if there is
+# no daemon running, otherwise whether the request succeeded.
+def ClientRequest(buildPath, message):
+    conn = Connect(buildPath)
+    if conn is None:
+        return None
+
+    try:
+        conn.send(message)
+        while True:
+            reply = conn.recv()
+            if reply['id'] == 'stdout':
+                sys.stdout.write(reply['text'])
+            elif reply['id'] == 'stderr':
+                sys.stderr.write(reply['text'])
+            elif reply['id'] == 'done':
+                sys.stdout.flush()
+                sys.stderr.flush()
+                return reply['ok']
+    except (EOFError, OSError):
+        util.con_err(util.ConsoleRed, 'Lost connection to the build daemon.', util.ConsoleNormal)
+        return False
+    except KeyboardInterrupt:
+        # Closing the connection cancels the build (see ClientInterrupt).
+        util.con_err(util.ConsoleHeader, 'Build cancelled.', util.ConsoleNormal)
+        return False
+    finally:
+        conn.close()
+
+def ClientBuild(buildPath, options, args):
+    message = {
+        'id': 'build',
+        'options': vars(options),
+        'args': args,
+        'env': dict(os.environ),
+        'isatty': (sys.stdout.isatty(), sys.stderr.isatty()),
+    }
+    return ClientRequest(buildPath, message)
+
+def StopDaemon(buildPath):
+    if ClientRequest(buildPath, {'id': 'stop'}) is None:
+        util.con_err(util.ConsoleRed, 'No build daemon is running for this folder.',
+                     util.ConsoleNormal)
+        return False
+    util.con_out(util.ConsoleHeader, 'Build daemon stopped.', util.ConsoleNormal)
+    return True
@@ -17,18 +17,14 @@
 import os
 import sys
 from ambuild2 import nodetypes
+from ambuild2 import util
 from ambuild2.graph import Graph
 
-def ComputeSourceDirty(node):
-    if not os.path.exists(node.path):
-        return True
-
-    return os.path.getmtime(node.path) != node.stamp
-
-def ComputeOutputDirty(node):
-    if not os.path.exists(node.path):
-        return True
+# |stamp| is the file's current util.FileStamp(), or None if it's missing.
+def ComputeSourceDirty(node, stamp):
+    return stamp != node.stamp
 
+def ComputeOutputDirty(node, stamp):
     # If the timestamp on the object file has changed, then one of two things
     # happened:
     #  (1) The build command completed, but the build process crashed, and we
@@ -38,37 +34,124 @@ def ComputeOutputDirty(node):
     # In the first case, our preceding command node will not have been undirtied,
     # so we should be able to find our incoming command in the graph. However,
     # case #2 breaks that guarantee. To be safe, if the timestamp has changed,
-    # we mark the node as dirty.
-    stamp = os.path.getmtime(node.path)
+    # we mark the node as dirty. A missing file has no stamp, so it is always
+    # dirty.
     return stamp != node.stamp
 
-def ComputeDirty(node):
+def ComputeDirty(node, stamp):
     if node.type == nodetypes.Source:
-        dirty = ComputeSourceDirty(node)
+        dirty = ComputeSourceDirty(node, stamp)
     elif node.type == nodetypes.Output:
-        dirty = ComputeOutputDirty(node)
+        dirty = ComputeOutputDirty(node, stamp)
     else:
         raise Exception('cannot compute dirty bit for node type: ' + node.type)
     return dirty
 
-def ComputeDamageGraph(database, only_changed = False):
-    graph = Graph(database)
-
-    def maybe_mkdir(node):
-        if not os.path.exists(node.path):
-            graph.create.append(node)
-
-    database.query_mkdir(maybe_mkdir)
-
+# Return the set of entries that |roots| need in order to be built: every
+# strong, dynamic and weak input, transitively, and the folders they live in.
+def ComputeClosure(database, roots):
+    closure = set()
+    worklist = list(roots)
+    while len(worklist):
+        entry = worklist.pop()
+        if entry in closure:
+            continue
+        closure.add(entry)
+
+        if entry.folder is not None:
+            worklist.append(entry.folder)
+        if entry.type == nodetypes.Source or entry.type == nodetypes.Mkdir:
+            continue
+
+        worklist.extend(database.query_strong_inputs(entry))
+        worklist.extend(database.query_dynamic_inputs(entry))
+        worklist.extend(database.query_weak_inputs(entry))
+    return closure
+
+# If |candidates| is not None, it is a list of entries that might have changed
+# on disk (for example, as reported by a file system watcher). Only those
+# entries are checked, rather than every file and folder in the graph.
+#
+# If |restrict| is not None, it is a set of entries (see ComputeClosure), and
+# nothing outside of it is checked, added to the graph, or marked dirty.
+def ComputeDamageGraph(database,
+                       only_changed = False,
+                       commands_only = True,
+                       content_hash = False,
+                       candidates = None,
+                       restrict = None):
+    graph = Graph(database, commands_only = commands_only, restrict = restrict)
+
+    mkdirs = []
     dirty = []
+    rehash = []
+    maybe_dirty = []
+
+    if restrict is not None and candidates is None:
+        candidates = restrict
 
-    def maybe_add_dirty(node):
-        if ComputeDirty(node):
-            database.mark_dirty(node)
-            dirty.append(node)
+    if candidates is None:
+        database.query_mkdir(lambda node: mkdirs.append(node))
+        database.query_known_dirty(lambda node: dirty.append(node))
+        database.query_maybe_dirty(lambda node: maybe_dirty.append(node))
+    else:
+        database.query_known_dirty(lambda node: dirty.append(node))
+        if restrict is not None:
+            dirty = [node for node in dirty if node in restrict]
+            candidates = [node for node in candidates if node in restrict]
+        for node in candidates:
+            if node.type == nodetypes.Mkdir:
+                mkdirs.append(node)
+            elif node.dirty == nodetypes.NOT_DIRTY and node.isFile():
+                maybe_dirty.append(node)
+
+    # Stat everything in one batch, so it can be spread across threads.
+    paths = [node.path for node in mkdirs]
+    paths.extend([node.path for node in maybe_dirty])
+    stamps = util.FileStamps(paths)
+
+    for node, stamp in zip(mkdirs, stamps):
+        if stamp is None:
+            graph.create.append(node)
 
-    database.query_known_dirty(lambda node: dirty.append(node))
-    database.query_maybe_dirty(maybe_add_dirty)
+    def maybe_add_dirty(node, stamp):
+        if not ComputeDirty(node, stamp):
+            return
+
+        # If we know what the source looked like last time, check whether
+        # its contents actually changed.
+        if content_hash and node.type == nodetypes.Source and node.digest is not None:
+            rehash.append(node)
+            return
+
+        database.mark_dirty(node)
+        dirty.append(node)
+
+    for node, stamp in zip(maybe_dirty, stamps[len(mkdirs):]):
+        maybe_add_dirty(node, stamp)
+
+    if len(rehash):
+        absorbed = 0
+        results = util.DigestFiles([node.path for node in rehash])
+        for node, (stamp, digest) in zip(rehash, results):
+            if digest is not None and digest == node.digest:
+                # Only the timestamp changed. Record it so we don't hash this
+                # file again next time.
+                database.unmark_dirty(node, stamp)
+                absorbed += 1
+            else:
+                database.mark_dirty(node)
+                dirty.append(node)
+
+        # Commit now, since the build might not (for example, if nothing
+        # else changed).
+        database.commit()
+
+        if absorbed:
+            util.con_out(
+                util.ConsoleHeader,
+                '{0} of {1} touched source files had no content changes.'.format(
+                    absorbed, len(rehash)), util.ConsoleNormal)
 
     if only_changed:
         return dirty
@@ -86,6 +169,10 @@ def ComputeDamageGraph(database, only_changed = False):
                 return None
 
             for cmd in incoming:
+                # The output was changed behind our back, so the command must
+                # run even if none of its inputs change.
+                if cmd.dirty == nodetypes.NOT_DIRTY:
+                    database.mark_dirty(cmd)
                 graph.addEntry(cmd)
         else:
             graph.addEntry(entry)
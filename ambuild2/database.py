@@ -23,18 +23,24 @@ from ambuild2 import nodetypes
 from ambuild2.nodetypes import Entry
 import traceback
 
+# How many builds to keep in the build log (see --stats).
+BUILD_LOG_SIZE = 20
+
 def CreateDatabase(path):
   cn = sqlite3.connect(path)
   queries = [
     "create table if not exists nodes(            \
       id integer primary key autoincrement,       \
       type varchar(4) not null,                   \
-      stamp real not null default 0.0,            \
+      stamp integer not null default 0,           \
+      size integer not null default 0,            \
+      inode integer not null default 0,           \
       dirty int not null default 0,               \
       path text,                                  \
       folder int,                                 \
       data blob,                                  \
-      env_id int default null                     \
+      env_id int default null,                    \
+      digest blob default null                    \
     )",
 
     # The edge table stores links that are specified by the build scripts;
@@ -73,7 +79,50 @@ def CreateDatabase(path):
       val varchar(255)                          \
     )",
 
-    "insert into vars (key, val) values ('db_version', '6')",
+    # Named groups of outputs, which can be passed to ambuild as targets.
+    "create table if not exists aliases(        \
+      name text not null,                       \
+      node_id int not null,                     \
+      unique (name, node_id)                    \
+    )",
+
+    # How long each command took the last few times it ran, in seconds.
+    "create table if not exists durations(      \
+      node_id int primary key,                  \
+      seconds real not null                     \
+    )",
+
+    # One row for each of the last few builds (see BUILD_LOG_SIZE), and one
+    # row for each command those builds ran. Times are seconds since the
+    # epoch.
+    "create table if not exists builds(         \
+      id integer primary key autoincrement,     \
+      start real not null,                      \
+      end real,                                 \
+      workers int not null                      \
+    )",
+    "create table if not exists command_log(    \
+      build_id int not null,                    \
+      node_id int not null,                     \
+      start real not null,                      \
+      end real not null,                        \
+      pid int not null,                         \
+      status int not null,                      \
+      stdout_bytes int not null,                \
+      stderr_bytes int not null                 \
+    )",
+    "create index if not exists command_log_build on command_log(build_id)",
+
+    # Peak memory use of each command the last time it ran, and the amount
+    # the build script said to reserve for it (AddCommand's |memory|), in
+    # bytes.
+    "create table if not exists command_memory( \
+      node_id int primary key,                  \
+      peak int,                                 \
+      reserve int                               \
+    )",
+
+    "insert into vars (key, val) values ('db_version', '12')",
 
     "create index if not exists outgoing_edge on edges(outgoing)",
     "create index if not exists incoming_edge on edges(incoming)",
@@ -127,6 +176,9 @@ class Database(object):
     self.path_cache_ = {}
     self.env_cache_ = {}
     self.env_reverse_lookup_ = {}
+    self.bulk_loaded_ = False
+    self.edges_loaded_ = False
+    self.lazy_edge_budget_ = 0
 
   def connect(self):
     assert not self.cn
@@ -150,9 +202,128 @@ class Database(object):
   def commit(self):
     self.cn.commit()
 
+  @property
+  def bulk_loaded(self):
+    return self.bulk_loaded_
+
+  # Only meaningful once bulk_load() has been called.
+  @property
+  def num_nodes(self):
+    return len(self.node_cache_)
+
+  def all_nodes(self):
+    assert self.bulk_loaded_
+    return list(self.node_cache_.values())
+
+  # Returns a number that changes whenever another connection commits to the
+  # database, so long-lived processes can tell when their caches are stale.
+  def data_version(self):
+    return self.cn.execute("PRAGMA data_version").fetchone()[0]
+
   def flush_caches(self):
     self.node_cache_ = {}
     self.path_cache_ = {}
+    self.bulk_loaded_ = False
+    self.edges_loaded_ = False
+
+  # Load every node into the cache with a single sequential scan, rather than
+  # importing nodes one query at a time. Once loaded, path and node lookups are
+  # answered from memory. This must be called with empty caches (for example,
+  # right after flush_caches()).
+  #
+  # Edges are still fetched lazily per node, since small incremental builds
+  # only touch a handful of them. Once the number of per-node edge queries
+  # suggests that a full scan would be cheaper, every edge table is loaded in
+  # one pass instead (see load_edges()).
+  def bulk_load(self):
+    assert not self.node_cache_
+
+    self.load_environments()
+
+    folders = []
+    query = """
+      select id, type, stamp, dirty, path, folder, data, env_id, digest, size, inode
+      from nodes
+    """
+    rows = self.cn.execute(query)
+    for id, type, stamp, dirty, path, folder_id, data, env_id, digest, size, inode in rows:
+      if not data:
+        blob = None
+      else:
+        blob = util.Unpickle(data)
+
+      node = Entry(id=id,
+                   type=type,
+                   path=path,
+                   blob=blob,
+                   folder=None,
+                   stamp=(stamp, size, inode),
+                   dirty=dirty,
+                   digest=digest)
+      if env_id:
+        node.tools_env = self.fetch_environment(env_id)
+
+      # Folders can have a higher id than the nodes inside them (for example,
+      # when an output changes to a folder), so link them in a second pass.
+      if folder_id:
+        folders.append((node, folder_id))
+
+      self.node_cache_[id] = node
+      if path:
+        self.path_cache_[path] = node
+
+    for node, folder_id in folders:
+      node.folder = self.node_cache_[folder_id]
+
+    # A lazy edge query costs roughly as much as scanning a handful of edge
+    # rows, so switch to a full scan once we've issued enough of them.
+    num_edges = 0
+    for table in ['edges', 'dynamic_edges', 'weak_edges']:
+      num_edges += self.cn.execute("select count(*) from {}".format(table)).fetchone()[0]
+    self.lazy_edge_budget_ = max(num_edges // 8, 64)
+
+    self.bulk_loaded_ = True
+
+  # Load all edges into the Entry adjacency sets, one sequential scan per edge
+  # table. Any sets that were already filled lazily are rebuilt from scratch.
+  def load_edges(self):
+    assert self.bulk_loaded_
+
+    nodes = self.node_cache_
+    for node in nodes.values():
+      self.init_edge_caches(node)
+
+    query = "select outgoing, incoming from edges"
+    for outgoing_id, incoming_id in self.cn.execute(query).fetchall():
+      to_entry = nodes[outgoing_id]
+      from_entry = nodes[incoming_id]
+      to_entry.strong_inputs.add(from_entry)
+      from_entry.outgoing.add(to_entry)
+
+    query = "select outgoing, incoming from dynamic_edges"
+    for outgoing_id, incoming_id in self.cn.execute(query).fetchall():
+      to_entry = nodes[outgoing_id]
+      from_entry = nodes[incoming_id]
+      to_entry.dynamic_inputs.add(from_entry)
+      from_entry.outgoing.add(to_entry)
+
+    query = "select outgoing, incoming from weak_edges"
+    for outgoing_id, incoming_id in self.cn.execute(query).fetchall():
+      nodes[outgoing_id].weak_inputs.add(nodes[incoming_id])
+
+    self.edges_loaded_ = True
+
+  # Called before each lazy edge lookup, which costs |num_queries| queries.
+  # Returns True if the edge caches were just filled, in which case the caller
+  # should return the cached set.
+  def maybe_load_edges(self, num_queries = 1):
+    if not self.bulk_loaded_:
+      return False
+    self.lazy_edge_budget_ -= num_queries
+    if self.lazy_edge_budget_ > 0:
+      return False
+    self.load_edges()
+    return True
 
   def check_upgrade(self):
     try:
@@ -165,7 +336,7 @@ class Database(object):
     except:
       version = 1
 
-    latest_version = 6
+    latest_version = 12
     if version == latest_version:
       return
     if version > latest_version:
@@ -192,6 +363,24 @@ class Database(object):
     if version == 5:
       version = self.upgrade_to_v6()
 
+    if version == 6:
+      version = self.upgrade_to_v7()
+
+    if version == 7:
+      version = self.upgrade_to_v8()
+
+    if version == 8:
+      version = self.upgrade_to_v9()
+
+    if version == 9:
+      version = self.upgrade_to_v10()
+
+    if version == 10:
+      version = self.upgrade_to_v11()
+
+    if version == 11:
+      version = self.upgrade_to_v12()
+
   def upgrade_to_v2(self):
     queries = [
       "create table if not exists vars(           \
@@ -276,6 +465,111 @@ class Database(object):
     self.cn.commit()
     return 6
 
+  def upgrade_to_v7(self):
+    # Existing outputs have no digest, so they'll all count as changed the
+    # next time they're regenerated.
+    self.cn.execute("ALTER TABLE nodes ADD COLUMN digest BLOB DEFAULT NULL")
+    self.cn.execute("INSERT OR REPLACE INTO vars (key, val) VALUES ('db_version', ?)", (7,))
+    self.cn.commit()
+    return 7
+
+  def upgrade_to_v8(self):
+    # Stamps are now integer nanoseconds, which need a column without REAL
+    # affinity, so the table is rebuilt. Old stamps can't be converted exactly,
+    # so they're reset; every file will be rechecked (and outputs rebuilt)
+    # once.
+    queries = [
+      "drop table if exists nodestmp",
+      "drop table if exists nodesold",
+
+      "create table nodestmp(                       \
+        id integer primary key autoincrement,       \
+        type varchar(4) not null,                   \
+        stamp integer not null default 0,           \
+        size integer not null default 0,            \
+        inode integer not null default 0,           \
+        dirty int not null default 0,               \
+        path text,                                  \
+        folder int,                                 \
+        data blob,                                  \
+        env_id int default null,                    \
+        digest blob default null                    \
+      )",
+
+      """
+        insert into nodestmp
+          (id, type, dirty, path, folder, data, env_id, digest)
+          select id, type, dirty, path, folder, data, env_id, digest
+          from nodes
+          order by id asc
+      """,
+
+      "alter table nodes rename to nodesold",
+      "alter table nodestmp rename to nodes",
+      "drop table nodesold",
+      "CREATE UNIQUE INDEX IF NOT EXISTS node_path ON nodes(path)",
+    ]
+    for query in queries:
+      self.cn.execute(query)
+    self.cn.execute("INSERT OR REPLACE INTO vars (key, val) VALUES ('db_version', ?)", (8,))
+    self.cn.commit()
+    return 8
+
+  def upgrade_to_v9(self):
+    self.cn.execute("create table if not exists aliases(        \
+      name text not null,                       \
+      node_id int not null,                     \
+      unique (name, node_id)                    \
+    )")
+    self.cn.execute("INSERT OR REPLACE INTO vars (key, val) VALUES ('db_version', ?)", (9,))
+    self.cn.commit()
+    return 9
+
+  def upgrade_to_v10(self):
+    self.cn.execute("create table if not exists durations(      \
+      node_id int primary key,                  \
+      seconds real not null                     \
+    )")
+    self.cn.execute("INSERT OR REPLACE INTO vars (key, val) VALUES ('db_version', ?)", (10,))
+    self.cn.commit()
+    return 10
+
+  def upgrade_to_v11(self):
+    queries = [
+      "create table if not exists builds(         \
+        id integer primary key autoincrement,     \
+        start real not null,                      \
+        end real,                                 \
+        workers int not null                      \
+      )",
+      "create table if not exists command_log(    \
+        build_id int not null,                    \
+        node_id int not null,                     \
+        start real not null,                      \
+        end real not null,                        \
+        pid int not null,                         \
+        status int not null,                      \
+        stdout_bytes int not null,                \
+        stderr_bytes int not null                 \
+      )",
+      "create index if not exists command_log_build on command_log(build_id)",
+    ]
+    for query in queries:
+      self.cn.execute(query)
+    self.cn.execute("INSERT OR REPLACE INTO vars (key, val) VALUES ('db_version', ?)", (11,))
+    self.cn.commit()
+    return 11
+
+  def upgrade_to_v12(self):
+    self.cn.execute("create table if not exists command_memory( \
+      node_id int primary key,                  \
+      peak int,                                 \
+      reserve int                               \
+    )")
+    self.cn.execute("INSERT OR REPLACE INTO vars (key, val) VALUES ('db_version', ?)", (12,))
+    self.cn.commit()
+    return 12
+
   def query_var(self, var):
     cursor = self.cn.execute("select val from vars where key = ?", (var,))
     row = cursor.fetchone()
@@ -324,11 +618,14 @@ class Database(object):
     query = "insert into nodes (type, path, folder) values (?, ?, ?)"
 
     cursor = self.cn.execute(query, (type, path, folder_id))
-    row = (type, 0, 1, path, folder_entry, None, None)
-    return self.import_node(
+    row = (type, 0, 1, path, folder_entry, None, None, None, 0, 0)
+    node = self.import_node(
       id=cursor.lastrowid,
       row=row
     )
+    if self.edges_loaded_:
+      self.init_edge_caches(node)
+    return node
 
   def update_command(self, entry, type, folder, data, dirty, refactoring, env_data):
     if not data:
@@ -415,12 +712,22 @@ class Database(object):
     cursor = self.cn.execute(query, (type, folder_id, blob, dirty, env_id))
 
     entry = Entry(id = cursor.lastrowid, type = type, path = None, blob = data, folder = folder,
-                  stamp = 0, dirty = nodetypes.DIRTY)
+                  stamp = util.NullStamp, dirty = nodetypes.DIRTY)
     entry.tools_env = tools_env
 
     self.node_cache_[entry.id] = entry
+    if self.edges_loaded_:
+      self.init_edge_caches(entry)
     return entry
 
+  # Once every edge is in memory, new nodes start out with empty (and complete)
+  # edge caches, so they never need to be queried.
+  def init_edge_caches(self, entry):
+    entry.strong_inputs = set()
+    entry.dynamic_inputs = set()
+    entry.weak_inputs = set()
+    entry.outgoing = set()
+
   def add_weak_edge(self, from_entry, to_entry):
     query = "insert into weak_edges (outgoing, incoming) values (?, ?)"
     self.cn.execute(query, (to_entry.id, from_entry.id))
@@ -479,16 +786,22 @@ class Database(object):
     if id in self.node_cache_:
       return self.node_cache_[id]
 
-    query = "select type, stamp, dirty, path, folder, data, env_id from nodes where id = ?"
+    query = """
+      select type, stamp, dirty, path, folder, data, env_id, digest, size, inode
+      from nodes
+      where id = ?
+    """
     cursor = self.cn.execute(query, (id,))
     return self.import_node(id, cursor.fetchone())
 
   def query_path(self, path):
     if path in self.path_cache_:
       return self.path_cache_[path]
+    if self.bulk_loaded_:
+      return None
 
     query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
+      select id, type, stamp, dirty, path, folder, data, env_id, digest, size, inode
       from nodes
       where path = ?
     """
@@ -518,8 +831,9 @@ class Database(object):
                  path=row[3],
                  blob=blob,
                  folder=folder,
-                 stamp=row[1],
-                 dirty=row[2])
+                 stamp=(row[1], row[8], row[9]),
+                 dirty=row[2],
+                 digest=row[7])
 
     if row[6]:
       node.tools_env = self.fetch_environment(row[6])
@@ -552,6 +866,8 @@ class Database(object):
   def query_outgoing(self, node):
     if node.outgoing is not None:
       return node.outgoing
+    if self.maybe_load_edges(2):
+      return node.outgoing
 
     node.outgoing = set()
 
@@ -570,6 +886,8 @@ class Database(object):
   def query_weak_inputs(self, node):
     if node.weak_inputs is not None:
       return node.weak_inputs
+    if self.maybe_load_edges():
+      return node.weak_inputs
 
     query = "select incoming from weak_edges where outgoing = ?"
     node.weak_inputs = set()
@@ -582,6 +900,8 @@ class Database(object):
   def query_strong_inputs(self, node):
     if node.strong_inputs is not None:
       return node.strong_inputs
+    if self.maybe_load_edges():
+      return node.strong_inputs
 
     query = "select incoming from edges where outgoing = ?"
     node.strong_inputs = set()
@@ -614,6 +934,8 @@ class Database(object):
   def query_dynamic_inputs(self, node):
     if node.dynamic_inputs is not None:
       return node.dynamic_inputs
+    if self.maybe_load_edges():
+      return node.dynamic_inputs
 
     query = "select incoming from dynamic_edges where outgoing = ?"
     node.dynamic_inputs = set()
@@ -662,26 +984,33 @@ class Database(object):
   def unmark_dirty(self, entry, stamp=None):
     assert entry.dirty != nodetypes.ALWAYS_DIRTY
 
-    query = "update nodes set dirty = ?, stamp = ? where id = ?"
     if not stamp:
       if entry.isCommand():
-        stamp = 0.0
+        stamp = util.NullStamp
       else:
-        try:
-          stamp = os.path.getmtime(entry.path)
-        except:
-          traceback.print_exc()
+        stamp = util.FileStamp(entry.path)
+        if stamp is None:
           util.con_err(
             util.ConsoleRed,
-            'Could not unmark file as dirty; leaving dirty.',
+            'Could not unmark file as dirty; leaving dirty: ',
+            util.ConsoleBlue,
+            entry.path,
             util.ConsoleNormal
           )
           return
 
-    self.cn.execute(query, (nodetypes.NOT_DIRTY, stamp, entry.id))
+    query = "update nodes set dirty = ?, stamp = ?, size = ?, inode = ? where id = ?"
+    self.cn.execute(query, (nodetypes.NOT_DIRTY, stamp[0], stamp[1], stamp[2], entry.id))
     entry.dirty = nodetypes.NOT_DIRTY
     entry.stamp = stamp
 
+  def set_digest(self, entry, digest):
+    if entry.digest == digest:
+      return
+    query = "update nodes set digest = ? where id = ?"
+    self.cn.execute(query, (digest, entry.id))
+    entry.digest = digest
+
   def set_dirty_type(self, entry, dirtyType):
     if entry.dirty == dirtyType:
       return
@@ -691,8 +1020,14 @@ class Database(object):
 
   # Query all mkdir nodes.
   def query_mkdir(self, aggregate):
+    if self.bulk_loaded_:
+      for node in list(self.node_cache_.values()):
+        if node.type == nodetypes.Mkdir:
+          aggregate(node)
+      return
+
     query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
+      select id, type, stamp, dirty, path, folder, data, env_id, digest, size, inode
       from nodes
       where type == 'mkd'
     """
@@ -702,8 +1037,14 @@ class Database(object):
 
   # Intended to be called before any nodes are imported.
   def query_known_dirty(self, aggregate):
+    if self.bulk_loaded_:
+      for node in list(self.node_cache_.values()):
+        if node.dirty != nodetypes.NOT_DIRTY and node.type != nodetypes.Mkdir:
+          aggregate(node)
+      return
+
     query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
+      select id, type, stamp, dirty, path, folder, data, env_id, digest, size, inode
       from nodes
       where dirty <> {0}
       and type != 'mkd'
@@ -715,8 +1056,14 @@ class Database(object):
   # Query all nodes that are not dirty, but need to be checked. Intended to
   # be called after query_dirty, and returns a mutually exclusive list.
   def query_maybe_dirty(self, aggregate):
+    if self.bulk_loaded_:
+      for node in list(self.node_cache_.values()):
+        if node.dirty == nodetypes.NOT_DIRTY and node.type in [nodetypes.Source, nodetypes.Output, 'cpa']:
+          aggregate(node)
+      return
+
     query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
+      select id, type, stamp, dirty, path, folder, data, env_id, digest, size, inode
       from nodes
       where dirty = {0}
       and (type == 'src' or type == 'out' or type == 'cpa')
@@ -728,7 +1075,7 @@ class Database(object):
 
   def query_commands(self, aggregate):
     query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
+      select id, type, stamp, dirty, path, folder, data, env_id, digest, size, inode
       from nodes
       where (type != 'src' and
              type != 'out' and
@@ -765,6 +1112,10 @@ class Database(object):
 
   def drop_entry(self, entry):
     self.drop_links(entry)
+    self.cn.execute("delete from aliases where node_id = ?", (entry.id,))
+    self.cn.execute("delete from durations where node_id = ?", (entry.id,))
+    self.cn.execute("delete from command_log where node_id = ?", (entry.id,))
+    self.cn.execute("delete from command_memory where node_id = ?", (entry.id,))
 
     query = "delete from nodes where id = ?"
     self.cn.execute(query, (entry.id,))
@@ -827,6 +1178,84 @@ class Database(object):
     query = "insert or replace into reconfigure (path, stamp) values (?, ?)"
     self.cn.execute(query, (path, stamp))
 
+  def add_alias(self, name, entry):
+    query = "insert or ignore into aliases (name, node_id) values (?, ?)"
+    self.cn.execute(query, (name, entry.id))
+
+  # Returns the set of entries named by an alias; empty if there is no such
+  # alias.
+  def query_alias(self, name):
+    query = "select node_id from aliases where name = ?"
+    return set([self.query_node(id) for id, in self.cn.execute(query, (name,)).fetchall()])
+
+  def drop_aliases(self):
+    self.cn.execute("delete from aliases")
+
+  # Start a new entry in the build log, and forget the oldest builds. Returns
+  # the new build's id.
+  def start_build_log(self, start, workers):
+    query = "insert into builds (start, workers) values (?, ?)"
+    build_id = self.cn.execute(query, (start, workers)).lastrowid
+
+    oldest = build_id - BUILD_LOG_SIZE
+    self.cn.execute("delete from builds where id <= ?", (oldest,))
+    self.cn.execute("delete from command_log where build_id <= ?", (oldest,))
+    return build_id
+
+  def finish_build_log(self, build_id, end):
+    self.cn.execute("update builds set end = ? where id = ?", (end, build_id))
+
+  # |rows| is a list of (node_id, start, end, pid, status, stdout_bytes,
+  # stderr_bytes) tuples.
+  def log_commands(self, build_id, rows):
+    query = "insert into command_log values (?, ?, ?, ?, ?, ?, ?, ?)"
+    self.cn.executemany(query, [(build_id,) + row for row in rows])
+
+  # Returns (id, start, end, workers) for the most recent build that ran any
+  # commands, or None.
+  def query_last_build(self):
+    query = "select id, start, end, workers from builds order by id desc limit 1"
+    return self.cn.execute(query).fetchone()
+
+  # Returns a list of (node_id, start, end, pid, status, stdout_bytes,
+  # stderr_bytes) rows.
+  def query_command_log(self, build_id):
+    query = """
+      select node_id, start, end, pid, status, stdout_bytes, stderr_bytes
+      from command_log
+      where build_id = ?
+    """
+    return self.cn.execute(query, (build_id,)).fetchall()
+
+  # Returns a dictionary of node id -> seconds, for every command that has
+  # run before.
+  def query_durations(self):
+    query = "select node_id, seconds from durations"
+    return dict(self.cn.execute(query).fetchall())
+
+  # |durations| is a dictionary of node id -> seconds.
+  def set_durations(self, durations):
+    query = "insert or replace into durations (node_id, seconds) values (?, ?)"
+    self.cn.executemany(query, list(durations.items()))
+
+  # Returns a dictionary of node id -> (peak, reserve). Either may be None.
+  def query_command_memory(self):
+    query = "select node_id, peak, reserve from command_memory"
+    return {row[0]: row[1:] for row in self.cn.execute(query)}
+
+  def set_peak_memory(self, entry, peak):
+    self.cn.execute("insert or ignore into command_memory (node_id) values (?)", (entry.id,))
+    query = "update command_memory set peak = ? where node_id = ?"
+    self.cn.execute(query, (peak, entry.id))
+
+  def set_memory_reserve(self, entry, reserve):
+    self.cn.execute("insert or ignore into command_memory (node_id) values (?)", (entry.id,))
+    query = "update command_memory set reserve = ? where node_id = ?"
+    self.cn.execute(query, (reserve, entry.id))
+
+  def drop_memory_reserves(self):
+    self.cn.execute("update command_memory set reserve = null")
+
   def query_scripts(self, aggregate):
     query = "select rowid, path, stamp from reconfigure"
     for rowid, path, stamp in self.cn.execute(query):
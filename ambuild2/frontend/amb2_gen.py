@@ -62,6 +62,8 @@ class Generator(BaseGenerator):
         self.db.query_scripts(lambda id, path, stamp: self.old_scripts_.add(path))
         self.db.query_mkdir(lambda entry: self.old_folders_.add(entry))
         self.db.query_commands(lambda entry: self.old_commands_.add(entry))
+        self.db.drop_aliases()
+        self.db.drop_memory_reserves()
         self.db.set_var('api_version', str(self.cm.apiVersion))
 
     def cleanup(self):
@@ -595,7 +597,7 @@ class Generator(BaseGenerator):
             else:
                 inputs.append(item)
 
-    def addFileOp(self, cmd, context, source, output_path):
+    def addFileOp(self, cmd, context, source, output_path, mode = None):
         # Try to detect if our output_path is actually a folder, via trailing
         # slash or '.'/'' indicating the context folder.
         detected_folder = None
@@ -637,21 +639,27 @@ class Generator(BaseGenerator):
         else:
             source_path = source_entry.path
 
+        # Copies that don't choose a mode use the build's --copy-mode, so their
+        # data stays as it was before modes existed.
+        data = (source_path, output_path)
+        if mode is not None:
+            data += (mode,)
+
         # For clarity of spew, we always execute file operations in the root of
         # the build folder. This means that no matter what context we're in,
         # we can use absolute-ish folders and get away with it.
         return self.addCommand(context = context,
                                node_type = cmd,
                                folder = None,
-                               data = (source_path, output_path),
+                               data = data,
                                inputs = [source_entry],
                                outputs = [output_path])
 
     def addSource(self, context, source_path):
         return self.graph.addSource(source_path)
 
-    def addCopy(self, context, source, output_path):
-        return self.addFileOp(nodetypes.Copy, context, source, output_path)
+    def addCopy(self, context, source, output_path, mode = None):
+        return self.addFileOp(nodetypes.Copy, context, source, output_path, mode)
 
     def addSymlink(self, context, source, output_path):
         if util.IsWindows():
@@ -678,7 +686,8 @@ class Generator(BaseGenerator):
                         weak_inputs = None,
                         shared_outputs = None,
                         env_data = None,
-                        dep_file = None):
+                        dep_file = None,
+                        memory = None):
         if folder == -1:
             folder = context.localFolder
 
@@ -714,15 +723,22 @@ class Generator(BaseGenerator):
         if argv is None:
             raise Exception('argv cannot be None')
 
-        return self.addCommand(context = context,
-                               node_type = node_type,
-                               folder = folder,
-                               data = data,
-                               inputs = inputs,
-                               outputs = outputs,
-                               weak_inputs = weak_inputs,
-                               shared_outputs = shared_outputs,
-                               env_data = env_data)
+        cmd_entry, outputs = self.addCommand(context = context,
+                                             node_type = node_type,
+                                             folder = folder,
+                                             data = data,
+                                             inputs = inputs,
+                                             outputs = outputs,
+                                             weak_inputs = weak_inputs,
+                                             shared_outputs = shared_outputs,
+                                             env_data = env_data)
+
+        # The build script knows better than the last build how much memory
+        # this command needs (see TaskMaster).
+        if memory is not None:
+            self.db.set_memory_reserve(cmd_entry, int(memory * 1024 * 1024))
+
+        return cmd_entry, outputs
 
     def addOutputFile(self, context, path, contents):
         folder, filename = os.path.split(path)
@@ -751,6 +767,25 @@ class Generator(BaseGenerator):
         self.old_scripts_.discard(path)
         self.db.add_or_update_script(path)
 
+    # |outputs| may be an output entry, a list of them, or the result of
+    # building a C++ binary.
+    def addAlias(self, context, name, outputs):
+        if not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+
+        for output in outputs:
+            # CppNodes; the debug file is built by the same command.
+            output = getattr(output, 'binary', output)
+            if isinstance(output, (list, tuple)):
+                self.addAlias(context, name, output)
+                continue
+
+            if not isinstance(output, nodetypes.Entry) or output.type != nodetypes.Output:
+                util.con_err(util.ConsoleRed, 'Alias "', util.ConsoleBlue, name, util.ConsoleRed,
+                             '" must name output files.', util.ConsoleNormal)
+                raise Exception('Tried to alias a non-output node')
+            self.db.add_alias(name, output)
+
     # This whole interface is a gross hack. It should be moved into builders.py.
     def addCxxObjTask(self, cx, shared_outputs, obj):
         cxxData = {
@@ -28,7 +28,7 @@ class BaseGenerator(object):
     def addFolder(self, context, folder):
         raise Exception('Must be implemented!')
 
-    def addCopy(self, context, source, output_path):
+    def addCopy(self, context, source, output_path, mode = None):
         raise Exception('Must be implemented!')
 
     def addShellCommand(self,
@@ -40,12 +40,17 @@ class BaseGenerator(object):
                         dep_type = None,
                         weak_inputs = [],
                         shared_outputs = [],
-                        env_data = None):
+                        env_data = None,
+                        dep_file = None,
+                        memory = None):
         raise Exception('Must be implemented!')
 
     def addConfigureFile(self, context, path):
         raise Exception('Must be implemented!')
 
+    def addAlias(self, context, name, outputs):
+        raise Exception('Must be implemented!')
+
     # The following methods are only needed to implement v2.2 generators.
     def newProgramProject(self, context, name):
         raise NotImplementedError()
@@ -17,6 +17,7 @@
 import copy
 import os
 import sys
+from ambuild2 import util
 from ambuild2.frontend.cloneable import Cloneable
 from ambuild2.frontend.cloneable import CloneableDict
 from ambuild2.frontend.cloneable import CloneableList
@@ -187,8 +188,10 @@ class BuildContext(BaseContext):
     def AddFolder(self, folder):
         return self.generator_.addFolder(self, folder)
 
-    def AddCopy(self, source, output_path):
-        _, (entry,) = self.generator_.addCopy(self, source, output_path)
+    def AddCopy(self, source, output_path, mode = None):
+        if mode is not None and mode not in util.CopyModes:
+            raise Exception('Unknown copy mode: {0}'.format(mode))
+        _, (entry,) = self.generator_.addCopy(self, source, output_path, mode)
         return entry
 
     def AddCommand(self,
@@ -200,7 +203,8 @@ class BuildContext(BaseContext):
                    weak_inputs = [],
                    shared_outputs = [],
                    env_data = None,
-                   dep_file = None):
+                   dep_file = None,
+                   memory = None):
         _, entries = self.generator_.addShellCommand(self,
                                                      inputs,
                                                      argv,
@@ -210,7 +214,8 @@ class BuildContext(BaseContext):
                                                      weak_inputs = weak_inputs,
                                                      shared_outputs = shared_outputs,
                                                      env_data = env_data,
-                                                     dep_file = dep_file)
+                                                     dep_file = dep_file,
+                                                     memory = memory)
         return entries
 
     def Context(self, name):
@@ -242,6 +247,11 @@ class BuildContext(BaseContext):
     def AddOutputFile(self, path, contents):
         return self.generator_.addOutputFile(self, path, contents)
 
+    # Name a group of outputs, so "ambuild <objdir> <name>" only builds what
+    # they need.
+    def AddAlias(self, name, outputs):
+        return self.generator_.addAlias(self, name, outputs)
+
 # Access to everything.
 class TopLevelBuildContext(BuildContext):
     def __init__(self, cm, parent, vars, script, sourceFolder, buildFolder):
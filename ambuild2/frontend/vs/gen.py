@@ -95,6 +95,12 @@ class Generator(BaseGenerator):
     def addConfigureFile(self, cx, path):
         pass
 
+    # Overridden.
+    #
+    # Aliases only name targets for ambuild itself.
+    def addAlias(self, context, name, outputs):
+        pass
+
     def detectCompilers(self):
         raise Exception('Implement me!')
 
@@ -157,7 +163,7 @@ class Generator(BaseGenerator):
         return self.generateFolder(parentFolderNode, folder)
 
     # Overridden.
-    def addCopy(self, context, source, output_path):
+    def addCopy(self, context, source, output_path, mode = None):
         return (None, (None,))
 
     # Overridden.
@@ -0,0 +1,334 @@
+# vim: set ts=8 sts=4 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+import errno
+import os
+import struct
+import sys
+from ambuild2 import nodetypes
+from ambuild2 import util
+if sys.platform.startswith('linux'):
+    import ctypes
+    import ctypes.util
+
+# File system watchers report which paths changed since the last call to
+# changes(). They only promise to see changes to the immediate contents of
+# watched folders; anything they can't account for precisely (overflowed
+# queues, folders being created, removed or renamed) is reported as "unknown",
+# meaning the caller should fall back to checking everything.
+
+# A watcher that never knows what changed. Used where inotify is unavailable.
+class PollingWatcher(object):
+    def fileno(self):
+        return None
+
+    @property
+    def active(self):
+        return False
+
+    def watch(self, folder):
+        return True
+
+    def changes(self):
+        return None
+
+    def close(self):
+        pass
+
+# Constants from <sys/inotify.h>.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# Events that change the folder structure itself.
+UNKNOWN_MASK = IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF | IN_ISDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher(object):
+    def __init__(self, libc):
+        self.libc_ = libc
+        self.fd_ = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd_ < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.folders_ = {}
+        self.changed_ = set()
+        self.unknown_ = False
+        self.exhausted_ = False
+
+    def fileno(self):
+        return self.fd_
+
+    @property
+    def active(self):
+        return not self.exhausted_
+
+    # Returns False if the folder does not exist.
+    def watch(self, folder):
+        if self.exhausted_:
+            return True
+
+        wd = self.libc_.inotify_add_watch(self.fd_, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in [errno.ENOENT, errno.ENOTDIR]:
+                return False
+            # Usually ENOSPC, meaning we've hit fs.inotify.max_user_watches. We
+            # can't see everything anymore, so stop trusting events at all.
+            self.exhausted_ = True
+            return True
+
+        self.folders_[wd] = folder
+        return True
+
+    # Read any queued events. This should be called whenever fileno() is
+    # readable, so the kernel queue doesn't overflow.
+    def drain(self):
+        while True:
+            try:
+                buffer = os.read(self.fd_, 64 * 1024)
+            except OSError as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not buffer:
+                return
+
+            pos = 0
+            while pos < len(buffer):
+                wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buffer, pos)
+                pos += EVENT_HEADER.size
+                name = buffer[pos:pos + name_len].rstrip(b'\0')
+                pos += name_len
+
+                if mask & UNKNOWN_MASK:
+                    self.unknown_ = True
+                    if mask & IN_IGNORED:
+                        self.folders_.pop(wd, None)
+                    continue
+
+                folder = self.folders_.get(wd)
+                if folder is None:
+                    continue
+                self.changed_.add(os.path.join(folder, os.fsdecode(name)))
+
+    # Return the set of paths that changed since the last call, or None if
+    # that can't be known.
+    def changes(self):
+        self.drain()
+        if self.unknown_ or self.exhausted_:
+            changed = None
+        else:
+            changed = self.changed_
+        self.changed_ = set()
+        self.unknown_ = False
+        return changed
+
+    def close(self):
+        if self.fd_ >= 0:
+            os.close(self.fd_)
+            self.fd_ = -1
+
+def CreateWatcher():
+    if not sys.platform.startswith('linux'):
+        return PollingWatcher()
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return InotifyWatcher(libc)
+    except (OSError, AttributeError):
+        return PollingWatcher()
+
+# Tracks changes to the files in a build's graph, for processes that run more
+# than one build (see daemon.py and Context.Watch).
+class BuildWatcher(object):
+    def __init__(self, buildPath):
+        self.buildPath = buildPath
+        self.watcher_ = CreateWatcher()
+        self.full_scan_ = True
+        self.watched_ = set()
+        self.missing_ = set()
+        self.folder_entries_ = {}
+        self.num_nodes_ = 0
+        self.pending_ = set()
+        self.scripts_ = set()
+
+    def fileno(self):
+        return self.watcher_.fileno()
+
+    @property
+    def active(self):
+        return self.watcher_.active
+
+    # Forget everything we know; the next build checks every file.
+    def invalidate(self):
+        self.full_scan_ = True
+
+    # Returns the paths that changed since the last call, or None if that
+    # can't be known.
+    def drain(self):
+        changed = self.watcher_.changes()
+        if changed is None:
+            self.full_scan_ = True
+        else:
+            self.pending_ |= changed
+        return changed
+
+    def lookup(self, db, path):
+        entry = db.query_path(path)
+        if entry is None:
+            rel_path = util.RelPathIfCommon(path, self.buildPath)
+            if rel_path:
+                entry = db.query_path(rel_path)
+        return entry
+
+    # Returns True if any of |paths| is a source file or build script. Outputs
+    # are ignored, since a build writes those itself.
+    def hasSourceChanges(self, db, paths):
+        for path in paths:
+            if path in self.scripts_:
+                return True
+            entry = self.lookup(db, path)
+            if entry is not None and entry.type == nodetypes.Source:
+                return True
+        return False
+
+    @property
+    def pending(self):
+        return self.pending_
+
+    # Returns the entries to check for changes in the next build, or None to
+    # check everything.
+    def takeCandidates(self, db):
+        self.drain()
+
+        # Reparsing build scripts replaces the node caches.
+        if not db.bulk_loaded:
+            self.full_scan_ = True
+
+        if self.full_scan_:
+            candidates = None
+        else:
+            candidates = set()
+            for path in self.pending_:
+                entry = self.lookup(db, path)
+                if entry is not None:
+                    candidates.add(entry)
+
+            # Folders we couldn't watch before might exist now.
+            for folder in self.addWatches(list(self.missing_)):
+                candidates.update(self.folder_entries_[folder])
+            candidates = list(candidates)
+
+        self.full_scan_ = False
+        self.pending_ = set()
+        return candidates
+
+    # Called after a build that was given |candidates|.
+    def finishBuild(self, db, candidates):
+        # A source that changed while the build was running might have been
+        # recorded with its new timestamp. Make sure the next build sees it.
+        self.drain()
+        marked = False
+        for path in self.pending_:
+            entry = self.lookup(db, path)
+            if entry is None or entry.type != nodetypes.Source:
+                continue
+            if entry.dirty == nodetypes.NOT_DIRTY:
+                db.mark_dirty(entry)
+                marked = True
+        if marked:
+            db.commit()
+
+        if candidates is None:
+            self.sync(db, full_scan = True)
+        elif db.num_nodes != self.num_nodes_:
+            self.sync(db, full_scan = False)
+
+    # Watch every folder that contains a file or folder in the graph, as well
+    # as the build scripts.
+    def sync(self, db, full_scan):
+        folder_entries = {}
+        for entry in db.all_nodes():
+            if entry.type != nodetypes.Mkdir and not entry.isFile():
+                continue
+            folder = os.path.dirname(self.absPath(entry.path))
+            entries = folder_entries.get(folder)
+            if entries is None:
+                entries = []
+                folder_entries[folder] = entries
+            entries.append(entry)
+
+        scripts = set()
+        db.query_scripts(lambda row, path, stamp: scripts.add(self.absPath(path)))
+        for path in scripts:
+            folder = os.path.dirname(path)
+            if folder not in folder_entries:
+                folder_entries[folder] = []
+
+        self.scripts_ = scripts
+        self.folder_entries_ = folder_entries
+        self.num_nodes_ = db.num_nodes
+        self.missing_ = set()
+        new_folders = [folder for folder in folder_entries if folder not in self.watched_]
+        added = self.addWatches(new_folders)
+
+        # Files in a folder we just started watching could have changed before
+        # the watch existed.
+        if not full_scan:
+            for folder in added:
+                for entry in folder_entries[folder]:
+                    self.pending_.add(entry.path)
+
+    def absPath(self, path):
+        if os.path.isabs(path):
+            return path
+        return os.path.join(self.buildPath, path)
+
+    # Returns the folders that were successfully watched.
+    def addWatches(self, folders):
+        added = []
+        for folder in folders:
+            if self.watcher_.watch(folder):
+                self.watched_.add(folder)
+                self.missing_.discard(folder)
+                added.append(folder)
+            else:
+                self.missing_.add(folder)
+        return added
+
+    def close(self):
+        self.watcher_.close()
@@ -14,129 +14,280 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+from array import array
 from ambuild2 import nodetypes
 
-class GraphNode(object):
-    def __init__(self, entry):
-        self.entry = entry
-        self.incoming = set()
-        self.outgoing = set()
-        self.outputs = set()
-        self.is_command = entry.isCommand()
-
-    @property
-    def type(self):
-        return self.entry.type
-
-    def isCommand(self):
-        return self.is_command
-
+# The damage graph is stored in compressed sparse row (CSR) form. Every node
+# has a dense integer id, which indexes into |entries|. While the graph is
+# being built, edges are appended to two flat arrays. finish() then packs them
+# into per-node slices:
+#
+#   successors of node i:   out_edges[out_start[i]:out_start[i + 1]]
+#   predecessors of node i: in_edges[in_start[i]:in_start[i + 1]]
+#
+# Per-node flags, like whether a node is a command or whether a traversal has
+# visited it, are bytearrays indexed by node id. This keeps large graphs
+# compact and lets traversals run without hashing or allocating per node.
+#
+# By default, the graph only contains command nodes. File nodes are walked
+# while integrating, but are collapsed away: two commands are connected if
+# there is a path between them that only goes through files. Passing
+# commands_only=False keeps every node, which is only useful for debugging
+# (--show-damage).
+#
+# If |restrict| is a set of entries, edges leading outside of it are ignored,
+# so nothing else is ever added to the graph.
 class Graph(object):
-    def __init__(self, database):
+    def __init__(self, database, commands_only = True, restrict = None):
         self.db = database
-        self.node_map = {}
-        self.node_list = []
-        self.worklist = []
+        self.commands_only = commands_only
+        self.restrict = restrict
+        self.entries = []
+        self.is_command = bytearray()
         self.create = []
+        self.node_map_ = {}
+        self.edge_from_ = array('i')
+        self.edge_to_ = array('i')
+        self.out_start = None
+        self.out_edges = None
+        self.in_start = None
+        self.in_edges = None
+
+        if commands_only:
+            # Files we've walked through, and files that were added directly
+            # (i.e., dirty sources).
+            self.worklist_ = []
+            self.files_ = set()
+            self.root_files_ = []
+            self.from_root_file_ = None
+        else:
+            self.worklist_ = array('i')
 
     def importEntry(self, entry):
-        assert entry not in self.node_map
+        assert entry not in self.node_map_
 
-        graph_node = GraphNode(entry)
-        self.node_map[entry] = graph_node
-        self.node_list.append(graph_node)
-        self.worklist.append(graph_node)
-        return graph_node
+        node = len(self.entries)
+        self.entries.append(entry)
+        self.is_command.append(entry.isCommand())
+        self.node_map_[entry] = node
+        if self.commands_only:
+            self.worklist_.append(entry)
+        else:
+            self.worklist_.append(node)
+        return node
 
     def addEntry(self, entry):
-        if entry in self.node_map:
-            return self.node_map[entry]
-
+        node = self.node_map_.get(entry)
+        if node is not None:
+            return node
+        if self.commands_only and not entry.isCommand():
+            if self.visitFile(entry):
+                self.root_files_.append(entry)
+            return None
         return self.importEntry(entry)
 
-    def addEdge(self, from_node, to_node):
-        from_node.outgoing.add(to_node)
-        to_node.incoming.add(from_node)
+    # Queue a file node to be walked through. Returns False if it was already
+    # seen.
+    def visitFile(self, entry):
+        if entry in self.files_:
+            return False
+        self.files_.add(entry)
+        self.worklist_.append(entry)
+        return True
 
-    def addEdgeToEntry(self, from_node, to_entry):
-        if to_entry not in self.node_map:
-            to_node = self.importEntry(to_entry)
-        else:
-            to_node = self.node_map[to_entry]
-        self.addEdge(from_node, to_node)
+    def query_outgoing(self, entry):
+        outgoing = self.db.query_outgoing(entry)
+        if self.restrict is None:
+            return outgoing
+        return outgoing & self.restrict
+
+    def addEdge(self, from_node, to_node):
+        self.edge_from_.append(from_node)
+        self.edge_to_.append(to_node)
 
     def integrate(self):
-        while len(self.worklist):
-            node = self.worklist.pop()
+        if self.commands_only:
+            return self.integrate_commands()
+
+        worklist = self.worklist_
+        while len(worklist):
+            node = worklist.pop()
+
+            for child_entry in self.query_outgoing(self.entries[node]):
+                self.addEdge(node, self.addEntry(child_entry))
 
-            for child_entry in self.db.query_outgoing(node.entry):
-                self.addEdgeToEntry(node, child_entry)
+    # Discover every command reachable from the initial entries. This visits
+    # nodes in the same order as the full graph would, so commands get the same
+    # relative ids; edges are filled in afterward by link_commands().
+    def integrate_commands(self):
+        worklist = self.worklist_
+        node_map = self.node_map_
+        while len(worklist):
+            entry = worklist.pop()
+
+            for child_entry in self.query_outgoing(entry):
+                if child_entry in node_map:
+                    continue
+                if child_entry.isCommand():
+                    self.importEntry(child_entry)
+                else:
+                    self.visitFile(child_entry)
+
+    def link_commands(self):
+        for node in range(len(self.entries)):
+            for child_entry in self.query_outgoing(self.entries[node]):
+                self.link_through(node, child_entry)
+
+        # Commands that consume a dirty file directly are leaf commands, even if
+        # they also depend on other commands in the graph.
+        self.from_root_file_ = bytearray(len(self.entries))
+        for entry in self.root_files_:
+            for child_entry in self.query_outgoing(entry):
+                self.mark_from_root_file(child_entry)
+
+    # Connect |node| to every command reachable from |entry| through files.
+    def link_through(self, node, entry):
+        child = self.node_map_.get(entry)
+        if child is not None:
+            self.addEdge(node, child)
+            return
+        for child_entry in self.query_outgoing(entry):
+            self.link_through(node, child_entry)
+
+    def mark_from_root_file(self, entry):
+        node = self.node_map_.get(entry)
+        if node is not None:
+            self.from_root_file_[node] = 1
+            return
+        for child_entry in self.query_outgoing(entry):
+            self.mark_from_root_file(child_entry)
 
     def complete_ordering(self):
-        for node in self.node_list:
-            if not node.isCommand():
+        for node in range(len(self.entries)):
+            if not self.is_command[node]:
                 continue
 
-            for weak_input in self.db.query_weak_inputs(node.entry):
-                if weak_input not in self.node_map:
+            for weak_input in self.db.query_weak_inputs(self.entries[node]):
+                dep = self.node_map_.get(weak_input)
+                if dep is not None:
+                    self.addEdge(dep, node)
                     continue
-                dep = self.node_map[weak_input]
-                dep.outgoing.add(node)
-                node.incoming.add(dep)
-
-    # We should try to get rid of this algorithm; it's very expensive and not
-    # really needed if we just include non-command nodes in the compressed
-    # version of the graph.
-    def filter_commands(self):
-        worklist = [node for node in self.node_list if not node.isCommand()]
-        for node in worklist:
-            for output in node.outgoing:
-                output.incoming.remove(node)
-                output_delta = node.incoming - output.incoming
-                output.incoming |= output_delta
-                for x in output_delta:
-                    x.outgoing.add(output)
-
-            for input in node.incoming:
-                input.outgoing.remove(node)
-                input_delta = node.outgoing - input.outgoing
-                input.outgoing |= input_delta
-                for x in input_delta:
-                    x.incoming.add(input)
-
-        self.node_list = [node for node in self.node_list if node.isCommand()]
+
+                # Outputs are collapsed away, so order against the command that
+                # generates them instead.
+                if self.commands_only and weak_input in self.files_:
+                    for producer in self.db.query_strong_inputs(weak_input):
+                        dep = self.node_map_.get(producer)
+                        if dep is not None:
+                            self.addEdge(dep, node)
 
     def finish(self):
         self.integrate()
+        if self.commands_only:
+            self.link_commands()
         self.complete_ordering()
-        self.node_map = None
+        self.node_map_ = None
+        if self.commands_only:
+            self.files_ = None
+            self.root_files_ = None
+
+        num_nodes = len(self.entries)
+        self.out_start, self.out_edges = BuildAdjacency(num_nodes, self.edge_from_, self.edge_to_)
+        self.in_start, self.in_edges = BuildAdjacency(num_nodes, self.edge_to_, self.edge_from_)
+        self.edge_from_ = None
+        self.edge_to_ = None
+
+    def outgoing(self, node):
+        return self.out_edges[self.out_start[node]:self.out_start[node + 1]]
+
+    def incoming(self, node):
+        return self.in_edges[self.in_start[node]:self.in_start[node + 1]]
 
     @property
     def leafs(self):
-        return [node for node in self.node_list if not len(node.incoming)]
-
-    def for_each_child_of(self, node, callback):
-        for outgoing in node.outgoing:
-            if outgoing.isCommand():
-                callback(outgoing.entry)
-            else:
-                self.for_each_child_of(outgoing, callback)
+        in_start = self.in_start
+        return [node for node in range(len(self.entries)) if in_start[node] == in_start[node + 1]]
 
+    # Invoke |callback| on every command entry that is either a root of the
+    # graph, or is reachable from a root only through file nodes.
     def for_each_leaf_command(self, callback):
+        if self.commands_only:
+            in_start = self.in_start
+            from_root_file = self.from_root_file_
+            for node in range(len(self.entries)):
+                if from_root_file[node] or in_start[node] == in_start[node + 1]:
+                    callback(self.entries[node])
+            return
+
+        out_start = self.out_start
+        out_edges = self.out_edges
+        is_command = self.is_command
+        visited = bytearray(len(self.entries))
+        stack = array('i')
+
         for node in self.leafs:
-            if node.isCommand():
-                callback(node.entry)
-            else:
-                self.for_each_child_of(node, callback)
+            if is_command[node]:
+                callback(self.entries[node])
+                continue
+
+            stack.append(node)
+            while len(stack):
+                current = stack.pop()
+                for i in range(out_start[current], out_start[current + 1]):
+                    child = out_edges[i]
+                    if visited[child]:
+                        continue
+                    visited[child] = 1
+                    if is_command[child]:
+                        callback(self.entries[child])
+                    else:
+                        stack.append(child)
 
     def printGraph(self):
         for entry in self.create:
             print(' : ' + entry.format())
 
         def printNode(node, indent):
-            print((' ' * indent) + ' - ' + node.entry.format())
-            for incoming in node.incoming:
+            print((' ' * indent) + ' - ' + self.entries[node].format())
+            for incoming in self.incoming(node):
                 printNode(incoming, indent + 1)
 
-        for node in [node for node in self.node_list if not len(node.incoming)]:
+        for node in self.leafs:
             printNode(node, 0)
+
+# Pack a list of (sources[i], targets[i]) edges into CSR form, dropping
+# duplicate edges. Returns (start, edges) arrays, where the neighbors of node
+# n are edges[start[n]:start[n + 1]], in the order they were added.
+def BuildAdjacency(num_nodes, sources, targets):
+    start = array('i', [0]) * (num_nodes + 1)
+    for source in sources:
+        start[source + 1] += 1
+    for node in range(num_nodes):
+        start[node + 1] += start[node]
+
+    cursor = array('i', start)
+    edges = array('i', [0]) * len(sources)
+    for i in range(len(sources)):
+        source = sources[i]
+        edges[cursor[source]] = targets[i]
+        cursor[source] += 1
+
+    # Compact each row in place, skipping targets we've already seen for it.
+    seen = array('i', [-1]) * num_nodes
+    write = 0
+    begin = 0
+    for node in range(num_nodes):
+        end = start[node + 1]
+        start[node] = write
+        for i in range(begin, end):
+            target = edges[i]
+            if seen[target] == node:
+                continue
+            seen[target] = node
+            edges[write] = target
+            write += 1
+        begin = end
+    start[num_nodes] = write
+    del edges[write:]
+
+    return start, edges
@@ -0,0 +1,189 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+import unittest
+from ambuild2 import nodetypes
+from ambuild2.damage import ComputeClosure
+from ambuild2.graph import BuildAdjacency, Graph
+
+# Minimal stand-in for Database, answering edge queries from Entry fields.
+class FakeDatabase(object):
+    def __init__(self):
+        self.next_id = 1
+
+    def add(self, type, name):
+        entry = nodetypes.Entry(self.next_id, type, name, None, None, 0, nodetypes.NOT_DIRTY)
+        entry.outgoing = set()
+        entry.strong_inputs = set()
+        entry.weak_inputs = set()
+        self.next_id += 1
+        return entry
+
+    def link(self, from_entry, to_entry):
+        from_entry.outgoing.add(to_entry)
+        to_entry.strong_inputs.add(from_entry)
+
+    def query_outgoing(self, entry):
+        return entry.outgoing
+
+    def query_strong_inputs(self, entry):
+        return entry.strong_inputs
+
+    def query_dynamic_inputs(self, entry):
+        return set()
+
+    def query_weak_inputs(self, entry):
+        return entry.weak_inputs
+
+class BuildAdjacencyTests(unittest.TestCase):
+    def runTest(self):
+        start, edges = BuildAdjacency(4, [2, 0, 2, 0, 2], [3, 1, 1, 1, 3])
+        self.assertEqual(list(start), [0, 1, 1, 3, 3])
+        self.assertEqual(list(edges), [1, 3, 1])
+
+# a.cpp -> cc -> a.o -> link -> prog
+#                       link <- b.o <- cc2 <- b.cpp
+#          gen -> gen.h ~~> cc2 (weak)
+def CreateSmallGraph(db):
+    a_cpp = db.add(nodetypes.Source, 'a.cpp')
+    b_cpp = db.add(nodetypes.Source, 'b.cpp')
+    cc = db.add(nodetypes.Cxx, 'cc')
+    cc2 = db.add(nodetypes.Cxx, 'cc2')
+    a_o = db.add(nodetypes.Output, 'a.o')
+    b_o = db.add(nodetypes.Output, 'b.o')
+    link = db.add(nodetypes.Command, 'link')
+    prog = db.add(nodetypes.Output, 'prog')
+    gen = db.add(nodetypes.Command, 'gen')
+    gen_h = db.add(nodetypes.Output, 'gen.h')
+    db.link(a_cpp, cc)
+    db.link(cc, a_o)
+    db.link(a_o, link)
+    db.link(b_cpp, cc2)
+    db.link(cc2, b_o)
+    db.link(b_o, link)
+    db.link(link, prog)
+    db.link(gen, gen_h)
+    cc2.weak_inputs.add(gen_h)
+    return a_cpp, b_cpp, cc, cc2, link, gen
+
+class FullGraphTests(unittest.TestCase):
+    def runTest(self):
+        db = FakeDatabase()
+        a_cpp, b_cpp, cc, cc2, link, gen = CreateSmallGraph(db)
+
+        graph = Graph(db, commands_only = False)
+        graph.addEntry(a_cpp)
+        graph.addEntry(gen)
+        graph.addEntry(b_cpp)
+        graph.finish()
+
+        self.assertEqual(len(graph.entries), 10)
+
+        leafs = set(graph.entries[node] for node in graph.leafs)
+        self.assertEqual(leafs, set([a_cpp, b_cpp, gen]))
+
+        leaf_commands = []
+        graph.for_each_leaf_command(lambda entry: leaf_commands.append(entry))
+        self.assertEqual(sorted(leaf_commands, key = lambda e: e.id), [cc, cc2, gen])
+
+class CommandGraphTests(unittest.TestCase):
+    def runTest(self):
+        db = FakeDatabase()
+        a_cpp, b_cpp, cc, cc2, link, gen = CreateSmallGraph(db)
+
+        graph = Graph(db)
+        graph.addEntry(a_cpp)
+        graph.addEntry(gen)
+        graph.addEntry(b_cpp)
+        graph.finish()
+
+        self.assertEqual(set(graph.entries), set([cc, cc2, link, gen]))
+        self.assertTrue(all(graph.is_command))
+
+        def edges_of(entry):
+            node = graph.entries.index(entry)
+            return set(graph.entries[child] for child in graph.outgoing(node))
+
+        self.assertEqual(edges_of(cc), set([link]))
+        self.assertEqual(edges_of(cc2), set([link]))
+        self.assertEqual(edges_of(gen), set([cc2]))
+        self.assertEqual(edges_of(link), set())
+
+        leafs = set(graph.entries[node] for node in graph.leafs)
+        self.assertEqual(leafs, set([cc, gen]))
+
+        # cc2 is not a graph root, but it consumes a dirty source, so it still
+        # counts as a leaf command.
+        leaf_commands = []
+        graph.for_each_leaf_command(lambda entry: leaf_commands.append(entry))
+        self.assertEqual(sorted(leaf_commands, key = lambda e: e.id), [cc, cc2, gen])
+
+class RestrictedGraphTests(unittest.TestCase):
+    def runTest(self):
+        db = FakeDatabase()
+        a_cpp, b_cpp, cc, cc2, link, gen = CreateSmallGraph(db)
+        b_o, = cc2.outgoing
+
+        closure = ComputeClosure(db, [b_o])
+        self.assertEqual(closure, set([b_o, cc2, b_cpp, gen]) | gen.outgoing)
+
+        graph = Graph(db, restrict = closure)
+        for entry in [a_cpp, b_cpp, gen]:
+            if entry in closure:
+                graph.addEntry(entry)
+        graph.finish()
+
+        self.assertEqual(set(graph.entries), set([cc2, gen]))
+        self.assertEqual(set(graph.entries[node] for node in graph.leafs), set([gen]))
+
+# Counts every edge the graph asks the database for, to measure how much of
+# the graph was walked.
+class CountingDatabase(FakeDatabase):
+    def __init__(self):
+        super(CountingDatabase, self).__init__()
+        self.visits = 0
+
+    def count(self, edges):
+        self.visits += len(edges)
+        return edges
+
+    def query_outgoing(self, entry):
+        return self.count(super(CountingDatabase, self).query_outgoing(entry))
+
+    def query_strong_inputs(self, entry):
+        return self.count(super(CountingDatabase, self).query_strong_inputs(entry))
+
+    def query_weak_inputs(self, entry):
+        return self.count(super(CountingDatabase, self).query_weak_inputs(entry))
+
+# Many translation units sharing one dirty header, all linked together. Every
+# compile command is reachable from the header, so collapsing file nodes must
+# stay linear in the number of edges.
+class SharedHeaderScalingTests(unittest.TestCase):
+    def build(self, num_tus):
+        db = CountingDatabase()
+        header = db.add(nodetypes.Source, 'common.h')
+        link = db.add(nodetypes.Command, 'link')
+        db.link(link, db.add(nodetypes.Output, 'prog'))
+        for i in range(num_tus):
+            cc = db.add(nodetypes.Cxx, 'cc{}'.format(i))
+            obj = db.add(nodetypes.Output, 'tu{}.o'.format(i))
+            db.link(header, cc)
+            db.link(cc, obj)
+            db.link(obj, link)
+
+        graph = Graph(db)
+        graph.addEntry(header)
+        graph.finish()
+
+        self.assertEqual(len(graph.entries), num_tus + 1)
+        self.assertEqual(len(graph.out_edges), num_tus)
+        self.assertEqual(len(graph.leafs), num_tus)
+        return db.visits + len(graph.out_edges)
+
+    def runTest(self):
+        small = self.build(1000)
+        large = self.build(10000)
+
+        # The work is a fixed amount per TU, plus a little for the header and
+        # the link, so ten times the TUs can't take more than ten times the
+        # work. A quadratic walk would be closer to 100 times.
+        self.assertLessEqual(large, small * 10)
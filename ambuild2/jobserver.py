@@ -0,0 +1,189 @@
+# vim: set ts=8 sts=4 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+import errno
+import os
+import re
+import shlex
+from ambuild2 import util
+
+# Support for the GNU make jobserver protocol. Every process sharing a
+# jobserver may run one job for free; each additional job needs a token, which
+# is a byte read from a pipe or fifo and written back when the job is done.
+#
+# If ambuild is run from make (with MAKEFLAGS containing --jobserver-auth),
+# it takes tokens from make's jobserver. Otherwise it creates its own, so
+# commands that run make, cargo, or anything else that understands MAKEFLAGS
+# share ambuild's job slots instead of assuming they own every core.
+
+# Returns ('fifo', path), ('pipe', read_fd, write_fd), or None.
+def ParseMakeflags(makeflags):
+    auth = None
+    for arg in shlex.split(makeflags):
+        for prefix in ['--jobserver-auth=', '--jobserver-fds=']:
+            if arg.startswith(prefix):
+                auth = arg[len(prefix):]
+
+    if auth is None:
+        return None
+    if auth.startswith('fifo:'):
+        return ('fifo', auth[len('fifo:'):])
+
+    try:
+        read_fd, write_fd = [int(fd) for fd in auth.split(',')]
+    except ValueError:
+        return None
+    if read_fd < 0 or write_fd < 0:
+        # make uses negative fds to say the jobserver is disabled.
+        return None
+    return ('pipe', read_fd, write_fd)
+
+# Adds |flags| (a job count and jobserver, from WorkerJobserver) to an existing
+# MAKEFLAGS value, keeping anything else the user or a tools environment set
+# (like "s" or "V=1"). Any job count or jobserver already there is replaced.
+def MergeMakeflags(makeflags, flags):
+    # Variable assignments come after a "--".
+    match = re.search(r'(^|\s)--(\s|$)', makeflags)
+    if match is None:
+        options, assignments = makeflags, ''
+    else:
+        options, assignments = makeflags[:match.start()], makeflags[match.start():]
+
+    options = re.sub(r'(^|\s)(-j\d*|--jobs(=\S*)?|--jobserver-(auth|fds)=\S*)(?=\s|$)', '', options)
+    return options.rstrip() + flags + assignments
+
+class Jobserver(object):
+    def __init__(self, read_fd, write_fd, worker_config, path = None):
+        self.read_fd_ = read_fd
+        self.write_fd_ = write_fd
+        self.path_ = path
+        self.tokens_ = []
+
+        # Tells each TaskWorker how to pass the jobserver to its commands
+        # (see WorkerJobserver).
+        self.worker_config = worker_config
+
+    @property
+    def num_tokens(self):
+        return len(self.tokens_)
+
+    # Returns True if a token was taken.
+    def acquire(self):
+        try:
+            token = os.read(self.read_fd_, 1)
+        except OSError as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]:
+                return False
+            raise
+        if not token:
+            return False
+        self.tokens_.append(token)
+        return True
+
+    def release(self):
+        os.write(self.write_fd_, self.tokens_.pop())
+
+    def release_all(self):
+        while len(self.tokens_):
+            self.release()
+
+    def close(self):
+        self.release_all()
+        os.close(self.read_fd_)
+        if self.write_fd_ != self.read_fd_:
+            os.close(self.write_fd_)
+        if self.path_ is not None:
+            try:
+                os.unlink(self.path_)
+            except OSError:
+                pass
+
+# Join the jobserver in MAKEFLAGS if there is one, otherwise create a new one
+# in |folder| with slots for |num_jobs| jobs. Returns None if neither works.
+def Open(folder, num_jobs):
+    if not hasattr(os, 'mkfifo'):
+        return None
+
+    auth = ParseMakeflags(os.environ.get('MAKEFLAGS', ''))
+    if auth is None:
+        return CreateServer(folder, num_jobs)
+
+    try:
+        if auth[0] == 'fifo':
+            fd = os.open(auth[1], os.O_RDWR | os.O_NONBLOCK)
+            return Jobserver(fd, fd, {})
+
+        # The pipe is shared with make and everything else it runs, so it
+        # can't be made non-blocking. Open a private copy of the read end
+        # instead.
+        _, read_fd, write_fd = auth
+        os.fstat(write_fd)
+        private_fd = os.open('/proc/self/fd/{}'.format(read_fd), os.O_RDONLY | os.O_NONBLOCK)
+        return Jobserver(private_fd, write_fd, {'fds': (read_fd, write_fd)})
+    except OSError as e:
+        util.con_err(util.ConsoleRed, 'Warning: could not join the make jobserver ({}); '.format(e),
+                     'ignoring it. If ambuild is run from a makefile, add "+" to the rule.',
+                     util.ConsoleNormal)
+        return None
+
+def CreateServer(folder, num_jobs):
+    path = os.path.join(folder, 'jobserver.{}'.format(os.getpid()))
+    try:
+        os.mkfifo(path, 0o600)
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        return None
+
+    # Our own first job doesn't need a token. The fifo is non-blocking, so
+    # writes can be short; if it fills up, we make do with fewer jobs.
+    num_tokens = 0
+    try:
+        while num_tokens < num_jobs - 1:
+            num_tokens += os.write(fd, b'+' * (num_jobs - 1 - num_tokens))
+    except OSError as e:
+        if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+            os.close(fd)
+            os.unlink(path)
+            return None
+
+    config = {
+        'fifo': path,
+        'jobs': num_tokens + 1,
+    }
+    return Jobserver(fd, fd, config, path = path)
+
+# The jobserver as seen by a TaskWorker. Returns (makeflags, fds): if
+# |makeflags| is not None, commands should get it as MAKEFLAGS, and |fds| must
+# stay open in them.
+def WorkerJobserver(config):
+    if 'fifo' in config:
+        # Older versions of make (before 4.4) don't understand fifo:PATH, so
+        # hand out plain descriptors instead. These are blocking, unlike the
+        # master's.
+        fd = os.open(config['fifo'], os.O_RDWR)
+        makeflags = ' -j{0} --jobserver-auth={1},{1}'.format(config['jobs'], fd)
+        return makeflags, (fd,)
+
+    if 'fds' in config:
+        # make's descriptors are only here if we were forked from the master.
+        try:
+            for fd in config['fds']:
+                os.fstat(fd)
+        except OSError:
+            return None, ()
+        return None, config['fds']
+
+    return None, ()
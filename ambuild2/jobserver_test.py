@@ -0,0 +1,22 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+import unittest
+from ambuild2.jobserver import MergeMakeflags, ParseMakeflags
+
+class ParseMakeflagsTests(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(ParseMakeflags(' -j8 --jobserver-auth=fifo:/tmp/GMfifo123'),
+                         ('fifo', '/tmp/GMfifo123'))
+        self.assertEqual(ParseMakeflags('s -j8 --jobserver-auth=3,4'), ('pipe', 3, 4))
+        self.assertEqual(ParseMakeflags(' -j --jobserver-fds=5,6 -- V=1'), ('pipe', 5, 6))
+        self.assertIsNone(ParseMakeflags(' -j8 --jobserver-auth=-2,-2'))
+        self.assertIsNone(ParseMakeflags('s -- V=1'))
+        self.assertIsNone(ParseMakeflags(''))
+
+class MergeMakeflagsTests(unittest.TestCase):
+    def runTest(self):
+        flags = ' -j4 --jobserver-auth=7,7'
+        self.assertEqual(MergeMakeflags('', flags), flags)
+        self.assertEqual(MergeMakeflags('s', flags), 's' + flags)
+        self.assertEqual(MergeMakeflags(' -- V=1', flags), flags + ' -- V=1')
+        self.assertEqual(MergeMakeflags('ks -j2 --jobserver-auth=-2,-2 -- V=1 CC=gcc', flags),
+                         'ks' + flags + ' -- V=1 CC=gcc')
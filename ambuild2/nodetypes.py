@@ -89,7 +89,7 @@ ALWAYS_DIRTY = 2
 
 # The basic properties of a node as it exists in the database.
 class Entry(object):
-    def __init__(self, id, type, path, blob, folder, stamp, dirty):
+    def __init__(self, id, type, path, blob, folder, stamp, dirty, digest = None):
         # Unique node ID (integer)
         self.id = id
 
@@ -115,12 +115,20 @@ class Entry(object):
         # working directory.
         self.folder = folder
 
-        # Last modification time.
+        # For files, an (mtime_ns, size, inode) tuple as of the last time the
+        # file was built or checked (see util.FileStamp).
         self.stamp = stamp
 
         # See the DIRTY values above.
         self.dirty = dirty
 
+        # For files, a digest of the contents, or None if unknown. Outputs
+        # record it each time they're generated, so commands using them can
+        # be skipped if it didn't change (see builder.py). Sources only keep
+        # it with --content-hash, so a source whose stamp changed only counts
+        # as dirty if its contents changed too (see damage.py).
+        self.digest = digest
+
         # If not None, a ToolsEnv that has environment information for running
         # commands.
         self.tools_env = None
@@ -88,60 +88,101 @@ class ProcessHost(object):
         self.proc = None
         self.channel = None
 
-    def spawn(self, target, args):
-        parent_send, child_recv = mp.Pipe()
-        parent_recv, child_send = mp.Pipe()
+    # |context| is a multiprocessing context, which decides how the process is
+    # started.
+    def spawn(self, target, args, context = mp):
+        parent_send, child_recv = context.Pipe()
+        parent_recv, child_send = context.Pipe()
 
         self.channel = Channel(parent_send, parent_recv)
         child_channel = Channel(child_send, child_recv)
 
         full_args = (target, child_channel) + args
-        self.proc = mp.Process(target = child_main, args = full_args)
+        self.proc = context.Process(target = child_main, args = full_args)
         self.proc.start()
 
     @property
     def pid(self):
         return self.proc.pid
 
+# Modules loaded into the forkserver, so children started from it don't have
+# to import them again.
+FORKSERVER_PRELOAD = ['ambuild2.task']
+
 class ProcessManager(object):
     def __init__(self):
         self.tasks_ = mp.Queue()
         self.children_ = []
 
-    def spawn(self, target, args):
+    # With |forkserver|, the child is forked from a template process that has
+    # FORKSERVER_PRELOAD imported, rather than from this one. The child then
+    # doesn't inherit this process's memory (such as the whole build graph),
+    # threads, or file descriptors. This falls back to the default if the
+    # platform has no forkserver.
+    def spawn(self, target, args, forkserver = False):
+        context = mp
+        if forkserver and 'forkserver' in mp.get_all_start_methods():
+            context = mp.get_context('forkserver')
+            context.set_forkserver_preload(FORKSERVER_PRELOAD)
+
         child = ProcessHost()
-        child.spawn(target, args)
+        child.spawn(target, args, context)
         self.children_.append(child)
         return child
 
     def shutdown(self):
         self.close_all_children()
 
+    # Ask a single child to exit, and wait for it.
+    def stop(self, child):
+        self.children_.remove(child)
+        self.send_stop(child)
+        child.proc.join()
+
+    def send_stop(self, child):
+        try:
+            child.channel.send({
+                'id': 'stop',
+            })
+            child.channel.close()
+        except:
+            pass
+
     def close_all_children(self):
         for child in self.children_:
-            try:
-                child.channel.send({
-                    'id': 'stop',
-                })
-                child.channel.close()
-            except:
-                pass
+            self.send_stop(child)
 
         for child in self.children_:
             child.proc.join()
         self.children_ = []
 
+# poll() returns a (process, message) pair, or (None, None) if |timeout| seconds
+# pass first. If |interrupt| is given, it is an object with a fileno(), and
+# poll() returns (None, interrupt) when that becomes readable. This is not
+# supported on Windows.
+#
+# Processes can be added and removed while the poller is in use. A process
+# must be removed before it is stopped.
 class ChannelPollerBase(object):
-    def __init__(self, cx, procs):
+    def __init__(self, cx, procs, interrupt = None):
         self.cx_ = cx
         self.procs_ = procs[:]
+        self.interrupt_ = interrupt
+
+    def add(self, proc):
+        self.procs_.append(proc)
+        self.watch(proc)
+
+    def remove(self, proc):
+        self.procs_.remove(proc)
+        self.unwatch(proc)
 
 # If available, use native Python 3.3+ support for multiplexing.
 if hasattr(mp, 'connection') and hasattr(mp.connection, 'wait'):
 
     class ChannelPoller(ChannelPollerBase):
-        def __init__(self, cx, procs):
-            super(ChannelPoller, self).__init__(cx, procs)
+        def __init__(self, cx, procs, interrupt = None):
+            super(ChannelPoller, self).__init__(cx, procs, interrupt)
             self.map_ = {}
             self.pipes_ = None
 
@@ -149,12 +190,27 @@ if hasattr(mp, 'connection') and hasattr(mp.connection, 'wait'):
             for proc in self.procs_:
                 self.map_[proc.channel.poll_pipe] = proc
             self.pipes_ = [proc.channel.poll_pipe for proc in self.procs_]
+            if self.interrupt_ is not None:
+                self.pipes_.append(self.interrupt_.fileno())
             return self
 
-        def poll(self):
-            ready = mp.connection.wait(self.pipes_)
-            proc = self.map_[ready[0]]
-            return proc, proc.channel.recv()
+        def watch(self, proc):
+            self.map_[proc.channel.poll_pipe] = proc
+            self.pipes_.append(proc.channel.poll_pipe)
+
+        def unwatch(self, proc):
+            del self.map_[proc.channel.poll_pipe]
+            self.pipes_.remove(proc.channel.poll_pipe)
+
+        def poll(self, timeout = None):
+            ready = mp.connection.wait(self.pipes_, timeout)
+            for obj in ready:
+                proc = self.map_.get(obj)
+                if proc is not None:
+                    return proc, proc.channel.recv()
+            if ready:
+                return None, self.interrupt_
+            return None, None
 
         def __exit__(self, type, value, traceback):
             pass
@@ -175,13 +231,14 @@ elif platform.system() == 'Windows':
             poller.on_receive(proc, None)
 
     class ChannelPoller(ChannelPollerBase):
-        def __init__(self, cx, procs):
-            super(ChannelPoller, self).__init__(cx, procs)
+        def __init__(self, cx, procs, interrupt = None):
+            super(ChannelPoller, self).__init__(cx, procs, interrupt)
             self.closing_ = False
             self.threads_ = []
             self.lock_ = threading.RLock()
             self.cv_ = threading.Condition(self.lock_)
             self.queue_ = collections.deque()
+            self.removed_ = set()
 
         def __enter__(self):
             for proc in self.procs_:
@@ -193,10 +250,27 @@ elif platform.system() == 'Windows':
                 thread.start()
             return self
 
-        def poll(self):
+        def watch(self, proc):
+            thread = threading.Thread(target = wait_on_pipe,
+                                      name = "Pipe Waiter",
+                                      args = (self, proc))
+            self.threads_.append(thread)
+            thread.start()
+
+        # The thread exits once the process closes its pipe; anything it
+        # receives until then is ignored.
+        def unwatch(self, proc):
+            with self.cv_:
+                self.removed_.add(proc)
+                self.queue_ = collections.deque([
+                    (other, obj) for other, obj in self.queue_ if other is not proc
+                ])
+
+        def poll(self, timeout = None):
             with self.cv_:
                 while len(self.queue_) == 0:
-                    self.cv_.wait()
+                    if not self.cv_.wait(timeout):
+                        return None, None
                     continue
                 proc, obj = self.queue_.popleft()
 
@@ -207,7 +281,7 @@ elif platform.system() == 'Windows':
 
         def on_receive(self, proc, obj):
             with self.cv_:
-                if not self.closing_:
+                if not self.closing_ and proc not in self.removed_:
                     self.queue_.append((proc, obj))
                     self.cv_.notify_all()
 
@@ -229,8 +303,8 @@ elif platform.system() == 'Windows':
 else:
 
     class ChannelPoller(ChannelPollerBase):
-        def __init__(self, cx, procs):
-            super(ChannelPoller, self).__init__(cx, procs)
+        def __init__(self, cx, procs, interrupt = None):
+            super(ChannelPoller, self).__init__(cx, procs, interrupt)
             self.map_ = {}
             self.rdlist_ = []
 
@@ -238,15 +312,29 @@ else:
             for proc in self.procs_:
                 self.map_[proc.channel.poll_handle] = proc
                 self.rdlist_ = [key for key in self.map_]
+            if self.interrupt_ is not None:
+                self.rdlist_.append(self.interrupt_.fileno())
             return self
 
-        def poll(self):
+        def watch(self, proc):
+            self.map_[proc.channel.poll_handle] = proc
+            self.rdlist_.append(proc.channel.poll_handle)
+
+        def unwatch(self, proc):
+            del self.map_[proc.channel.poll_handle]
+            self.rdlist_.remove(proc.channel.poll_handle)
+
+        def poll(self, timeout = None):
             while True:
                 try:
-                    ready, _, _ = select.select(self.rdlist_, [], [])
+                    ready, _, _ = select.select(self.rdlist_, [], [], timeout)
+                    for fd in ready:
+                        proc = self.map_.get(fd)
+                        if proc is not None:
+                            return proc, proc.channel.recv()
                     if ready:
-                        proc = self.map_[ready[0]]
-                        return proc, proc.channel.recv()
+                        return None, self.interrupt_
+                    return None, None
                 except select.error as e:
                     if e.args[0] == errno.EINTR:
                         continue
@@ -17,11 +17,11 @@
 from __future__ import print_function
 import os, sys
 from optparse import OptionParser
-from ambuild2 import util
+from ambuild2 import daemon, util
 from ambuild2.context import Context
 
-DEFAULT_API = '2.2.4'
-CURRENT_API = '2.2.4'
+DEFAULT_API = '2.2.5'
+CURRENT_API = '2.2.5'
 
 SampleScript = """# vim: set sts=4 ts=8 sw=4 tw=99 et ft=python:
 builder.cxx = builder.DetectCxx()
@@ -56,7 +56,7 @@ builder.Configure()
 """.format(DEFAULT_API = DEFAULT_API)
 
 def BuildOptions():
-    parser = OptionParser("usage: %prog [options] [path]")
+    parser = OptionParser("usage: %prog [options] [path [targets...]]")
     parser.add_option("--no-color",
                       dest = "no_color",
                       action = "store_true",
@@ -87,6 +87,28 @@ def BuildOptions():
                       action = "store_true",
                       default = False,
                       help = "Show the computed build steps and then exit.")
+    parser.add_option(
+        "--memory-budget",
+        dest = "memory_budget",
+        type = "int",
+        default = None,
+        metavar = "MB",
+        help = "Don't start a job if the commands already running are expected to use more "
+        "than this much memory in total, unless no other jobs are running. The default is "
+        "the memory available when the build starts.")
+    parser.add_option("--stats",
+                      dest = "stats",
+                      action = "store_true",
+                      default = False,
+                      help = "Show the slowest commands and other timings from the last build, "
+                      "then exit.")
+    parser.add_option("--trace",
+                      dest = "trace",
+                      type = "string",
+                      default = None,
+                      metavar = "FILE",
+                      help = "Write a Chrome trace (for chrome://tracing or Perfetto) of the build "
+                      "to FILE.")
     parser.add_option(
         "-j",
         "--jobs",
@@ -94,11 +116,72 @@ def BuildOptions():
         type = "int",
         default = 0,
         help = "Number of worker processes. Minimum number is 1; default is #cores * 1.25.")
+    parser.add_option(
+        "-k",
+        "--keep-going",
+        dest = "keep_going",
+        type = "int",
+        default = 1,
+        metavar = "N",
+        help = "Keep going until N commands fail (0 means no limit). Commands that depend on "
+        "a failed command are skipped.")
+    parser.add_option(
+        "-l",
+        "--max-load",
+        dest = "max_load",
+        type = "float",
+        default = None,
+        help = "Don't start new jobs while the load average is at least this high, unless "
+        "no other jobs are running.")
+    parser.add_option('--forkserver',
+                      dest = "forkserver",
+                      action = "store_true",
+                      default = False,
+                      help = "Start worker processes from a preloaded template process, instead of "
+                      "forking the build process.")
+    parser.add_option('--asyncio',
+                      dest = "asyncio",
+                      action = "store_true",
+                      default = False,
+                      help = "Run commands from the main process with asyncio, instead of from a "
+                      "pool of worker processes. Requires Python 3.5 or higher.")
+    parser.add_option('--copy-mode',
+                      dest = "copy_mode",
+                      type = "choice",
+                      choices = util.CopyModes,
+                      default = 'copy',
+                      help = "How to create the outputs of AddCopy() calls that don't choose: "
+                      "'copy' (the default) or 'link', to hard link them to their sources.")
+    parser.add_option('--content-hash',
+                      dest = "content_hash",
+                      action = "store_true",
+                      default = False,
+                      help = "Only treat source files as changed if their contents changed.")
     parser.add_option('--refactor',
                       dest = "refactor",
                       action = "store_true",
                       default = False,
                       help = "Abort the build if the dependency graph would change.")
+    parser.add_option('--watch',
+                      dest = "watch",
+                      action = "store_true",
+                      default = False,
+                      help = "Keep running, and rebuild whenever a source file changes.")
+    parser.add_option('--daemon',
+                      dest = "daemon",
+                      action = "store_true",
+                      default = False,
+                      help = "Start a build server that watches for file changes, and exit.")
+    parser.add_option('--stop-daemon',
+                      dest = "stop_daemon",
+                      action = "store_true",
+                      default = False,
+                      help = "Stop the build server, if one is running, and exit.")
+    parser.add_option('--no-daemon',
+                      dest = "no_daemon",
+                      action = "store_true",
+                      default = False,
+                      help = "Build in this process, even if a build server is running.")
     parser.add_option('--new-project',
                       dest = "new_project",
                       action = "store_true",
@@ -107,8 +190,13 @@ def BuildOptions():
 
     options, argv = parser.parse_args()
 
-    if len(argv) > 1:
-        parser.error("expected path, found extra arguments")
+    # The build runs from the build folder, and maybe in another process.
+    if options.trace is not None:
+        options.trace = os.path.abspath(options.trace)
+
+    if options.asyncio and sys.version_info < (3, 5):
+        sys.stderr.write('--asyncio requires Python 3.5 or higher.\n')
+        sys.exit(1)
 
     if options.new_project:
         if os.path.exists('AMBuildScript'):
@@ -129,6 +217,19 @@ def BuildOptions():
     return options, argv
 
 def Build(buildPath, options, argv):
+    if options.daemon:
+        return daemon.StartDaemon(buildPath)
+    if options.stop_daemon:
+        return daemon.StopDaemon(buildPath)
+    if options.watch:
+        with util.FolderChanger(buildPath):
+            with Context(buildPath, options, argv) as cx:
+                return cx.Watch()
+    if not options.no_daemon:
+        result = daemon.ClientBuild(buildPath, options, argv)
+        if result is not None:
+            return result
+
     with util.FolderChanger(buildPath):
         with Context(buildPath, options, argv) as cx:
             return cx.Build()
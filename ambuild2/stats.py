@@ -0,0 +1,73 @@
+# vim: set ts=8 sts=4 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+
+# Summarize the most recent build in the build log (--stats).
+def PrintStats(db, num_slowest = 10):
+    build = db.query_last_build()
+    if build is None:
+        print('No builds have been logged yet.')
+        return True
+
+    build_id, build_start, build_end, workers = build
+    rows = db.query_command_log(build_id)
+    if build_end is None:
+        # The build never finished; assume it ended with its last command.
+        build_end = max([row[2] for row in rows] + [build_start])
+
+    commands = []
+    by_type = {}
+    busy = 0
+    failed = 0
+    for node_id, start, end, pid, status, stdout_bytes, stderr_bytes in rows:
+        entry = db.query_node(node_id)
+        elapsed = end - start
+        busy += elapsed
+        if status != 0:
+            failed += 1
+        commands.append((elapsed, entry))
+
+        count, total, output_bytes = by_type.get(entry.type, (0, 0, 0))
+        by_type[entry.type] = (count + 1, total + elapsed,
+                               output_bytes + stdout_bytes + stderr_bytes)
+
+    wall = build_end - build_start
+    if wall > 0 and workers:
+        utilization = 100 * busy / (wall * workers)
+    else:
+        utilization = 0
+
+    print('Last build: {0} commands ({1} failed) in {2:.2f}s, on {3} workers'.format(
+        len(commands), failed, wall, workers))
+    print('Parallel utilization: {0:.1f}% ({1:.2f}s of work)'.format(utilization, busy))
+
+    if not len(commands):
+        return True
+
+    print('')
+    print('Slowest commands:')
+    commands.sort(key = lambda item: item[0], reverse = True)
+    for elapsed, entry in commands[:num_slowest]:
+        print('  {0:8.2f}s  {1}'.format(elapsed, entry.format()))
+
+    print('')
+    print('By type:')
+    for type in sorted(by_type, key = lambda type: by_type[type][1], reverse = True):
+        count, total, output_bytes = by_type[type]
+        print('  {0:4} {1:6} commands {2:10.2f}s total {3:10} bytes of output'.format(
+            type, count, total, output_bytes))
+    return True
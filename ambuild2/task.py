@@ -1,14 +1,67 @@
 # vim: set ts=8 sts=4 sw=4 tw=99 et:
+import codecs
+import collections
 import errno
+import heapq
+import inspect
+import io
 import multiprocessing as mp
 import shutil
 import os, sys
+import time
 import traceback
+from ambuild2 import jobserver
 from ambuild2 import make_parser
 from ambuild2 import nodetypes
 from ambuild2 import process_manager
 from ambuild2 import util
 
+# Assumed running time of a command that has never run, if no other command
+# has either.
+DEFAULT_TASK_DURATION = 1.0
+
+# How often to check the system load when --max-load is holding tasks back, in
+# seconds.
+LOAD_CHECK_INTERVAL = 0.5
+
+# How often to try for another jobserver token while tasks are waiting for one,
+# in seconds.
+JOBSERVER_RETRY_INTERVAL = 0.05
+
+# Workers that are busy with quick tasks can be handed up to this many tasks
+# at once, so they don't sit idle waiting on the master between tasks. Only
+# tasks expected to take less than PREFETCH_MAX_DURATION seconds are queued
+# behind another task.
+WORKER_QUEUE_DEPTH = 8
+PREFETCH_MAX_DURATION = 0.1
+
+# Workers send results back in batches; a result is held for at most this
+# long, in seconds, while the rest of a batch runs. Results are never held
+# while a task runs a process, since there's no telling how long that takes.
+RESULT_BATCH_DELAY = 0.01
+PROCESS_TASK_TYPES = set([nodetypes.Command, nodetypes.Cxx, nodetypes.Rc])
+
+# Workers are started as tasks become ready, and stopped after they've had
+# nothing to do for this many seconds.
+WORKER_IDLE_TIMEOUT = 2.0
+
+# Command output is written to files in .ambuild2/output. Output up to this
+# many bytes is sent to the master as text; anything bigger stays on disk, and
+# the master is only told where it is.
+OUTPUT_SPILL_SIZE = 256 * 1024
+
+# At most this many bytes of a command's stdout or stderr are printed. The
+# rest is left in its file.
+MAX_SPEW_SIZE = 1024 * 1024
+SPEW_CHUNK_SIZE = 64 * 1024
+
+# File operations (copies, symlinks and AddOutputFile writes) are run by the
+# master itself, rather than paying for a round-trip to a worker. Copies of
+# files bigger than INLINE_COPY_MAX_SIZE bytes still go to a worker, so they
+# can't hold up everything else.
+INLINE_TASK_TYPES = set(['cp', 'ln', 'bin'])
+INLINE_COPY_MAX_SIZE = 1024 * 1024
+
 class Task(object):
     def __init__(self, id, entry, outputs):
         self.id = id
@@ -20,12 +73,27 @@ class Task(object):
             self.folder = None
         self.outputs = outputs
         self.outgoing = []
-        self.incoming = set()
+        self.num_incoming = 0
         self.tools_env = entry.tools_env
 
+        # Whether this task has to run. Tasks that are only in the graph
+        # because an upstream command might change their inputs start out
+        # clean; they are skipped if no upstream command actually changes
+        # anything.
+        self.needs_run = entry.dirty != nodetypes.NOT_DIRTY
+
+        # Expected running time, in seconds, and the expected running time of
+        # the longest chain of tasks starting with this one. See
+        # ComputePriorities().
+        self.duration = DEFAULT_TASK_DURATION
+        self.priority = 0
+
+        # Expected peak memory use, in bytes.
+        self.memory = 0
+
     def addOutgoing(self, task):
         self.outgoing.append(task)
-        task.incoming.add(self)
+        task.num_incoming += 1
 
     @property
     def folder_name(self):
@@ -46,6 +114,103 @@ class Task(object):
                                                                       self.data[1]))
         return (' '.join([arg for arg in self.data]))
 
+# Set each task's priority to the length of the longest path from it to the
+# end of the graph, weighted by task durations. Running the tasks on that path
+# first keeps the build from ending with a long chain on a single core.
+def ComputePriorities(tasks):
+    # Order tasks so that each one comes after everything it depends on.
+    num_incoming = {}
+    for task in tasks:
+        num_incoming[task] = task.num_incoming
+    order = [task for task in tasks if not task.num_incoming]
+    for task in order:
+        for outgoing in task.outgoing:
+            num_incoming[outgoing] -= 1
+            if not num_incoming[outgoing]:
+                order.append(outgoing)
+
+    for task in reversed(order):
+        longest = 0
+        for outgoing in task.outgoing:
+            longest = max(longest, outgoing.priority)
+        task.priority = task.duration + longest
+
+# Tasks that are ready to run, highest priority first.
+class ReadyQueue(object):
+    def __init__(self, tasks = ()):
+        self.heap_ = [(-task.priority, task.id, task) for task in tasks]
+        heapq.heapify(self.heap_)
+
+    def __len__(self):
+        return len(self.heap_)
+
+    def append(self, task):
+        heapq.heappush(self.heap_, (-task.priority, task.id, task))
+
+    def peek(self):
+        return self.heap_[0][2]
+
+    def pop(self):
+        return heapq.heappop(self.heap_)[2]
+
+def OutputFolder(buildPath):
+    return os.path.join(buildPath, '.ambuild2', 'output')
+
+# Where a command's stdout or stderr goes. The process writes to a file rather
+# than a pipe, so however much it prints, nothing has to be held in memory or
+# pickled. Once the process exits, small outputs are read back as text; large
+# ones are left in the file.
+class CommandOutput(object):
+    def __init__(self, path, origin):
+        self.path = path
+        self.origin = origin
+        self.fp = open(path, 'wb')
+        self.size = None
+        self.text = None
+
+    # Called once the process has exited.
+    def finish(self):
+        self.fp.close()
+        self.size = os.path.getsize(self.path)
+        if self.size <= OUTPUT_SPILL_SIZE:
+            with open(self.path, 'rb') as fp:
+                self.text = util.DecodeConsoleText(self.origin, fp.read())
+            os.unlink(self.path)
+
+    # Runs a dependency filter (like util.FilterGCCDeps) over the output, and
+    # keeps only the lines it passes through. Returns the dependencies.
+    def filter(self, fn, *args):
+        if self.text is not None:
+            new_text = []
+            deps = fn(util.SplitLines(self.text), new_text.append, *args)
+            self.text = ''.join(new_text)
+            return deps
+
+        encoding = util.ConsoleEncoding(self.origin)
+        path = self.path + '.filtered'
+        with io.open(self.path, 'r', encoding = encoding, errors = 'replace') as input:
+            with io.open(path, 'w', encoding = encoding, errors = 'replace', newline = '') as fp:
+                lines = (line.rstrip('\n') for line in input)
+                deps = fn(lines, fp.write, *args)
+        os.unlink(self.path)
+
+        self.path = path
+        self.finish()
+        return deps
+
+    def discard(self):
+        if self.text is None:
+            os.unlink(self.path)
+
+    # Adds the output to a worker's reply, as |key| (such as 'stdout'). If it
+    # was too big to send, the master gets its path and size as |key|_file.
+    def addToReply(self, reply, key):
+        if self.text is not None:
+            reply[key] = self.text
+        else:
+            reply[key] = ''
+            reply[key + '_file'] = (self.path, self.size)
+
 def GetMsvcInclusionPattern(vars, tools_env):
     if 'cc_inclusion_pattern' in vars:
         return vars['cc_inclusion_pattern']
@@ -59,30 +224,142 @@ def GetMsvcInclusionPattern(vars, tools_env):
     return None
 
 class TaskWorker(process_manager.MessageReceiver):
-    def __init__(self, channel, vars):
+    def __init__(self, channel, vars, jobserver_config, environ = None):
         super(TaskWorker, self).__init__(channel)
+        if environ is not None:
+            os.environ.clear()
+            os.environ.update(environ)
+        self.initRunner(vars, jobserver_config)
+        self.messageMap = {'tasks': lambda channel, message: self.receive_tasks(channel, message)}
+        self.try_send({'id': 'spawned'})
+
+    # Sets up everything needed to run tasks. Runners that don't talk to the
+    # master over a channel (see AsyncTaskRunner) use this instead of __init__.
+    def initRunner(self, vars, jobserver_config):
         self.buildPath = vars['buildPath']
         self.pid = os.getpid()
         self.vars = vars
-        self.messageMap = {'task': lambda channel, message: self.receive_task(channel, message)}
+        self.makeflags, self.jobserver_fds = jobserver.WorkerJobserver(jobserver_config)
+        self.tools_envs_ = {}
+        self.env_cache_ = {}
+        self.output_folder_ = OutputFolder(self.buildPath)
+        self.num_outputs_ = 0
         self.taskMap = {
             # When updating this, add to task_argv_debug().
-            'cxx': lambda message: self.doCompile(message),
-            'cmd': lambda message: self.doCommand(message),
-            'ln': lambda message: self.doSymlink(message),
-            'cp': lambda message: self.doCopy(message),
-            'rc': lambda message: self.doResource(message),
-            'bin': lambda message: self.doBinaryWrite(message),
+            'cxx': self.doCompile,
+            'cmd': self.doCommand,
+            'ln': self.doSymlink,
+            'cp': self.doCopy,
+            'rc': self.doResource,
+            'bin': self.doBinaryWrite,
             # When updating this, add to task_argv_debug().
         }
-        self.try_send({'id': 'spawned'})
 
     def onShutdown(self):
         pass
 
-    def receive_task(self, channel, message):
+    def receive_tasks(self, channel, message):
+        self.addToolsEnvs(message.get('envs', {}))
+
+        results = []
+        flush_time = None
+        for task in message['tasks']:
+            # Send what's finished before starting something that might hold
+            # it up.
+            if len(results):
+                if task['task_type'] in PROCESS_TASK_TYPES or time.time() >= flush_time:
+                    self.try_send({'id': 'results', 'results': results})
+                    results = []
+
+            results.append(self.receive_task(task))
+            if len(results) == 1:
+                flush_time = time.time() + RESULT_BATCH_DELAY
+        if len(results):
+            self.try_send({'id': 'results', 'results': results})
+
+    # The master sends each tools environment once, with the first task that
+    # needs it; tasks only carry its id.
+    def addToolsEnvs(self, envs):
+        self.tools_envs_.update(envs)
+
+    def getToolsEnv(self, message):
+        env_id = message['task_env_id']
+        if env_id is None:
+            return None
+        return self.tools_envs_[env_id]
+
+    # Returns the environment to run commands with, or None to inherit ours.
+    # Each one is built once, since the same few are used by every command.
+    def getEnv(self, tools_env, with_makeflags = False):
+        if tools_env is not None:
+            key = (tools_env.env_id, with_makeflags)
+        else:
+            key = (None, with_makeflags)
+        if key in self.env_cache_:
+            return self.env_cache_[key]
+
+        env = None
+        if tools_env is not None and tools_env.env_cmds is not None:
+            env = util.BuildEnv(tools_env.env_cmds)
+
+        # Let make (or anything else that understands MAKEFLAGS) share our job
+        # slots.
+        if with_makeflags and self.makeflags is not None:
+            env = dict(env or os.environ)
+            env['MAKEFLAGS'] = jobserver.MergeMakeflags(env.get('MAKEFLAGS', ''), self.makeflags)
+
+        env = util.ExecuteEnv(env)
+        self.env_cache_[key] = env
+        return env
+
+    # Returns (stdout, stderr) for a new command (see CommandOutput).
+    def createOutputs(self):
+        self.num_outputs_ += 1
+        prefix = os.path.join(self.output_folder_, '{}-{}'.format(os.getpid(), self.num_outputs_))
+        out = CommandOutput(prefix + '.stdout', sys.stdout)
+        err = CommandOutput(prefix + '.stderr', sys.stderr)
+        return out, err
+
+    # Runs |argv| in |folder|. Returns the exit code, the stdout and stderr
+    # CommandOutputs, and peak memory usage.
+    def execute(self, argv, folder, env, pass_fds = ()):
+        out, err = self.createOutputs()
+        try:
+            with util.FolderChanger(folder):
+                returncode, peak_memory = util.ExecuteAndMeasure(argv,
+                                                                 out.fp,
+                                                                 err.fp,
+                                                                 env = env,
+                                                                 pass_fds = pass_fds)
+        finally:
+            out.finish()
+            err.finish()
+        return returncode, out, err, peak_memory
+
+    # Tasks that run processes are generators, so that AsyncTaskRunner can run
+    # them too. They yield each step that can take a while, and get back its
+    # result (or have its exception raised in them):
+    #   ('execute', argv, folder, env, pass_fds) runs a process (see execute()).
+    #   ('call', fn, args...) calls fn(args...).
+    def runSteps(self, steps):
+        send, value = steps.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                if step[0] == 'execute':
+                    value = self.execute(*step[1:])
+                else:
+                    value = step[1](*step[2:])
+                send = steps.send
+            except Exception as exn:
+                send, value = steps.throw, exn
+
+    def receive_task(self, message):
         try:
-            return self.process_task(channel, message)
+            return self.process_task(message)
         except Exception as e:
             response = {
                 'ok': False,
@@ -92,52 +369,69 @@ class TaskWorker(process_manager.MessageReceiver):
             }
             return self.issueResponse(message, response)
 
-    def process_task(self, channel, message):
-        task_id = message['task_id']
-        task_type = message['task_type']
-        task_folder = message['task_folder']
-        if not task_folder:
-            task_folder = '.'
+    def process_task(self, message):
+        response = self.prepareTask(message)
+        if response is not None:
+            return self.issueResponse(message, response)
 
-        # Remove all outputs.
+        # Do the task.
+        response = {'start': time.time()}
+        reply = self.taskMap[message['task_type']](message)
+        if inspect.isgenerator(reply):
+            reply = self.runSteps(reply)
+        response.update(reply)
+        response['end'] = time.time()
+        return self.issueResponse(message, response)
+
+    # Removes all of a task's outputs, and fills in its folder. Returns an
+    # error response if an output couldn't be removed.
+    def prepareTask(self, message):
         for output in message['task_outputs']:
             try:
                 os.unlink(output)
             except OSError as exn:
                 if exn.errno != errno.ENOENT:
-                    response = {
+                    return {
                         'ok': False,
                         'cmdline': 'rm {0}'.format(output),
                         'stdout': '',
                         'stderr': '{0}'.format(exn)
                     }
-                    return self.issueResponse(message, response)
 
         if not message['task_folder']:
             message['task_folder'] = '.'
-
-        # Do the task.
-        response = self.taskMap[task_type](message)
-        return self.issueResponse(message, response)
+        return None
 
     def issueResponse(self, message, response):
-        # Compute new timestamps for all command outputs.
-        new_timestamps = []
+        # Compute new timestamps and digests for all command outputs. The
+        # digests let the master skip dependent commands if the output did not
+        # actually change.
+        updates = []
         if response['ok']:
             for output in message['task_outputs']:
-                try:
-                    new_timestamps.append((output, os.path.getmtime(output)))
-                except:
+                stamp = util.FileStamp(output)
+                if stamp is None:
                     response['ok'] = False
                     response['stderr'] += 'Expected output file, but not found: {0}'.format(output)
                     break
 
-        # Send a message back to the master process to update the DAG and spew
-        # stdout/stderr if needed.
-        response['id'] = 'results'
+                # Outputs that can't be hashed (like a symlink to a folder) are
+                # always considered changed.
+                if os.path.isfile(output):
+                    digest = util.DigestFile(output)
+                else:
+                    digest = None
+                updates.append((output, stamp, digest))
+
+        # Tasks that don't run a process only report whether they succeeded.
+        if 'status' not in response or (response['status'] == 0 and not response['ok']):
+            response['status'] = 0 if response['ok'] else 1
+
+        # The master process uses this to update the DAG and spew stdout/stderr
+        # if needed.
         response['task_id'] = message['task_id']
-        response['updates'] = new_timestamps
-        self.try_send(response)
+        response['updates'] = updates
+        return response
 
     def try_send(self, message):
         try:
@@ -150,42 +444,48 @@ class TaskWorker(process_manager.MessageReceiver):
 
     def doCommand(self, message):
         task_folder = message['task_folder']
-        tools_env = message['task_tools_env']
+        tools_env = self.getToolsEnv(message)
         argv = message['task_data']
 
-        env = None
-        if tools_env is not None:
-            if tools_env.env_cmds is not None:
-                env = util.BuildEnv(tools_env.env_cmds)
-            if argv[0] in tools_env.tools:
-                argv[0] = tools_env.tools[argv[0]]
+        env = self.getEnv(tools_env, with_makeflags = True)
+        if tools_env is not None and argv[0] in tools_env.tools:
+            argv[0] = tools_env.tools[argv[0]]
 
-        with util.FolderChanger(task_folder):
-            try:
-                p, stdout, stderr = util.Execute(argv, env = env)
-                status = p.returncode == 0
-            except Exception as exn:
-                status = False
-                stdout = ''
-                stderr = '{0}'.format(exn)
+        try:
+            returncode, out, err, peak_memory = yield ('execute', argv, task_folder, env,
+                                                       self.jobserver_fds)
+        except Exception as exn:
+            return {
+                'ok': False,
+                'status': 1,
+                'cmdline': self.task_argv_debug(message),
+                'stdout': '',
+                'stderr': '{0}'.format(exn),
+            }
 
         reply = {
-            'ok': status,
+            'ok': returncode == 0,
+            'status': returncode,
             'cmdline': self.task_argv_debug(message),
-            'stdout': stdout,
-            'stderr': stderr,
+            'peak_memory': peak_memory,
         }
+        out.addToReply(reply, 'stdout')
+        err.addToReply(reply, 'stderr')
         return reply
 
+    # The file operations below don't change the current folder, so the
+    # master can run them too (see TaskMaster.runInlineTasks()), as can
+    # AsyncTaskRunner's helper threads.
     def doSymlink(self, message):
         task_folder = message['task_folder']
         source_path, output_path = message['task_data']
 
-        with util.FolderChanger(task_folder):
-            rcode, stdout, stderr = util.symlink(source_path, output_path)
+        # The link's target is left as-is, since it's relative to the link.
+        rcode, stdout, stderr = util.symlink(source_path, os.path.join(task_folder, output_path))
 
         reply = {
             'ok': rcode == 0,
+            'status': rcode,
             'cmdline': self.task_argv_debug(message),
             'stdout': stdout,
             'stderr': stderr,
@@ -194,16 +494,17 @@ class TaskWorker(process_manager.MessageReceiver):
 
     def doCopy(self, message):
         task_folder = message['task_folder']
-        source_path, output_path = message['task_data']
-
-        with util.FolderChanger(task_folder):
-            if os.path.exists(source_path):
-                shutil.copy(source_path, output_path)
-                ok = True
-                stderr = ''
-            else:
-                ok = False
-                stderr = 'File not found: {0}'.format(source_path)
+        source_path, output_path = message['task_data'][:2]
+
+        source_path = os.path.join(task_folder, source_path)
+        if os.path.exists(source_path):
+            util.CopyFile(source_path, os.path.join(task_folder, output_path),
+                          message['task_copy_mode'])
+            ok = True
+            stderr = ''
+        else:
+            ok = False
+            stderr = 'File not found: {0}'.format(message['task_data'][0])
 
         reply = {
             'ok': ok,
@@ -224,22 +525,21 @@ class TaskWorker(process_manager.MessageReceiver):
             'stdout': '',
             'stderr': '',
         }
-        with util.FolderChanger(task_folder):
-            try:
-                with open(filename, 'wb') as fp:
-                    fp.write(task_data['contents'])
-            except Exception as e:
-                reply['ok'] = False
-                reply['stderr'] = str(e)
+        try:
+            with open(os.path.join(task_folder, filename), 'wb') as fp:
+                fp.write(task_data['contents'])
+        except Exception as e:
+            reply['ok'] = False
+            reply['stderr'] = str(e)
         return reply
 
-    # Adjusts any dependencies relative to the current folder, to be relative to
-    # the output folder instead.
-    def rewriteDeps(self, deps):
+    # Adjusts any dependencies relative to |folder| (by default, the current
+    # folder), to be relative to the output folder instead.
+    def rewriteDeps(self, deps, folder = '.'):
         paths = []
         for inc_path in deps:
             if not os.path.isabs(inc_path):
-                inc_path = os.path.abspath(inc_path)
+                inc_path = os.path.abspath(os.path.join(folder, inc_path))
 
             # Detect whether the include is within the build folder or not.
             build_path = self.buildPath
@@ -257,7 +557,7 @@ class TaskWorker(process_manager.MessageReceiver):
     def doCompile(self, message):
         task_folder = message['task_folder']
         task_data = message['task_data']
-        tools_env = message['task_tools_env']
+        tools_env = self.getToolsEnv(message)
         cc_type = task_data['type']
         argv = task_data['argv']
 
@@ -267,82 +567,81 @@ class TaskWorker(process_manager.MessageReceiver):
             dep_type = cc_type
             dep_info = None
 
-        env = None
-        if tools_env is not None:
-            if tools_env.env_cmds is not None:
-                env = util.BuildEnv(tools_env.env_cmds)
-            if 'cl' in tools_env.tools:
-                argv[0] = tools_env.tools['cl']
+        env = self.getEnv(tools_env)
+        if tools_env is not None and 'cl' in tools_env.tools:
+            argv[0] = tools_env.tools['cl']
 
-        with util.FolderChanger(task_folder):
-            p, out, err = util.Execute(argv, env = env)
-            out, err, paths = self.parseDependencies(p, tools_env, out, err, dep_type, dep_info)
+        returncode, out, err, peak_memory = yield ('execute', argv, task_folder, env, ())
+        paths = yield ('call', self.parseDependencies, returncode, tools_env, out, err, dep_type,
+                       dep_info, task_folder)
 
         reply = {
-            'ok': p.returncode == 0,
+            'ok': returncode == 0,
+            'status': returncode,
             'cmdline': self.task_argv_debug(message),
-            'stdout': out,
-            'stderr': err,
             'deps': paths,
+            'peak_memory': peak_memory,
         }
+        out.addToReply(reply, 'stdout')
+        err.addToReply(reply, 'stderr')
         return reply
 
-    def parseDependencies(self, p, tools_env, out, err, dep_type, dep_info):
+    # |out| and |err| are CommandOutputs. Dependencies are removed from them.
+    def parseDependencies(self, returncode, tools_env, out, err, dep_type, dep_info, folder = '.'):
         if dep_type == 'md':
             try:
-                with open(dep_info) as fp:
+                with open(os.path.join(folder, dep_info)) as fp:
                     deps = make_parser.ParseDependencyFile(dep_info, fp)
             except:
-                if p.returncode == 0:
+                if returncode == 0:
                     raise
                 deps = []
         elif dep_type == 'gcc':
-            err, deps = util.ParseGCCDeps(err)
+            deps = err.filter(util.FilterGCCDeps)
         elif dep_type == 'msvc':
             inclusion_pattern = GetMsvcInclusionPattern(self.vars, tools_env)
-            out, deps = util.ParseMSVCDeps(out, inclusion_pattern)
+            deps = out.filter(util.FilterMSVCDeps, inclusion_pattern)
         elif dep_type == 'fxc':
-            out, deps = util.ParseFXCDeps(out)
+            deps = out.filter(util.FilterFXCDeps)
         else:
             raise Exception('unknown dependency type')
 
-        paths = self.rewriteDeps(deps)
-        return out, err, paths
+        return self.rewriteDeps(deps, folder)
 
     def doResource(self, message):
         task_folder = message['task_folder']
         task_data = message['task_data']
-        tools_env = message['task_tools_env']
+        tools_env = self.getToolsEnv(message)
         cl_argv = task_data['cl_argv']
         rc_argv = task_data['rc_argv']
 
         inclusion_pattern = GetMsvcInclusionPattern(self.vars, tools_env)
 
-        env = None
+        env = self.getEnv(tools_env)
         if tools_env is not None:
-            if tools_env.env_cmds is not None:
-                env = util.BuildEnv(tools_env.env_cmds)
             if 'cl' in tools_env.tools:
                 cl_argv[0] = tools_env.tools['cl']
             if 'rc' in tools_env.tools:
                 rc_argv[0] = tools_env.tools['rc']
 
-        with util.FolderChanger(task_folder):
-            # Includes go to stderr when we preprocess to stdout.
-            p, out, err = util.Execute(cl_argv, env = env)
-            out, deps = util.ParseMSVCDeps(err, inclusion_pattern)
-            paths = self.rewriteDeps(deps)
+        # Includes go to stderr when we preprocess to stdout.
+        returncode, out, err, _ = yield ('execute', cl_argv, task_folder, env, ())
+        deps = yield ('call', err.filter, util.FilterMSVCDeps, inclusion_pattern)
+        paths = self.rewriteDeps(deps, task_folder)
 
-            if p.returncode == 0:
-                p, out, err = util.Execute(rc_argv, env = env)
+        if returncode == 0:
+            out.discard()
+            err.discard()
+            returncode, out, err, _ = yield ('execute', rc_argv, task_folder, env, ())
 
         reply = {
-            'ok': p.returncode == 0,
+            'ok': returncode == 0,
+            'status': returncode,
             'cmdline': self.task_argv_debug(message),
-            'stdout': out,
-            'stderr': err,
             'deps': paths,
         }
+        out.addToReply(reply, 'stdout')
+        err.addToReply(reply, 'stderr')
         return reply
 
     def task_argv_debug(self, message):
@@ -365,6 +664,62 @@ class TaskWorker(process_manager.MessageReceiver):
         elif message['task_type'] == 'bin':
             return 'write {}'.format(message['task_data']['path'])
 
+# Runs file operations for TaskMaster, in the master process. Like a worker,
+# it works from the build folder.
+class InlineTaskRunner(TaskWorker):
+    def __init__(self, vars):
+        self.buildPath = vars['buildPath']
+        self.pid = os.getpid()
+        self.vars = vars
+        self.taskMap = {
+            'ln': self.doSymlink,
+            'cp': self.doCopy,
+            'bin': self.doBinaryWrite,
+        }
+
+    def runs(self, task):
+        if task.type not in INLINE_TASK_TYPES:
+            return False
+        if task.type == 'cp':
+            try:
+                source_path = os.path.join(task.folder_name, task.data[0])
+                return os.path.getsize(source_path) <= INLINE_COPY_MAX_SIZE
+            except OSError:
+                # Let the copy fail as usual.
+                return True
+        return True
+
+# Copies a command's output file (see CommandOutput) to |stream|, up to
+# MAX_SPEW_SIZE bytes. The file is removed, unless it was cut short.
+def SpewOutputFile(stream, path, size):
+    decoder = codecs.getincrementaldecoder(util.ConsoleEncoding(stream))('replace')
+    remaining = min(size, MAX_SPEW_SIZE)
+    last = '\n'
+    with open(path, 'rb') as fp:
+        while remaining > 0:
+            data = fp.read(min(remaining, SPEW_CHUNK_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+            text = decoder.decode(data, final = remaining <= 0)
+            if len(text):
+                util.WriteEncodedText(stream, text)
+                last = text[-1]
+    if last != '\n':
+        stream.write('\n')
+
+    if size > MAX_SPEW_SIZE:
+        stream.write('... {} more bytes of output are in {}\n'.format(size - MAX_SPEW_SIZE, path))
+    else:
+        os.unlink(path)
+    stream.flush()
+
+# Returns the size of a command's stdout or stderr, in bytes.
+def OutputSize(message, key):
+    if key + '_file' in message:
+        return message[key + '_file'][1]
+    return len(message[key].encode('utf-8', 'replace'))
+
 class TaskMaster(object):
     BUILD_IN_PROGRESS = 0
     BUILD_SUCCEEDED = 1
@@ -379,17 +734,46 @@ class TaskMaster(object):
         self.messageMap = {
             'completed': lambda child, message: self.receiveCompleted(child, message),
             'spawned': lambda child, message: self.recvSpawned(child, message),
-            'results': lambda child, message: self.recvTaskComplete(child, message),
+            'results': lambda child, message: self.recvResults(child, message),
             'done': lambda child, message: self.receiveDone(child, message),
         }
         self.errors_ = []
-        self.task_graph = task_graph
+        self.inline_runner_ = InlineTaskRunner(cx.vars)
+        self.inline_tasks_ = collections.deque()
+        self.task_graph = ReadyQueue()
+        for task in task_graph:
+            self.addReadyTask(task)
         self.workers_ = []
         self.pending_ = {}
-        self.idle_ = set()
+        self.num_pending_ = 0
+        self.starting_ = set()
+        self.poller_ = None
+
+        # Maps each worker to the ids of the tools environments it has.
+        self.worker_envs_ = {}
+
+        # Maps idle workers to when they became idle.
+        self.idle_ = {}
         self.build_completed_ = False
         self.failed_task_message = None
 
+        # Memory that running tasks are expected to use, and how much they may
+        # use in total.
+        self.running_memory_ = 0
+        if cx.options.memory_budget is not None:
+            self.memory_budget_ = cx.options.memory_budget * 1024 * 1024
+        else:
+            self.memory_budget_ = util.AvailableMemory()
+
+        # Stop the build after this many tasks fail; 0 means never.
+        self.max_failures_ = cx.options.keep_going
+
+        self.max_load_ = cx.options.max_load
+        if self.max_load_ is not None and not hasattr(os, 'getloadavg'):
+            util.con_err(util.ConsoleRed, 'Warning: --max-load is not supported on this platform.',
+                         util.ConsoleNormal)
+            self.max_load_ = None
+
         # Figure out how many tasks to create.
         if cx.options.jobs == 0:
             # Using 1 process will be strictly worse than an in-process build,
@@ -403,12 +787,31 @@ class TaskMaster(object):
         else:
             num_processes = cx.options.jobs
 
-        # Don't create more processes than we'll need.
+        num_jobs = num_processes
+
+        # Don't create more processes than we'll need. They're started as
+        # tasks become ready (see start_workers()).
         if num_processes > max_parallel:
             num_processes = max_parallel
-
-        for _ in range(num_processes):
-            self.startWorker()
+        self.max_workers_ = num_processes
+        self.waiting_for_token_ = False
+
+        self.build_id_ = cx.db.start_build_log(time.time(), num_processes)
+        self.command_log_ = []
+
+        # Remove any output left from the last build.
+        output_folder = OutputFolder(cx.buildPath)
+        shutil.rmtree(output_folder, ignore_errors = True)
+        if not os.path.isdir(output_folder):
+            os.mkdir(output_folder)
+
+        # Every task but the first needs a token from the jobserver. If we
+        # create the jobserver, commands that run make can use the slots we
+        # don't, so it gets the full job count. It's opened last, since only
+        # run() closes it (and removes the fifo, if we created one).
+        self.jobserver_ = None
+        if num_jobs > 1:
+            self.jobserver_ = jobserver.Open(cx.cacheFolder, num_jobs)
 
     def spewResult(self, worker, task, message):
         if message['ok']:
@@ -419,116 +822,402 @@ class TaskMaster(object):
                      color, message['cmdline'], util.ConsoleNormal)
         sys.stdout.flush()
 
-        if len(message['stdout']):
-            util.WriteEncodedText(sys.stdout, message['stdout'])
-            if message['stdout'][-1] != '\n':
-                sys.stdout.write('\n')
-            sys.stdout.flush()
-
-        if len(message['stderr']):
-            util.WriteEncodedText(sys.stderr, message['stderr'])
-            if message['stderr'][-1] != '\n':
-                sys.stderr.write('\n')
-            sys.stderr.flush()
+        self.spewOutput(sys.stdout, message, 'stdout')
+        self.spewOutput(sys.stderr, message, 'stderr')
 
         if not message['ok'] and task:
             self.failed_task_message = task.outputs[0]
 
+    def spewOutput(self, stream, message, key):
+        if key + '_file' in message:
+            path, size = message[key + '_file']
+            SpewOutputFile(stream, path, size)
+            return
+
+        text = message[key]
+        if len(text):
+            util.WriteEncodedText(stream, text)
+            if text[-1] != '\n':
+                stream.write('\n')
+            stream.flush()
+
+    def recvResults(self, worker, message):
+        # Every result is for a command that ran, so record them all, even if
+        # an earlier one ended the build.
+        for result in message['results']:
+            self.recvTaskComplete(worker, result)
+        if self.status_ != TaskMaster.BUILD_IN_PROGRESS:
+            return
+        self.continueBuild(worker)
+
     def recvTaskComplete(self, worker, message):
-        task = self.pending_[worker.pid]
+        task = self.pending_[worker.pid][0]
+        if message['task_id'] != task.id:
+            raise Exception('Worker {} returned wrong task id (got {}, expected {})'.format(
+                worker.pid, message['task_id'], task.id))
 
         message['pid'] = worker.pid
-        if not message['ok']:
-            self.errors_.append((worker, task, message))
-            self.terminateBuild(TaskMaster.BUILD_FAILED)
-            return
+        self.retireTask(worker)
+        self.finishTask(worker, task, message)
 
+    # |worker| is None if the master ran the task itself.
+    def finishTask(self, worker, task, message):
+        self.logTask(task, message)
+        self.traceTask(task, message)
         self.spewResult(worker, task, message)
 
-        del self.pending_[worker.pid]
-        if message['task_id'] != task.id:
-            raise Exception('Worker {} returned wrong task id (got {}, expected {})'.format(
-                worker.pid, task_id, task.id))
+        # With --keep-going, a failed task only stops the tasks that depend on
+        # it. They never become ready, so they're skipped.
+        if not message['ok']:
+            self.errors_.append((worker, task, message))
+            if self.max_failures_ and len(self.errors_) >= self.max_failures_:
+                self.terminateBuild(TaskMaster.BUILD_FAILED)
+            return
 
         updates = message['updates']
         if not self.builder.updateGraph(task.id, updates, message):
             util.con_out(util.ConsoleRed, 'Failed to update node!', util.ConsoleNormal)
             self.terminateBuild(TaskMaster.BUILD_FAILED)
+            return
 
         # Enqueue any tasks that can be run if this was their last outstanding
         # dependency.
-        for outgoing in task.outgoing:
-            outgoing.incoming.remove(task)
-            if len(outgoing.incoming) == 0:
-                self.task_graph.append(outgoing)
-
-        if not len(self.task_graph) and not len(self.pending_):
+        self.releaseOutgoing(task)
+
+    def retireTask(self, worker):
+        queue = self.pending_[worker.pid]
+        task = queue.popleft()
+        self.num_pending_ -= 1
+        self.running_memory_ -= task.memory
+        if not len(queue):
+            self.release_token()
+
+    def addReadyTask(self, task):
+        if self.inline_runner_.runs(task):
+            self.inline_tasks_.append(task)
+        else:
+            self.task_graph.append(task)
+
+    # Run file operations as soon as they're ready, along with any that become
+    # ready as they finish.
+    def runInlineTasks(self):
+        while len(self.inline_tasks_) and self.status_ == TaskMaster.BUILD_IN_PROGRESS:
+            task = self.inline_tasks_.popleft()
+            task.dispatched = time.time()
+            message = self.inline_runner_.receive_task(self.task_message(task))
+            message['pid'] = self.inline_runner_.pid
+            self.finishTask(None, task, message)
+
+    def checkFinished(self):
+        if self.status_ != TaskMaster.BUILD_IN_PROGRESS:
+            return
+        if not len(self.task_graph) and not self.num_pending_:
             # There are no tasks remaining.
-            self.status_ = TaskMaster.BUILD_SUCCEEDED
+            if len(self.errors_):
+                self.status_ = TaskMaster.BUILD_FAILED
+            else:
+                self.status_ = TaskMaster.BUILD_SUCCEEDED
 
-        # Add this process to the idle set.
-        self.idle_.add(worker)
+    def continueBuild(self, worker):
+        self.runInlineTasks()
+        if self.status_ != TaskMaster.BUILD_IN_PROGRESS:
+            return
+        self.checkFinished()
+
+        # Add this process to the idle set if it has nothing left to do.
+        if not len(self.pending_[worker.pid]):
+            self.idle_[worker] = time.time()
 
         # If more stuff was queued, and we have idle processes, use them.
-        while len(self.task_graph) and len(self.idle_):
-            worker = self.idle_.pop()
-            self.issue_next_task(worker)
+        self.issue_tasks(worker)
+
+    def printFailures(self):
+        util.con_err(util.ConsoleHeader, '{0} commands failed:'.format(len(self.errors_)),
+                     util.ConsoleNormal)
+        for worker, task, message in self.errors_:
+            util.con_err(util.ConsoleBlue, ' -> ', util.ConsoleRed, message['cmdline'],
+                         util.ConsoleNormal)
+
+    # The build log is written in one go, when the build ends.
+    def logTask(self, task, message):
+        now = time.time()
+        self.command_log_.append((self.builder.commands[task.id].id, message.get('start', now),
+                                  message.get('end', now), message['pid'], message['status'],
+                                  OutputSize(message, 'stdout'), OutputSize(message, 'stderr')))
+
+    def traceTask(self, task, message):
+        now = time.time()
+        start = message.get('start', now)
+        if task.outputs:
+            name = os.path.basename(task.outputs[0])
+        else:
+            name = task.type
+        args = {
+            'cmdline': message['cmdline'],
+            'status': message['status'],
+            # Time spent between sending the task and the worker starting it.
+            'dispatch_ms': round((start - task.dispatched) * 1000, 3),
+        }
+        self.cx.tracer.addSpan(name,
+                               start,
+                               message.get('end', now),
+                               tid = message['pid'],
+                               category = task.type,
+                               args = args)
+
+    def releaseOutgoing(self, task):
+        ready = [task]
+        while len(ready):
+            task = ready.pop()
+            for outgoing in task.outgoing:
+                outgoing.num_incoming -= 1
+                if outgoing.num_incoming != 0:
+                    continue
+
+                # If nothing upstream changed, the task is skipped, and its own
+                # dependents may now be ready.
+                if self.builder.pruneTask(outgoing):
+                    ready.append(outgoing)
+                else:
+                    self.addReadyTask(outgoing)
 
     def terminateBuild(self, status):
         self.status_ = status
 
     def startWorker(self):
-        args = (self.cx.vars,)
-        child = self.cx.procman.spawn(TaskWorker, args)
+        if self.jobserver_ is not None:
+            jobserver_config = self.jobserver_.worker_config
+        else:
+            jobserver_config = {}
+
+        # Descriptors inherited from make are only valid in processes forked
+        # from this one.
+        forkserver = self.cx.options.forkserver and 'fds' not in jobserver_config
+
+        args = (self.cx.vars, jobserver_config)
+        if forkserver:
+            # The template process might be older than this build (see
+            # daemon.py), so it can't be trusted to have our environment.
+            args += (dict(os.environ),)
+        child = self.cx.procman.spawn(TaskWorker, args, forkserver = forkserver)
         self.workers_.append(child)
+        self.starting_.add(child)
+        self.poller_.add(child)
+        self.cx.tracer.nameThread(child.proc.pid, 'worker {}'.format(child.proc.pid))
 
         util.con_out(util.ConsoleHeader, 'Spawned {0} (pid: {1})'.format('worker', child.proc.pid),
                      util.ConsoleNormal)
 
+    def stopWorker(self, worker):
+        del self.idle_[worker]
+        del self.pending_[worker.pid]
+        del self.worker_envs_[worker.pid]
+        self.workers_.remove(worker)
+        self.poller_.remove(worker)
+        self.cx.procman.stop(worker)
+
+    # Start a worker for each ready task that doesn't have one yet, up to the
+    # limit. Workers that are still starting count as available.
+    def start_workers(self):
+        needed = len(self.task_graph) - len(self.starting_)
+        while needed > 0 and len(self.workers_) < self.max_workers_:
+            self.startWorker()
+            needed -= 1
+
+    # Stop workers that have had nothing to do for a while, such as during a
+    # long link at the end of a build. More are started if they're needed
+    # again.
+    def retire_idle_workers(self):
+        if len(self.task_graph):
+            return
+        now = time.time()
+        for worker, since in list(self.idle_.items()):
+            if now - since >= WORKER_IDLE_TIMEOUT:
+                self.stopWorker(worker)
+
     def run(self):
         try:
             self.pump()
         except KeyboardInterrupt:  # :TODO: TEST!
             self.terminateBuild(TaskMaster.BUILD_INTERRUPTED)
-        for worker, task, message in self.errors_:
-            self.spewResult(worker, task, message)
+        finally:
+            if self.jobserver_ is not None:
+                self.jobserver_.close()
+            self.cx.db.log_commands(self.build_id_, self.command_log_)
+        if len(self.errors_) > 1:
+            self.printFailures()
+        self.cx.db.finish_build_log(self.build_id_, time.time())
         return self.status_
 
     def onShutdown(self):
         return False
 
     def recvSpawned(self, worker, message):
+        self.starting_.discard(worker)
         if self.status_ != TaskMaster.BUILD_IN_PROGRESS:
             return
 
-        if not len(self.task_graph):
-            # If there are still tasks left to complete, they're waiting on others
-            # to finish. Mark this process as ready and just ignore the status
-            # change for now.
-            self.idle_.add(worker)
+        # If there are still tasks left to complete, they might be waiting on
+        # others to finish, or on the system load to drop.
+        self.pending_[worker.pid] = collections.deque()
+        self.worker_envs_[worker.pid] = set()
+        self.idle_[worker] = time.time()
+        self.issue_tasks()
+
+    # |reporting| is the worker that just sent results, if any; it can be
+    # topped up with more quick tasks.
+    def issue_tasks(self, reporting = None):
+        self.waiting_for_token_ = False
+        batches = {}
+        if reporting is not None:
+            batches[reporting] = []
+        while len(self.task_graph) and not self.overloaded():
+            task = self.task_graph.peek()
+            worker = self.find_worker(task, batches)
+            if worker is None:
+                self.start_workers()
+                break
+            if not self.fits_in_memory(task):
+                # Wait for running tasks to finish, rather than starting
+                # smaller tasks first, so the big task isn't starved.
+                break
+            # Tokens are for busy workers, not tasks: a worker runs the tasks
+            # queued to it one at a time.
+            if worker in self.idle_ and not self.acquire_token():
+                self.waiting_for_token_ = True
+                break
+            self.idle_.pop(worker, None)
+            batches.setdefault(worker, []).append(self.queue_next_task(worker))
+
+        # Each worker gets its new tasks in a single message.
+        for worker, tasks in batches.items():
+            if len(tasks):
+                self.issue_batch(worker, tasks)
+
+    # Prefer an idle worker. Otherwise, a quick task can wait behind other
+    # quick tasks, on one of the workers in |batches| (those we're sending a
+    # message to anyway). Spreading them over every worker would mean a
+    # message per task again.
+    def find_worker(self, task, batches):
+        if len(self.idle_):
+            return next(iter(self.idle_))
+        if task.duration > PREFETCH_MAX_DURATION:
+            return None
+
+        best = None
+        for worker in batches:
+            queue = self.pending_[worker.pid]
+            if not len(queue) or len(queue) >= WORKER_QUEUE_DEPTH:
+                continue
+            if queue[0].duration > PREFETCH_MAX_DURATION:
+                continue
+            if best is None or len(queue) < len(self.pending_[best.pid]):
+                best = worker
+        return best
+
+    def num_busy_workers(self):
+        return len([queue for queue in self.pending_.values() if len(queue)])
+
+    def acquire_token(self):
+        if self.jobserver_ is None or not self.num_busy_workers():
+            return True
+        return self.jobserver_.acquire()
+
+    # Give back a token if we're holding more than the busy workers need.
+    def release_token(self):
+        if self.jobserver_ is None:
             return
-
-        self.issue_next_task(worker)
-
-    def issue_next_task(self, worker):
+        if self.jobserver_.num_tokens > max(self.num_busy_workers() - 1, 0):
+            self.jobserver_.release()
+
+    # A task that doesn't fit in the memory budget can still run on its own.
+    def fits_in_memory(self, task):
+        if self.memory_budget_ is None or not self.num_pending_:
+            return True
+        return self.running_memory_ + task.memory <= self.memory_budget_
+
+    # With --max-load, don't start more tasks while the system is busy. Like
+    # make, one task is always allowed to run, so the build can't stall.
+    def overloaded(self):
+        if self.max_load_ is None or not self.num_pending_:
+            return False
+        return os.getloadavg()[0] >= self.max_load_
+
+    # If tasks are being held back, wake up periodically to see if the load
+    # has dropped. Otherwise, wake up to retire idle workers.
+    def poll_timeout(self):
+        if not len(self.idle_):
+            return None
+        if not len(self.task_graph):
+            return WORKER_IDLE_TIMEOUT
+        if self.waiting_for_token_:
+            return JOBSERVER_RETRY_INTERVAL
+        if self.max_load_ is not None:
+            return LOAD_CHECK_INTERVAL
+        return None
+
+    def queue_next_task(self, worker):
         task = self.task_graph.pop()
+        self.pending_[worker.pid].append(task)
+        self.num_pending_ += 1
+        self.running_memory_ += task.memory
+        return task
+
+    def issue_batch(self, worker, tasks):
+        now = time.time()
+        messages = []
+        envs = {}
+        known_envs = self.worker_envs_[worker.pid]
+        for task in tasks:
+            messages.append(self.task_message(task))
+            task.dispatched = now
+
+            tools_env = task.tools_env
+            if tools_env is not None and tools_env.env_id not in known_envs:
+                envs[tools_env.env_id] = tools_env
+                known_envs.add(tools_env.env_id)
+
+        message = {'id': 'tasks', 'tasks': messages}
+        if len(envs):
+            message['envs'] = envs
+        worker.channel.send(message)
+
+    def task_message(self, task):
         message = {
-            'id': 'task',
             'task_id': task.id,
             'task_type': task.type,
             'task_data': task.data,
             'task_folder': task.folder,
             'task_outputs': task.outputs,
-            'task_tools_env': task.tools_env,
+            'task_env_id': task.tools_env.env_id if task.tools_env is not None else None,
         }
-        worker.channel.send(message)
-        self.pending_[worker.pid] = task
+        if task.type == nodetypes.Copy:
+            # AddCopy(mode = ...) overrides --copy-mode.
+            if len(task.data) > 2:
+                message['task_copy_mode'] = task.data[2]
+            else:
+                message['task_copy_mode'] = self.cx.options.copy_mode
+        return message
 
     def pump(self):
-        with process_manager.ChannelPoller(self.cx, self.workers_) as poller:
+        interrupt = self.cx.interrupt
+        with process_manager.ChannelPoller(self.cx, self.workers_, interrupt) as poller:
+            self.poller_ = poller
+            self.runInlineTasks()
+            self.checkFinished()
+            self.start_workers()
             while self.status_ == TaskMaster.BUILD_IN_PROGRESS:
                 try:
-                    proc, obj = poller.poll()
+                    proc, obj = poller.poll(self.poll_timeout())
+                    if proc is None:
+                        # Tasks that are already running are allowed to
+                        # finish; their results are dropped.
+                        if obj is not None and interrupt.poll():
+                            self.terminateBuild(TaskMaster.BUILD_INTERRUPTED)
+                        else:
+                            self.retire_idle_workers()
+                            self.issue_tasks()
+                        continue
                     if obj['id'] not in self.messageMap:
                         raise Exception('Unhandled message type: {}'.format(obj['id']))
                     self.messageMap[obj['id']](proc, obj)
@@ -0,0 +1,220 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from ambuild2 import nodetypes
+from ambuild2 import util
+from ambuild2.task import CommandOutput, ComputePriorities, InlineTaskRunner
+from ambuild2.task import INLINE_COPY_MAX_SIZE, OUTPUT_SPILL_SIZE, ReadyQueue, Task, TaskMaster
+from ambuild2.task import TaskWorker
+
+class TaskFactory(object):
+    def __init__(self):
+        self.tasks = []
+
+    def add(self, name, duration):
+        entry = nodetypes.Entry(
+            len(self.tasks) + 1, nodetypes.Command, name, None, None, 0, nodetypes.ALWAYS_DIRTY)
+        task = Task(len(self.tasks), entry, [name])
+        task.duration = duration
+        self.tasks.append(task)
+        return task
+
+# Run |tasks| on |num_workers| workers, taking ready tasks from |queue| the
+# same way TaskMaster does, and return how long the whole build took.
+def Simulate(tasks, queue, num_workers):
+    for task in tasks:
+        if not task.num_incoming:
+            queue.append(task)
+
+    now = 0
+    running = []
+    idle = num_workers
+    while len(queue) or len(running):
+        while idle and len(queue):
+            task = queue.pop()
+            heapq.heappush(running, (now + task.duration, task.id, task))
+            idle -= 1
+
+        now, _, task = heapq.heappop(running)
+        idle += 1
+        for outgoing in task.outgoing:
+            outgoing.num_incoming -= 1
+            if not outgoing.num_incoming:
+                queue.append(outgoing)
+    return now
+
+# Many quick compiles feeding one small library, and one slow compile feeding
+# a slow link. The slow chain is found last, so a LIFO queue runs it last.
+def CreateSkewedGraph():
+    factory = TaskFactory()
+    slow_cc = factory.add('slow.o', 10)
+    link = factory.add('program', 5)
+    slow_cc.addOutgoing(link)
+
+    lib = factory.add('lib.a', 1)
+    for i in range(16):
+        factory.add('{}.o'.format(i), 1).addOutgoing(lib)
+    lib.addOutgoing(link)
+    return factory.tasks
+
+class ComputePrioritiesTests(unittest.TestCase):
+    def runTest(self):
+        tasks = CreateSkewedGraph()
+        ComputePriorities(tasks)
+
+        slow_cc, link, lib = tasks[0:3]
+        self.assertEqual(link.priority, 5)
+        self.assertEqual(lib.priority, 6)
+        self.assertEqual(slow_cc.priority, 15)
+        self.assertEqual(tasks[3].priority, 7)
+
+class MakespanTests(unittest.TestCase):
+    def runTest(self):
+        lifo = Simulate(CreateSkewedGraph(), [], 4)
+
+        tasks = CreateSkewedGraph()
+        ComputePriorities(tasks)
+        critical_path = Simulate(tasks, ReadyQueue(), 4)
+
+        # The slow compile and link are on the critical path, and nothing
+        # else takes longer than that.
+        self.assertEqual(critical_path, 15)
+        self.assertLess(critical_path, lifo)
+
+class CommandOutputTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, text):
+        output = CommandOutput(os.path.join(self.root, name), sys.stdout)
+        output.fp.write(text.encode(util.ConsoleEncoding(sys.stdout)))
+        output.finish()
+        return output
+
+    def runTest(self):
+        includes = ''.join(['Note: including file: header{}.h\r\n'.format(i) for i in range(20000)])
+        text = 'main.cpp\r\n' + includes + 'warning: something\r\n'
+        self.assertGreater(len(text), OUTPUT_SPILL_SIZE)
+
+        # Small outputs are read back and removed.
+        small = self.write('small.txt', 'main.cpp\r\n')
+        self.assertEqual(small.text, 'main.cpp\r\n')
+        self.assertFalse(os.path.exists(small.path))
+
+        # Large outputs are filtered from the file, and read back if what's
+        # left is small.
+        large = self.write('large.txt', text)
+        self.assertIsNone(large.text)
+        deps = large.filter(util.FilterMSVCDeps)
+        self.assertEqual(deps, util.ParseMSVCDeps(text)[1])
+        self.assertEqual(large.text, 'main.cpp\nwarning: something\n')
+        self.assertEqual(os.listdir(self.root), [])
+
+        # If it's still large, the master is sent the file instead.
+        large = self.write('large.txt', text)
+        large.filter(util.FilterMSVCDeps, 'No match')
+        reply = {}
+        large.addToReply(reply, 'stdout')
+        self.assertEqual(reply['stdout'], '')
+        self.assertEqual(reply['stdout_file'], (large.path, os.path.getsize(large.path)))
+
+class InlineTaskRunnerTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+        os.mkdir('out')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def copy_task(self, name):
+        entry = nodetypes.Entry(1, nodetypes.Copy, None, (os.path.join(self.root, name), name),
+                                None, 0, nodetypes.DIRTY)
+        task = Task(0, entry, [os.path.join('out', name)])
+        task.folder = 'out'
+        return task
+
+    def runTest(self):
+        with open('small.txt', 'wb') as fp:
+            fp.write(b'small')
+        with open('big.bin', 'wb') as fp:
+            fp.write(b'x' * (INLINE_COPY_MAX_SIZE + 1))
+
+        runner = InlineTaskRunner({'buildPath': self.root})
+        self.assertFalse(runner.runs(self.copy_task('big.bin')))
+        self.assertTrue(runner.runs(self.copy_task('missing.txt')))
+
+        task = self.copy_task('small.txt')
+        self.assertTrue(runner.runs(task))
+        message = {
+            'task_id': task.id,
+            'task_type': task.type,
+            'task_data': task.data,
+            'task_folder': task.folder,
+            'task_outputs': task.outputs,
+            'task_env_id': None,
+            'task_copy_mode': 'copy',
+        }
+        reply = runner.receive_task(message)
+        self.assertTrue(reply['ok'])
+        self.assertEqual(reply['updates'][0][0], os.path.join('out', 'small.txt'))
+        with open(os.path.join('out', 'small.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'small')
+
+# Records what TaskWorker.receive_tasks() sends, without running anything.
+class BatchingWorker(TaskWorker):
+    def __init__(self):
+        self.tools_envs_ = {}
+        self.sent = []
+        self.started = []
+
+    def receive_task(self, task):
+        self.started.append((task['task_id'], len(self.sent)))
+        return {'task_id': task['task_id']}
+
+    def try_send(self, message):
+        self.sent.append([result['task_id'] for result in message['results']])
+
+class ResultBatchingTests(unittest.TestCase):
+    def runTest(self):
+        types = [nodetypes.BinWrite, nodetypes.Copy, nodetypes.Command, nodetypes.Symlink]
+        tasks = [{'task_id': i, 'task_type': type} for i, type in enumerate(types)]
+        worker = BatchingWorker()
+        worker.receive_tasks(None, {'tasks': tasks})
+
+        # Results from the quick tasks are sent before the command starts.
+        self.assertEqual(worker.started[2], (2, 1))
+        self.assertEqual(worker.sent, [[0, 1], [2, 3]])
+
+# Records the results TaskMaster.recvResults() handles. The first failure
+# ends the build.
+class ResultsMaster(TaskMaster):
+    def __init__(self):
+        self.status_ = TaskMaster.BUILD_IN_PROGRESS
+        self.completed = []
+        self.continued = False
+
+    def recvTaskComplete(self, worker, message):
+        self.completed.append(message['task_id'])
+        if not message['ok']:
+            self.terminateBuild(TaskMaster.BUILD_FAILED)
+
+    def continueBuild(self, worker):
+        self.continued = True
+
+class RecvResultsTests(unittest.TestCase):
+    def runTest(self):
+        master = ResultsMaster()
+        results = [{'task_id': 1, 'ok': False}, {'task_id': 2, 'ok': True}]
+        master.recvResults(None, {'id': 'results', 'results': results})
+        self.assertEqual(master.completed, [1, 2])
+        self.assertFalse(master.continued)
@@ -0,0 +1,108 @@
+# vim: set ts=8 sts=4 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+import time
+
+# Records a build in the Chrome trace event format (--trace), which can be
+# loaded in chrome://tracing or Perfetto. The master process and each worker
+# get their own track.
+class Tracer(object):
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.start = time.time()
+        self.events = []
+        self.threads = set()
+        self.nameThread(self.pid, 'master')
+
+    def timestamp(self, when):
+        return int((when - self.start) * 1000000)
+
+    def nameThread(self, tid, name):
+        if tid in self.threads:
+            return
+        self.threads.add(tid)
+        self.events.append({
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': self.pid,
+            'tid': tid,
+            'args': {
+                'name': name
+            },
+        })
+
+    def addSpan(self, name, start, end, tid = None, category = 'build', args = None):
+        if tid is None:
+            tid = self.pid
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': self.timestamp(start),
+            'dur': self.timestamp(end) - self.timestamp(start),
+            'pid': self.pid,
+            'tid': tid,
+        }
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def span(self, name):
+        return TraceSpan(self, name)
+
+    def save(self):
+        with open(self.path, 'w') as fp:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fp)
+
+class TraceSpan(object):
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.tracer.addSpan(self.name, self.start, time.time())
+
+# Used when there is no --trace, so callers don't have to check.
+class NullTracer(object):
+    def nameThread(self, tid, name):
+        pass
+
+    def addSpan(self, name, start, end, tid = None, category = 'build', args = None):
+        pass
+
+    def span(self, name):
+        return self
+
+    def save(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+def CreateTracer(path):
+    if path is None:
+        return NullTracer()
+    return Tracer(path)
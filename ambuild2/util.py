@@ -1,7 +1,11 @@
 # vim: set sts=4 ts=8 sw=4 tw=99 et:
+import codecs
 import errno
+import hashlib
+import multiprocessing as mp
 import subprocess
 import re, os, sys, locale
+import shutil
 import uuid
 import platform
 from tempfile import NamedTemporaryFile
@@ -383,22 +387,252 @@ class Guard:
     def __exit__(self, type, value, traceback):
         self.obj.close()
 
-def Execute(argv, shell = False, env = None):
+def ExecuteEnv(env):
     if env is not None:
-        env = SanitizeEnv(env)
-    elif NeedsSanitizing(os.environ):
-        env = SanitizeEnv(os.environ)
+        return SanitizeEnv(env)
+    if NeedsSanitizing(os.environ):
+        return SanitizeEnv(os.environ)
+    return None
 
+def Execute(argv, shell = False, env = None):
     p = subprocess.Popen(args = argv,
                          stdout = subprocess.PIPE,
                          stderr = subprocess.PIPE,
                          shell = shell,
-                         env = env)
+                         env = ExecuteEnv(env))
     stdout, stderr = p.communicate()
     out = DecodeConsoleText(sys.stdout, stdout)
     err = DecodeConsoleText(sys.stderr, stderr)
     return p, out, err
 
+# Commands are started with os.posix_spawn() where it's available. It doesn't
+# copy the caller's page tables (glibc and macOS implement it with vfork
+# semantics), so starting a process costs the same no matter how big the
+# worker has grown. subprocess.Popen() forks instead, except on Python 3.10+
+# on Linux.
+UsePosixSpawn = hasattr(os, 'posix_spawn') and hasattr(os, 'wait4')
+
+# Signals Python ignores, which subprocess.Popen() restores for the process.
+if UsePosixSpawn:
+    import signal
+    SpawnDefaultSignals = [
+        getattr(signal, name) for name in ['SIGPIPE', 'SIGXFZ', 'SIGXFSZ'] if hasattr(signal, name)
+    ]
+
+# Returns the path to run for |name|, searching PATH in |env| like
+# subprocess.Popen() does.
+def FindExecutable(name, env = None):
+    if os.path.dirname(name):
+        return name
+    for folder in os.get_exec_path(env):
+        path = os.path.join(folder, name)
+        if os.access(path, os.X_OK) and not os.path.isdir(path):
+            return path
+    raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+
+# Unlike subprocess.Popen(), posix_spawn() leaves every inheritable descriptor
+# open in the new process. Python doesn't create inheritable descriptors, but
+# it can be handed some (multiprocessing's forkserver does this), so those are
+# made non-inheritable before the first process is spawned.
+sSealedFdsPid = None
+
+def SealInheritedFds():
+    global sSealedFdsPid
+    if sSealedFdsPid == os.getpid():
+        return
+    sSealedFdsPid = os.getpid()
+
+    if os.path.isdir('/proc/self/fd'):
+        fd_folder = '/proc/self/fd'
+    else:
+        fd_folder = '/dev/fd'
+    for name in os.listdir(fd_folder):
+        fd = int(name)
+        if fd <= 2:
+            continue
+        try:
+            if os.get_inheritable(fd):
+                os.set_inheritable(fd, False)
+        except OSError:
+            # This was the descriptor for the folder listing.
+            pass
+
+# Starts |argv| with posix_spawn(), and returns its pid. |pass_fds| are made
+# inheritable only while the process is being spawned, so this must not race
+# with starting other processes.
+def SpawnProcess(argv, stdout, stderr, env = None, pass_fds = ()):
+    SealInheritedFds()
+
+    if env is None:
+        env = os.environ
+    path = FindExecutable(argv[0], env)
+    file_actions = [
+        (os.POSIX_SPAWN_DUP2, stdout.fileno(), 1),
+        (os.POSIX_SPAWN_DUP2, stderr.fileno(), 2),
+    ]
+
+    for fd in pass_fds:
+        os.set_inheritable(fd, True)
+    try:
+        return os.posix_spawn(path,
+                              argv,
+                              env,
+                              file_actions = file_actions,
+                              setsigdef = SpawnDefaultSignals)
+    finally:
+        for fd in pass_fds:
+            os.set_inheritable(fd, False)
+
+# Runs a process with its output going to the files |stdout| and |stderr|,
+# rather than pipes, so nothing has to be buffered here no matter how much it
+# prints. Returns the exit code and the peak resident memory of the process,
+# in bytes, or None if the platform can't tell us.
+#
+# |pass_fds| is a list of file descriptors to leave open in the process.
+def ExecuteAndMeasure(argv, stdout, stderr, env = None, pass_fds = ()):
+    env = ExecuteEnv(env)
+    if UsePosixSpawn:
+        pid = SpawnProcess(argv, stdout, stderr, env = env, pass_fds = pass_fds)
+    else:
+        kwargs = {}
+        if len(pass_fds):
+            kwargs['pass_fds'] = pass_fds
+        p = subprocess.Popen(args = argv, stdout = stdout, stderr = stderr, env = env, **kwargs)
+        if not hasattr(os, 'wait4'):
+            return p.wait(), None
+        pid = p.pid
+
+    # We can't use wait(), since it reaps the process without giving us its
+    # resource usage.
+    _, status, usage = os.wait4(pid, 0)
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    if not UsePosixSpawn:
+        p.returncode = returncode
+
+    # ru_maxrss is in bytes on macOS, and kilobytes everywhere else.
+    peak_memory = usage.ru_maxrss
+    if not IsMac():
+        peak_memory *= 1024
+    return returncode, peak_memory
+
+# Returns how much memory is available to start new processes, in bytes, or
+# None if unknown.
+def AvailableMemory():
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+# How AddCopy tasks create their output. "copy" makes a new file, sharing the
+# source's data blocks when the filesystem allows it (see CloneFile()).
+# "link" makes a hard link, and copies where that isn't possible; the output is
+# then the same file as the source, so writing to one changes both.
+CopyModes = ['copy', 'link']
+
+# FICLONE from <linux/fs.h>. It makes a file share another file's blocks, on
+# filesystems with copy-on-write (btrfs, XFS, bcachefs).
+FICLONE = 0x40049409
+
+# Ways CloneFile() can copy data on this platform, best first.
+CopyReflink = 'reflink'
+CopyFileRange = 'copy_file_range'
+CopyStrategies = []
+if IsLinux():
+    import fcntl
+    CopyStrategies.append(CopyReflink)
+if hasattr(os, 'copy_file_range'):
+    CopyStrategies.append(CopyFileRange)
+
+# Errors that mean a strategy isn't supported between two files, rather than
+# that the copy failed.
+CopyUnsupportedErrors = set([
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EXDEV,
+])
+
+# Maps (source device, output device) to the index of the best strategy that
+# worked between them, found by the first copy between the two filesystems.
+sCopyStrategies = {}
+
+# (source device, output folder device) pairs that can't be hard linked.
+sUnlinkableDevices = set()
+
+def RemoveFile(path):
+    try:
+        os.unlink(path)
+    except OSError as exn:
+        if exn.errno != errno.ENOENT:
+            raise
+
+# Copies the data in |src| to |dst|, both unbuffered files, without reading it
+# into this process. Returns False if the filesystems don't allow that.
+def CloneFile(src, dst):
+    src_stat = os.fstat(src.fileno())
+    key = (src_stat.st_dev, os.fstat(dst.fileno()).st_dev)
+    index = sCopyStrategies.get(key, 0)
+
+    while index < len(CopyStrategies):
+        try:
+            if CopyStrategies[index] == CopyReflink:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return True
+
+            while True:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), 1024 * 1024 * 1024)
+                if copied == 0:
+                    break
+            # Some filesystems report nothing to copy, rather than an error.
+            if dst.tell() == src_stat.st_size:
+                return True
+        except OSError as exn:
+            if exn.errno not in CopyUnsupportedErrors:
+                raise
+
+        index += 1
+        sCopyStrategies[key] = index
+        src.seek(0)
+        dst.seek(0)
+        dst.truncate()
+    return False
+
+# Like shutil.copy(), but |dest| is replaced rather than written to, and how it
+# is created depends on |mode| (see CopyModes).
+def CopyFile(source, dest, mode = 'copy'):
+    RemoveFile(dest)
+
+    if mode == 'link':
+        key = (os.stat(source).st_dev, os.stat(os.path.dirname(dest) or '.').st_dev)
+        if key not in sUnlinkableDevices:
+            try:
+                os.link(source, dest)
+                return
+            except OSError as exn:
+                # EMLINK is about this file, not the filesystem.
+                if exn.errno != errno.EMLINK:
+                    sUnlinkableDevices.add(key)
+
+    with open(source, 'rb', buffering = 0) as src:
+        with open(dest, 'wb', buffering = 0) as dst:
+            cloned = CloneFile(src, dst)
+    if not cloned:
+        # This uses sendfile() or fcopyfile() where it can.
+        shutil.copyfile(source, dest)
+    shutil.copymode(source, dest)
+
 def typeof(x):
     return builtins.type(x)
 
@@ -433,13 +667,16 @@ sLookForIncludeGuard = 1
 sFoundIncludeGuard = 2
 sIgnoring = 3
 
-def ParseGCCDeps(text):
+# The dependency filters below take the lines of a compiler's output (without
+# line endings), pass every line that isn't part of a dependency listing to
+# |write|, and return the dependencies. They don't need the whole output in
+# memory, so they can stream over a file (see task.CommandOutput).
+def FilterGCCDeps(lines, write):
     deps = set()
     strip = False
-    new_text = ''
 
     state = sReadIncludes
-    for line in re.split(r'\n+', text):
+    for line in lines:
         line = line.replace('\r', '')
         if state == sReadIncludes:
             m = re.match(r'[\.!x]\.*\s+(.+)\s*$', line)
@@ -464,35 +701,28 @@ def ParseGCCDeps(text):
                 strip = False
                 state = sIgnoring
         if not strip and len(line):
-            new_text += line + '\n'
-    return new_text, deps
+            write(line + '\n')
+    return deps
 
-def ParseMSVCDeps(out, inclusion_pattern = None):
+def FilterMSVCDeps(lines, write, inclusion_pattern = None):
     if inclusion_pattern is not None:
-        pattern = inclusion_pattern
+        pattern = re.compile(inclusion_pattern)
     else:
-        pattern = r'Note: including file:\s+(.+)$'
+        pattern = re.compile(r'Note: including file:\s+(.+)$')
 
     deps = []
-    new_text = ''
-    out = out.replace('\r\n', '\n')
-    out = out.replace('\r', '\n')
-    for line in out.split('\n'):
-        m = re.search(pattern, line)
+    for line in lines:
+        m = pattern.search(line)
         if m != None:
             file = m.group(1).strip()
             deps.append(file)
         else:
-            new_text += line + '\n'
-    return new_text, deps
-
-def ParseFXCDeps(out):
-    out = out.replace('\r\n', '\n')
-    out = out.replace('\r', '\n')
+            write(line + '\n')
+    return deps
 
+def FilterFXCDeps(lines, write):
     deps = []
-    new_text = ''
-    for line in out.split('\n'):
+    for line in lines:
         # The inclusion pattern is probably translated, but for now we ignore this possibilty.
         m = re.match(r'Opening file \[.*\], stack top \[.*\]', line)
         if m is not None:
@@ -504,9 +734,28 @@ def ParseFXCDeps(out):
         if m is not None:
             deps.append(m.group(1).strip())
             continue
-        new_text += line + '\n'
+        write(line + '\n')
+    return deps
+
+def SplitLines(text):
+    text = text.replace('\r\n', '\n')
+    text = text.replace('\r', '\n')
+    return text.split('\n')
 
-    return new_text, deps
+def ParseGCCDeps(text):
+    new_text = []
+    deps = FilterGCCDeps(re.split(r'\n+', text), new_text.append)
+    return ''.join(new_text), deps
+
+def ParseMSVCDeps(out, inclusion_pattern = None):
+    new_text = []
+    deps = FilterMSVCDeps(SplitLines(out), new_text.append, inclusion_pattern)
+    return ''.join(new_text), deps
+
+def ParseFXCDeps(out):
+    new_text = []
+    deps = FilterFXCDeps(SplitLines(out), new_text.append)
+    return ''.join(new_text), deps
 
 def ParseSunDeps(text):
     deps = set()
@@ -674,6 +923,18 @@ def DecodeConsoleText(origin, text):
 
     return text.decode('utf8', 'replace')
 
+# Returns the encoding DecodeConsoleText() would use for |origin|.
+def ConsoleEncoding(origin):
+    for encoding in [getattr(origin, 'encoding', None), locale.getpreferredencoding()]:
+        if not encoding:
+            continue
+        try:
+            codecs.lookup(encoding)
+            return encoding
+        except LookupError:
+            pass
+    return 'utf8'
+
 def WriteEncodedText(fd, text):
     if not hasattr(fd, 'encoding') or fd.encoding == None:
         text = text.encode(locale.getpreferredencoding(), 'replace')
@@ -736,6 +997,129 @@ def RelPathIfCommon(search_path, prefix_path):
     assert not os.path.isabs(rel_path)
     return rel_path
 
+# The stamp of a node that isn't a file, or hasn't been built yet.
+NullStamp = (0, 0, 0)
+
+# Return a (mtime_ns, size, inode) tuple for a file, from a single stat call,
+# or None if the file does not exist. A file is considered changed if any of
+# these differ. Inode numbers aren't reliable on Windows, so they are always
+# 0 there.
+def FileStamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    if IsWindows():
+        inode = 0
+    else:
+        inode = st.st_ino
+        # SQLite integers are signed 64-bit.
+        if inode >= 1 << 63:
+            inode -= 1 << 64
+    return (st.st_mtime_ns, st.st_size, inode)
+
+# Below this many paths, stat serially; a thread pool costs more than it saves.
+PARALLEL_STAT_THRESHOLD = 64
+
+# On Windows, listing a folder returns stat information for every entry, so
+# it's cheaper than opening each file once enough files share a folder.
+SCANDIR_THRESHOLD = 8
+
+# Return FileStamp() for every path in |paths|, in the same order. Paths are
+# grouped by folder, and folders are processed in parallel, which helps a lot
+# on slow (network or overlay) filesystems.
+def FileStamps(paths):
+    if len(paths) < PARALLEL_STAT_THRESHOLD:
+        return [FileStamp(path) for path in paths]
+
+    groups = {}
+    for index, path in enumerate(paths):
+        folder = os.path.dirname(path) or '.'
+        group = groups.get(folder)
+        if group is None:
+            group = []
+            groups[folder] = group
+        group.append(index)
+
+    stamps = [None] * len(paths)
+
+    def stat_group(item):
+        folder, indices = item
+        if IsWindows() and len(indices) >= SCANDIR_THRESHOLD:
+            ScanFolderStamps(folder, indices, paths, stamps)
+        else:
+            for index in indices:
+                stamps[index] = FileStamp(paths[index])
+
+    from concurrent.futures import ThreadPoolExecutor
+    num_threads = min(len(groups), mp.cpu_count() * 2, 32)
+    with ThreadPoolExecutor(max_workers = num_threads) as pool:
+        for _ in pool.map(stat_group, groups.items()):
+            pass
+    return stamps
+
+def ScanFolderStamps(folder, indices, paths, stamps):
+    try:
+        listing = {}
+        for entry in os.scandir(folder):
+            listing[os.path.normcase(entry.name)] = entry
+    except OSError:
+        listing = {}
+
+    for index in indices:
+        entry = listing.get(os.path.normcase(os.path.basename(paths[index])))
+        if entry is None or entry.is_symlink():
+            # Fall back to stat, which handles anything the listing can't
+            # (symlinks, odd names, or the folder going away).
+            stamps[index] = FileStamp(paths[index])
+            continue
+        try:
+            st = entry.stat()
+        except OSError:
+            stamps[index] = FileStamp(paths[index])
+            continue
+        stamps[index] = (st.st_mtime_ns, st.st_size, 0)
+
+# Chunk size for hashing files, so large outputs don't have to be read into
+# memory at once.
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+# Return a digest of a file's contents, as bytes. This is used to detect
+# whether a regenerated file actually changed.
+def DigestFile(path):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(DIGEST_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.digest()
+
+# Compute (stamp, digest) pairs for a list of files, hashing them in parallel.
+# The stamp is read before hashing, so a file modified while it's being hashed
+# will still look changed the next time. Both values are None for files that
+# can't be read.
+def DigestFiles(paths):
+    def digest(path):
+        stamp = FileStamp(path)
+        if stamp is None:
+            return None, None
+        try:
+            return stamp, DigestFile(path)
+        except (IOError, OSError):
+            return None, None
+
+    if len(paths) <= 1:
+        return [digest(path) for path in paths]
+
+    # hashlib releases the GIL while hashing large buffers, so threads are
+    # enough to hash several files at once.
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers = min(len(paths), mp.cpu_count())) as pool:
+        return list(pool.map(digest, paths))
+
 # Build an environment from an iterable of environment commands.
 def BuildEnv(cmds, env = None):
     if env is None:
@@ -0,0 +1,117 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from ambuild2 import util
+
+class FileStampsTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def runTest(self):
+        paths = []
+        for i in range(4):
+            folder = os.path.join(self.root, 'dir{}'.format(i))
+            os.mkdir(folder)
+            paths.append(folder)
+            for j in range(30):
+                path = os.path.join(folder, 'file{}.h'.format(j))
+                with open(path, 'w') as fp:
+                    fp.write('x' * j)
+                paths.append(path)
+            paths.append(os.path.join(folder, 'missing.h'))
+        paths.append(os.path.join(self.root, 'missing', 'file.h'))
+
+        expected = [util.FileStamp(path) for path in paths]
+        self.assertIsNone(expected[-1])
+        self.assertEqual(util.FileStamps(paths), expected)
+
+        # Folder listings are only used on Windows, but they must agree with
+        # stat everywhere (other than inodes).
+        stamps = [None] * len(paths)
+        util.ScanFolderStamps(os.path.join(self.root, 'dir0'), list(range(1, 32)), paths, stamps)
+        for index in range(1, 32):
+            if expected[index] is None:
+                self.assertIsNone(stamps[index])
+            else:
+                self.assertEqual(stamps[index][:2], expected[index][:2])
+
+class ExecuteAndMeasureTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.use_posix_spawn = util.UsePosixSpawn
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        util.UsePosixSpawn = self.use_posix_spawn
+
+    def execute(self, argv):
+        out_path = os.path.join(self.root, 'stdout')
+        err_path = os.path.join(self.root, 'stderr')
+        with open(out_path, 'wb') as out, open(err_path, 'wb') as err:
+            returncode, _ = util.ExecuteAndMeasure(argv, out, err)
+        with open(out_path, 'rb') as out, open(err_path, 'rb') as err:
+            return returncode, out.read(), err.read()
+
+    def runTest(self):
+        launchers = [False]
+        if self.use_posix_spawn:
+            launchers.append(True)
+
+        script = 'import sys; print("out"); sys.stderr.write("err"); sys.exit(3)'
+        for use_posix_spawn in launchers:
+            util.UsePosixSpawn = use_posix_spawn
+            returncode, out, err = self.execute([sys.executable, '-c', script])
+            self.assertEqual(returncode, 3)
+            self.assertEqual(out.strip(), b'out')
+            self.assertEqual(err, b'err')
+
+            with self.assertRaises(OSError):
+                self.execute(['ambuild-no-such-program'])
+
+class CopyFileTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.copy_strategies = util.CopyStrategies
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        util.CopyStrategies = self.copy_strategies
+        util.sCopyStrategies.clear()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as fp:
+            return fp.read()
+
+    def runTest(self):
+        contents = os.urandom(3 * 1024 * 1024 + 5)
+        with open(self.path('source'), 'wb') as fp:
+            fp.write(contents)
+        os.chmod(self.path('source'), 0o750)
+
+        # Whatever strategy this filesystem supports, and the fallback.
+        for copy_strategies in [self.copy_strategies, []]:
+            util.CopyStrategies = copy_strategies
+            util.sCopyStrategies.clear()
+
+            # An output hard linked to the source must be replaced, not written to.
+            os.link(self.path('source'), self.path('copy'))
+            util.CopyFile(self.path('source'), self.path('copy'))
+            self.assertEqual(self.read('copy'), contents)
+            self.assertNotEqual(
+                os.stat(self.path('copy')).st_ino,
+                os.stat(self.path('source')).st_ino)
+            self.assertEqual(os.stat(self.path('copy')).st_mode & 0o777, 0o750)
+            os.unlink(self.path('copy'))
+
+        util.CopyFile(self.path('source'), self.path('link'), 'link')
+        self.assertEqual(self.read('link'), contents)
+        self.assertEqual(os.stat(self.path('link')).st_ino, os.stat(self.path('source')).st_ino)
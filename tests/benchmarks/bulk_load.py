@@ -0,0 +1,171 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+#
+# Compares the lazy, per-node database lookups against Database.bulk_load()
+# on a synthetic C++ graph. Every translation unit includes a common header
+# plus a handful of other shared headers. We touch either the common header
+# (damaging everything) or a single source file, and time the damage pass plus
+# the dependency lookups that Builder.mergeDependencies performs per command.
+#
+# "adaptive" is what a build does: nodes are loaded in one scan, and edges
+# switch from per-node queries to a full scan once that becomes cheaper.
+# "bulk" loads every edge table up front.
+#
+# Usage: python tests/benchmarks/bulk_load.py [--tus N] [--headers N]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from ambuild2 import damage
+from ambuild2 import database
+from ambuild2 import nodetypes
+from ambuild2 import util
+
+def CreateGraph(root, num_tus, num_headers, includes_per_tu, db_path = None):
+    src_folder = os.path.join(root, 'src')
+    os.mkdir(src_folder)
+
+    if db_path is None:
+        db_path = os.path.join(root, 'graph')
+    db = database.CreateDatabase(db_path)
+
+    common = os.path.join(src_folder, 'common.h')
+    with open(common, 'w') as fp:
+        fp.write('\n')
+    common = db.add_source(common)
+
+    headers = []
+    for i in range(num_headers):
+        path = os.path.join(src_folder, 'header{}.h'.format(i))
+        with open(path, 'w') as fp:
+            fp.write('\n')
+        headers.append(db.add_source(path))
+
+    obj_folder = db.add_folder(None, 'obj')
+    os.mkdir(os.path.join(root, 'obj'))
+
+    objs = []
+    for i in range(num_tus):
+        path = os.path.join(src_folder, 'tu{}.cpp'.format(i))
+        with open(path, 'w') as fp:
+            fp.write('\n')
+        source = db.add_source(path)
+
+        data = {'type': 'gcc', 'argv': ['cc', '-c', path, '-o', 'tu{}.o'.format(i)]}
+        cmd = db.add_command(nodetypes.Cxx, obj_folder, data, nodetypes.DIRTY, None)
+        obj = db.add_output(obj_folder, os.path.join('obj', 'tu{}.o'.format(i)))
+        with open(os.path.join(root, obj.path), 'w') as fp:
+            fp.write('\n')
+
+        db.add_strong_edge(source, cmd)
+        db.add_strong_edge(cmd, obj)
+        db.add_dynamic_edge(common, cmd)
+        for j in range(includes_per_tu):
+            db.add_dynamic_edge(headers[(i + j) % num_headers], cmd)
+        objs.append(obj)
+        if i == 0:
+            first_tu = source
+
+    link = db.add_command(nodetypes.Command, obj_folder, ['ld', '-o', 'program'], nodetypes.DIRTY,
+                          None)
+    program = db.add_output(obj_folder, os.path.join('obj', 'program'))
+    with open(os.path.join(root, program.path), 'w') as fp:
+        fp.write('\n')
+    db.add_strong_edge(link, program)
+    for obj in objs:
+        db.add_strong_edge(obj, link)
+
+    # Mark everything as up-to-date, as if a build had just finished.
+    with util.FolderChanger(root):
+        for entry in list(db.node_cache_.values()):
+            if entry.type != nodetypes.Mkdir:
+                db.unmark_dirty(entry)
+    db.commit()
+    db.close()
+
+    return common.path, first_tu.path
+
+class QueryCounter(object):
+    def __init__(self, db):
+        self.count = 0
+        db.cn.set_trace_callback(self.on_query)
+
+    def on_query(self, statement):
+        self.count += 1
+
+def RunDamagePass(root, mode):
+    db = database.Database(os.path.join(root, 'graph'))
+    db.connect()
+    counter = QueryCounter(db)
+
+    start = time.time()
+    if mode != 'lazy':
+        db.bulk_load()
+    if mode == 'bulk':
+        db.load_edges()
+    with util.FolderChanger(root):
+        graph = damage.ComputeDamageGraph(db)
+
+    # Mimic Builder.mergeDependencies, which looks up the inputs of every
+    # command once it completes.
+    num_commands = 0
+    for node, entry in enumerate(graph.entries):
+        if graph.is_command[node]:
+            db.query_strong_inputs(entry)
+            db.query_dynamic_inputs(entry)
+            db.query_outgoing(entry)
+            num_commands += 1
+    elapsed = time.time() - start
+
+    # Don't persist the dirty bits; every run should see the same damage.
+    db.cn.rollback()
+    db.close()
+    return counter.count, elapsed, num_commands
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tus', type = int, default = 5000, help = 'Number of translation units')
+    parser.add_argument('--headers', type = int, default = 500, help = 'Number of shared headers')
+    parser.add_argument('--includes', type = int, default = 30, help = 'Headers included per TU')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        common, first_tu = CreateGraph(root, args.tus, args.headers, args.includes)
+
+        print('{} TUs, {} headers, {} includes per TU'.format(args.tus, args.headers,
+                                                              args.includes))
+        for touched, path in [('no-op', None), ('one source', first_tu), ('common header', common)]:
+            if path is not None:
+                stamp = os.path.getmtime(path) + 10
+                os.utime(path, (stamp, stamp))
+
+            print('{}:'.format(touched))
+            for mode in ['lazy', 'adaptive', 'bulk']:
+                queries, elapsed, commands = RunDamagePass(root, mode)
+                print('  {:>8}: {:>8} queries, {:8.3f}s, {} commands damaged'.format(
+                    mode, queries, elapsed, commands))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+#
+# Measures how long AddCopy tasks take to copy a set of files, with
+# shutil.copy() (what they used before), and with util.CopyFile() in each
+# mode. --folder picks where the files go, since which copy strategy works
+# depends on the filesystem.
+#
+# Usage: python tests/benchmarks/copy.py [--files N] [--size MB] [--runs N] [--folder PATH]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from ambuild2 import util
+
+def CopyAll(copy, sources, dest_folder):
+    start = time.time()
+    for source in sources:
+        copy(source, os.path.join(dest_folder, os.path.basename(source)))
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type = int, default = 20, help = 'Number of files')
+    parser.add_argument('--size', type = int, default = 16, help = 'Megabytes per file')
+    parser.add_argument('--runs', type = int, default = 3, help = 'Copies to time')
+    parser.add_argument('--folder', type = str, default = None, help = 'Where to put the files')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir = args.folder)
+    try:
+        source_folder = os.path.join(root, 'source')
+        dest_folder = os.path.join(root, 'dest')
+        os.mkdir(source_folder)
+        os.mkdir(dest_folder)
+
+        sources = []
+        for i in range(args.files):
+            path = os.path.join(source_folder, 'file{}.bin'.format(i))
+            with open(path, 'wb') as fp:
+                fp.write(os.urandom(args.size * 1024 * 1024))
+            sources.append(path)
+
+        methods = [
+            ('shutil.copy', shutil.copy),
+            ('copy', lambda source, dest: util.CopyFile(source, dest, 'copy')),
+            ('link', lambda source, dest: util.CopyFile(source, dest, 'link')),
+        ]
+        for name, copy in methods:
+            times = []
+            for _ in range(args.runs):
+                shutil.rmtree(dest_folder)
+                os.mkdir(dest_folder)
+                times.append(CopyAll(copy, sources, dest_folder))
+            best = min(times)
+            rate = args.files * args.size / max(best, 0.000001)
+            print('{:12}: {} x {}MB: {:8.3f}s, {:8.0f} MB/s'.format(name, args.files, args.size,
+                                                                    best, rate))
+
+        strategies = [
+            util.CopyStrategies[index] if index < len(util.CopyStrategies) else 'stream'
+            for index in util.sCopyStrategies.values()
+        ]
+        print('copy strategy: {}'.format(', '.join(strategies) or 'stream'))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
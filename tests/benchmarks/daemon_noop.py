@@ -0,0 +1,95 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+#
+# Times no-op builds of a synthetic C++ graph (the same one as bulk_load.py),
+# once in-process and once through the build daemon. The daemon only has to
+# check files its watcher reported, so its no-op builds shouldn't scale with
+# the size of the graph.
+#
+# Usage: python tests/benchmarks/daemon_noop.py [--tus N] [--runs N]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ambuild2 import daemon
+from ambuild2 import run
+from ambuild2 import util
+import bulk_load
+
+def TimeBuilds(root, options, runs):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        if not run.Build(root, options, []):
+            raise Exception('build failed')
+        times.append(time.time() - start)
+    return min(times), sum(times) / len(times)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tus', type = int, default = 16000, help = 'Number of translation units')
+    parser.add_argument('--headers', type = int, default = 1000, help = 'Number of shared headers')
+    parser.add_argument('--includes', type = int, default = 10, help = 'Headers included per TU')
+    parser.add_argument('--runs', type = int, default = 5, help = 'Builds to time per mode')
+    args = parser.parse_args()
+
+    if not daemon.IsSupported():
+        sys.stderr.write('The build daemon is not supported on this platform.\n')
+        sys.exit(1)
+
+    # Use the default command-line options.
+    sys.argv = sys.argv[:1]
+    options, _ = run.BuildOptions()
+
+    root = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(root, '.ambuild2'))
+        bulk_load.CreateGraph(root,
+                              args.tus,
+                              args.headers,
+                              args.includes,
+                              db_path = os.path.join(root, '.ambuild2', 'graph'))
+        with open(os.path.join(root, '.ambuild2', 'vars'), 'wb') as fp:
+            util.DiskPickle({'buildPath': root}, fp)
+
+        print('{} TUs, {} headers, {} includes per TU'.format(args.tus, args.headers,
+                                                              args.includes))
+        options.no_daemon = True
+        best, mean = TimeBuilds(root, options, args.runs)
+        print('  in-process: best {:8.3f}s, mean {:8.3f}s'.format(best, mean))
+
+        options.no_daemon = False
+        if not daemon.StartDaemon(root):
+            raise Exception('could not start the build daemon')
+        try:
+            # The first build fills the daemon's caches and watches.
+            run.Build(root, options, [])
+            best, mean = TimeBuilds(root, options, args.runs)
+            print('      daemon: best {:8.3f}s, mean {:8.3f}s'.format(best, mean))
+        finally:
+            daemon.StopDaemon(root)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
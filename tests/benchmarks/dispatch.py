@@ -0,0 +1,118 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+#
+# Measures how many tasks per second TaskMaster can get through when the
+# tasks themselves cost almost nothing: every command writes an empty file
+# (like AddOutputFile), so the time is all dispatch and graph updates. These
+# are run by the master itself, unless --no-inline sends them to workers.
+#
+# Usage: python tests/benchmarks/dispatch.py [--tasks N] [--jobs N] [--runs N] [--asyncio]
+#                                            [--no-inline]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from ambuild2 import database
+from ambuild2 import nodetypes
+from ambuild2 import run
+from ambuild2 import task
+from ambuild2 import util
+
+def CreateGraph(root, num_tasks):
+    os.mkdir(os.path.join(root, '.ambuild2'))
+    db = database.CreateDatabase(os.path.join(root, '.ambuild2', 'graph'))
+
+    out_folder = db.add_folder(None, 'out')
+    os.mkdir(os.path.join(root, 'out'))
+    for i in range(num_tasks):
+        name = 'file{}.txt'.format(i)
+        data = {
+            'path': os.path.join('out', name),
+            'contents': b'',
+        }
+        cmd = db.add_command(nodetypes.BinWrite, out_folder, data, nodetypes.DIRTY, None)
+        output = db.add_output(out_folder, os.path.join('out', name))
+        db.add_strong_edge(cmd, output)
+    db.commit()
+    db.close()
+
+    with open(os.path.join(root, '.ambuild2', 'vars'), 'wb') as fp:
+        util.DiskPickle({'buildPath': root}, fp)
+
+def MarkAllDirty(root):
+    db = database.Database(os.path.join(root, '.ambuild2', 'graph'))
+    db.connect()
+    db.cn.execute("update nodes set dirty = ? where type = ?",
+                  (nodetypes.DIRTY, nodetypes.BinWrite))
+    db.commit()
+    db.close()
+
+# Returns the time TaskMaster spent, as recorded in the build log.
+def TimeBuild(root, options):
+    MarkAllDirty(root)
+    with open(os.devnull, 'w') as null:
+        stdout = sys.stdout
+        sys.stdout = null
+        try:
+            if not run.Build(root, options, []):
+                raise Exception('build failed')
+        finally:
+            sys.stdout = stdout
+
+    db = database.Database(os.path.join(root, '.ambuild2', 'graph'))
+    db.connect()
+    _, start, end, _ = db.query_last_build()
+    db.close()
+    return end - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type = int, default = 5000, help = 'Number of tasks')
+    parser.add_argument('--jobs', type = int, default = 4, help = 'Number of workers')
+    parser.add_argument('--runs', type = int, default = 3, help = 'Builds to time')
+    parser.add_argument('--asyncio',
+                        action = 'store_true',
+                        help = 'Run commands with asyncio instead of worker processes')
+    parser.add_argument('--no-inline',
+                        action = 'store_true',
+                        help = 'Send file writes to workers instead of running them in the master')
+    args = parser.parse_args()
+
+    if args.no_inline:
+        task.INLINE_TASK_TYPES = set()
+
+    sys.argv = sys.argv[:1]
+    options, _ = run.BuildOptions()
+    options.no_daemon = True
+    options.jobs = args.jobs
+    options.asyncio = args.asyncio
+
+    root = tempfile.mkdtemp()
+    try:
+        CreateGraph(root, args.tasks)
+        best = min([TimeBuild(root, options) for _ in range(args.runs)])
+        print('{} tasks, {} workers: {:8.3f}s, {:10.0f} tasks/s'.format(
+            args.tasks, args.jobs, best, args.tasks / best))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+#
+# Measures how many commands per second a build can run when every command is
+# /bin/true, so the time is mostly spent starting processes. Each build is
+# run with posix_spawn() and with subprocess.Popen(). --heap grows the master
+# (and so the workers forked from it) by that many megabytes, since fork()
+# gets slower as the process it copies gets bigger.
+#
+# Usage: python tests/benchmarks/spawn.py [--tasks N] [--jobs N] [--runs N] [--heap MB]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from ambuild2 import database
+from ambuild2 import nodetypes
+from ambuild2 import run
+from ambuild2 import util
+
+def CreateGraph(root, num_tasks):
+    os.mkdir(os.path.join(root, '.ambuild2'))
+    db = database.CreateDatabase(os.path.join(root, '.ambuild2', 'graph'))
+
+    out_folder = db.add_folder(None, 'out')
+    os.mkdir(os.path.join(root, 'out'))
+    for i in range(num_tasks):
+        db.add_command(nodetypes.Command, out_folder, ['true', str(i)], nodetypes.DIRTY, None)
+    db.commit()
+    db.close()
+
+    with open(os.path.join(root, '.ambuild2', 'vars'), 'wb') as fp:
+        util.DiskPickle({'buildPath': root}, fp)
+
+def MarkAllDirty(root):
+    db = database.Database(os.path.join(root, '.ambuild2', 'graph'))
+    db.connect()
+    db.cn.execute("update nodes set dirty = ? where type = ?", (nodetypes.DIRTY, nodetypes.Command))
+    db.commit()
+    db.close()
+
+# Returns the time TaskMaster spent, as recorded in the build log.
+def TimeBuild(root, options):
+    MarkAllDirty(root)
+    with open(os.devnull, 'w') as null:
+        stdout = sys.stdout
+        sys.stdout = null
+        try:
+            if not run.Build(root, options, []):
+                raise Exception('build failed')
+        finally:
+            sys.stdout = stdout
+
+    db = database.Database(os.path.join(root, '.ambuild2', 'graph'))
+    db.connect()
+    _, start, end, _ = db.query_last_build()
+    db.close()
+    return end - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type = int, default = 2000, help = 'Number of commands')
+    parser.add_argument('--jobs', type = int, default = 4, help = 'Number of workers')
+    parser.add_argument('--runs', type = int, default = 3, help = 'Builds to time')
+    parser.add_argument('--heap', type = int, default = 0, help = 'Extra megabytes of heap')
+    args = parser.parse_args()
+
+    if not util.UsePosixSpawn:
+        sys.stderr.write('posix_spawn() is not available here.\n')
+        sys.exit(1)
+
+    sys.argv = sys.argv[:1]
+    options, _ = run.BuildOptions()
+    options.no_daemon = True
+    options.jobs = args.jobs
+
+    heap = [bytearray(1024) for _ in range(args.heap * 1024)]
+
+    root = tempfile.mkdtemp()
+    try:
+        CreateGraph(root, args.tasks)
+        for launcher in ['posix_spawn', 'Popen']:
+            # Workers are forked from here, so they see this too.
+            util.UsePosixSpawn = launcher == 'posix_spawn'
+            best = min([TimeBuild(root, options) for _ in range(args.runs)])
+            print('{:12}: {} commands, {} workers: {:8.3f}s, {:8.0f} commands/s'.format(
+                launcher, args.tasks, args.jobs, best, args.tasks / best))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+#
+# This file is part of AMBuild.
+#
+# AMBuild is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AMBuild is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+#
+# Measures what a tools environment costs per task, for an MSVC-like
+# environment (dozens of long variables). "full" is a task message that
+# carries the whole ToolsEnv and builds its environment on every task; "cached"
+# is what TaskMaster and TaskWorker do now: messages carry only the env_id,
+# and each worker builds the environment once.
+#
+# Usage: python tests/benchmarks/tools_env.py [--vars N] [--tasks N]
+import argparse
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from ambuild2 import nodetypes
+from ambuild2 import util
+from ambuild2.task import TaskWorker
+
+def CreateToolsEnv(num_vars):
+    env_cmds = []
+    for i in range(num_vars):
+        folders = [
+            'C:\\Program Files\\Microsoft Visual Studio\\Tools\\{}\\{}'.format(i, j)
+            for j in range(4)
+        ]
+        env_cmds.append(('replace', 'MSVC_VAR_{}'.format(i), ';'.join(folders)))
+    env_cmds.append(('add', 'PATH', ';C:\\Program Files\\Microsoft Visual Studio\\bin'))
+
+    env_data = (
+        ('env_cmds', tuple(env_cmds)),
+        ('tools', (('cl', 'C:\\Program Files\\Microsoft Visual Studio\\bin\\cl.exe'),)),
+        ('props', ()),
+    )
+    return nodetypes.ToolsEnv(1, env_data)
+
+def CreateMessage(tools_env, i):
+    return {
+        'task_id': i,
+        'task_type': 'cxx',
+        'task_data': {
+            'type': 'msvc',
+            'argv': ['cl', '/c', 'file{}.cpp'.format(i), '/Fofile{}.obj'.format(i)],
+        },
+        'task_folder': 'out',
+        'task_outputs': ['file{}.obj'.format(i)],
+        'task_env_id': tools_env.env_id,
+    }
+
+class NullChannel(object):
+    def send(self, obj):
+        pass
+
+def TimeFull(tools_env, num_tasks):
+    start = time.time()
+    size = 0
+    for i in range(num_tasks):
+        message = CreateMessage(tools_env, i)
+        message['task_tools_env'] = tools_env
+        data = pickle.dumps({'id': 'tasks', 'tasks': [message]})
+        size += len(data)
+
+        message = pickle.loads(data)['tasks'][0]
+        util.ExecuteEnv(util.BuildEnv(message['task_tools_env'].env_cmds))
+    return time.time() - start, size
+
+def TimeCached(tools_env, num_tasks):
+    worker = TaskWorker(NullChannel(), {'buildPath': os.getcwd()}, {})
+    start = time.time()
+    size = 0
+    for i in range(num_tasks):
+        envs = {tools_env.env_id: tools_env} if i == 0 else {}
+        data = pickle.dumps({'id': 'tasks', 'tasks': [CreateMessage(tools_env, i)], 'envs': envs})
+        size += len(data)
+
+        message = pickle.loads(data)
+        worker.addToolsEnvs(message['envs'])
+        worker.getEnv(worker.getToolsEnv(message['tasks'][0]))
+    return time.time() - start, size
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vars', type = int, default = 40, help = 'Environment variables')
+    parser.add_argument('--tasks', type = int, default = 5000, help = 'Number of tasks')
+    args = parser.parse_args()
+
+    tools_env = CreateToolsEnv(args.vars)
+    for name, fn in [('full', TimeFull), ('cached', TimeCached)]:
+        elapsed, size = fn(tools_env, args.tasks)
+        print('{:6}: {:8.0f} bytes/task, {:8.1f} us/task'.format(name, size / args.tasks,
+                                                                 elapsed * 1000000 / args.tasks))
+
+if __name__ == '__main__':
+    main()